@@ -1,6 +1,7 @@
 from tasks.future import Future
 from tasks.taskmanager import TaskManager
 from tasks.task import *
+from testconstants import TASK_MANAGER_WORKERS
 import types
 
 
@@ -13,8 +14,8 @@ API provides a way to run task do syncronously and asynchronously.
 class Cluster(object):
     """An API for interacting with Couchbase clusters"""
 
-    def __init__(self):
-        self.task_manager = TaskManager("Cluster_Thread")
+    def __init__(self, num_workers=TASK_MANAGER_WORKERS):
+        self.task_manager = TaskManager("Cluster_Thread", num_workers)
         self.task_manager.start()
 
     def async_create_default_bucket(self, bucket_params):
@@ -153,7 +154,11 @@ class Cluster(object):
 
     def async_verify_data(self, server, bucket, kv_store, max_verify=None,
                           only_store_hash=True, batch_size=1, replica_to_read=None, timeout_sec=5):
-        if batch_size > 1:
+        num_shards = TestInputSingleton.input.param("validate_processes", 0) if TestInputSingleton.input else 0
+        if num_shards > 1 and replica_to_read is None:
+            _task = ShardedValidateDataTask(server, bucket, kv_store, max_verify, only_store_hash,
+                                            max(batch_size, 1000), num_shards)
+        elif batch_size > 1:
             _task = BatchedValidateDataTask(server, bucket, kv_store, max_verify, only_store_hash, batch_size, timeout_sec)
         else:
             _task = ValidateDataTask(server, bucket, kv_store, max_verify, only_store_hash, replica_to_read)
@@ -1,6 +1,9 @@
 import os, time
 import os.path
+import csv
 import uuid
+import zlib
+from threading import Thread, Lock
 from remote.remote_util import RemoteMachineShellConnection
 from lib.mc_bin_client import MemcachedClient
 from memcached.helper.data_helper import MemcachedClientHelper
@@ -18,6 +21,93 @@ UPDATED_ITEMS="updatedItems"
 LOGICAL_RESULT="logicalresult"
 RESULT="result"
 MEMCACHED_PORT=11210
+DIGEST_MASK=(1 << 64) - 1
+
+class DataSetIndex(dict):
+    """ Keyed index of the cbtransfer csv rows of one bucket
+
+        Maps document key -> csv row, or -> (fingerprint, rev) when created
+        with fingerprints=True, which is all a comparison needs and much
+        smaller for large buckets. Rows are added one at a time from any
+        iterable of lines (e.g. an open csv file), the row with the highest
+        rev wins for keys seen more than once, and a key list plus an order
+        independent digest of the row fingerprints is kept per vbucket so
+        DataAnalyzer can skip vbuckets that match.
+    """
+
+    def __init__(self, header=None, fingerprints=False, key_index=0):
+        dict.__init__(self)
+        self.fingerprints = fingerprints
+        self.key_index = key_index
+        self.vb_keys = {}
+        self.vb_digests = {}
+        self.lock = Lock()
+        self.set_header(header)
+
+    def set_header(self, header):
+        """ Locate rev and vbid, which follow the (possibly quoted) value """
+        fields = [field.strip() for field in (header or "").split(",")]
+        if "value" in fields and "rev" in fields and "vbid" in fields:
+            value = fields.index("value")
+            self.tail = len(fields) - value - 1
+            self.rev_index = fields.index("rev") - value - 1
+            self.vb_index = fields.index("vbid") - value - 1
+        else:
+            # id,flags,expiration,cas,value,rev,vbid
+            self.tail, self.rev_index, self.vb_index = 2, 0, 1
+
+    def load(self, lines, header=None):
+        with self.lock:
+            if header is not None:
+                self.set_header(header)
+            for line in lines:
+                self.add(line)
+        return self
+
+    def add(self, row):
+        row = row.rstrip("\r\n")
+        if not row:
+            return
+        if self.key_index == 0 and not row.startswith('"'):
+            key = row[:row.find(",")]
+        else:
+            key = csv.reader([row]).next()[self.key_index]
+        tail = row.rsplit(",", self.tail)[1:]
+        try:
+            rev = int(tail[self.rev_index])
+        except (IndexError, ValueError):
+            rev = 0
+        vb = tail[self.vb_index] if len(tail) == self.tail else None
+        fingerprint = zlib.crc32(row) & 0xffffffff
+        if key in self:
+            if self.rev(key) >= rev:
+                return
+            # a key always hashes to the same vbucket
+            self.vb_digests[vb] = (self.vb_digests[vb] - self.fingerprint(key)) & DIGEST_MASK
+        else:
+            self.vb_keys.setdefault(vb, []).append(key)
+        self.vb_digests[vb] = (self.vb_digests.get(vb, 0) + fingerprint) & DIGEST_MASK
+        if self.fingerprints:
+            self[key] = (fingerprint, rev)
+        else:
+            self[key] = row
+
+    def fingerprint(self, key):
+        if self.fingerprints:
+            return self[key][0]
+        return zlib.crc32(self[key]) & 0xffffffff
+
+    def rev(self, key):
+        if self.fingerprints:
+            return self[key][1]
+        try:
+            return int(self[key].rsplit(",", self.tail)[1:][self.rev_index])
+        except (IndexError, ValueError):
+            return 0
+
+    def vbucket_matches(self, other, vb):
+        return len(self.vb_keys.get(vb, ())) == len(other.vb_keys.get(vb, ())) and \
+               self.vb_digests.get(vb) == other.vb_digests.get(vb)
 
 class DataAnalysisResultAnalyzer:
     """ Class containing methods to help analyze results for data analysis """
@@ -299,13 +389,17 @@ class DataAnalyzer(object):
     def find_data_distribution(self,info):
         """ Method to extract data distribution from map info """
         distribution_map = {}
-        for key in info.keys():
-            data = info[key].split(",")
-            vbucket = data[len(data) - 1]
-            if vbucket in distribution_map.keys():
-                distribution_map[vbucket] += 1
-            else:
-                distribution_map[vbucket] = 1
+        if isinstance(info, DataSetIndex):
+            for vbucket, keys in info.vb_keys.iteritems():
+                distribution_map[vbucket] = len(keys)
+        else:
+            for key in info.keys():
+                data = info[key].split(",")
+                vbucket = data[len(data) - 1]
+                if vbucket in distribution_map:
+                    distribution_map[vbucket] += 1
+                else:
+                    distribution_map[vbucket] = 1
         array  =  []
         total  = 0
         for key in distribution_map.keys():
@@ -344,24 +438,62 @@ class DataAnalyzer(object):
 
     def compare_data_maps(self,info1,info2,headerInfo,mainKey,comparisonMap=None):
         """ Method to help comparison of datasets """
+        if comparisonMap == None and isinstance(info1, DataSetIndex) and isinstance(info2, DataSetIndex):
+            return self.compare_data_indexes(info1,info2,headerInfo)
         updatedItemsMap = {}
-        deletedItemsList = list(set(info1.keys()) - set(info2.keys()))
-        addedItemsList = list(set(info2.keys()) - set(info1.keys()))
-        for key in set(info1.keys()) & set(info2.keys()):
-            data1 = info1[key].split(",")
-            data2 = info2[key].split(",")
-            fields = headerInfo.split(",")
-            reason = {}
-            if len(data1) == len(data2):
-                for i in range(len(data1)):
-                    if comparisonMap != None and headerInfo[i] in comparisonMap.keys():
-                        self.compare_values(data1[i],data2[i],fields[i],reason,comparisonMap[headerInfo[i]])
-                    elif data1[i] !=  data2[i]:
-                        reason[fields[i]] = "Expected {0} :: Actual {1}".format(data1[i],data2[i])
-            else:
-                reason["number of value mismatch"] = "Number of values mismatch :: Expected values {0} \n Actual values {1}".format(data1,data2)
+        keys1 = set(info1)
+        keys2 = set(info2)
+        deletedItemsList = list(keys1 - keys2)
+        addedItemsList = list(keys2 - keys1)
+        fields = headerInfo.split(",")
+        for key in keys1 & keys2:
+            reason = self.compare_rows(info1[key],info2[key],fields,headerInfo,comparisonMap)
             if len(reason) > 0:
                 updatedItemsMap[key] = reason
+        return self.data_maps_result(deletedItemsList,addedItemsList,updatedItemsMap)
+
+    def compare_data_indexes(self,info1,info2,headerInfo):
+        """ Compares two DataSetIndex, only looking at keys of vbuckets whose digests differ """
+        updatedItemsMap = {}
+        deletedItemsList = []
+        addedItemsList = []
+        fields = headerInfo.split(",")
+        for vb in set(info1.vb_keys) | set(info2.vb_keys):
+            if info1.vbucket_matches(info2, vb):
+                continue
+            for key in info1.vb_keys.get(vb, []):
+                if key not in info2:
+                    deletedItemsList.append(key)
+                elif info1.fingerprint(key) != info2.fingerprint(key):
+                    if info1.fingerprints or info2.fingerprints:
+                        reason = {"row": "Expected rev {0} crc {1:08x} :: Actual rev {2} crc {3:08x}".format(
+                            info1.rev(key), info1.fingerprint(key), info2.rev(key), info2.fingerprint(key))}
+                    else:
+                        reason = self.compare_rows(info1[key],info2[key],fields,headerInfo)
+                    updatedItemsMap[key] = reason
+            for key in info2.vb_keys.get(vb, []):
+                if key not in info1:
+                    addedItemsList.append(key)
+        return self.data_maps_result(deletedItemsList,addedItemsList,updatedItemsMap)
+
+    def compare_rows(self,row1,row2,fields,headerInfo,comparisonMap=None):
+        """ Helper method to compare two csv rows field by field """
+        data1 = row1.split(",")
+        data2 = row2.split(",")
+        reason = {}
+        if len(data1) == len(data2):
+            for i in range(len(data1)):
+                field = fields[i] if i < len(fields) else str(i)
+                if comparisonMap != None and headerInfo[i] in comparisonMap.keys():
+                    self.compare_values(data1[i],data2[i],field,reason,comparisonMap[headerInfo[i]])
+                elif data1[i] !=  data2[i]:
+                    reason[field] = "Expected {0} :: Actual {1}".format(data1[i],data2[i])
+        else:
+            reason["number of value mismatch"] = "Number of values mismatch :: Expected values {0} \n Actual values {1}".format(data1,data2)
+        return reason
+
+    def data_maps_result(self,deletedItemsList,addedItemsList,updatedItemsMap):
+        """ Helper method to build the logical and detailed comparison result """
         comparisonResult = {DELETED_ITEMS:deletedItemsList,ADD_ITEMS:addedItemsList,UPDATED_ITEMS:updatedItemsMap}
         logicalResult = {DELETED_ITEMS:(len(deletedItemsList) > 0),ADD_ITEMS:(len(addedItemsList) > 0),UPDATED_ITEMS:(len(updatedItemsMap) > 0)}
         return {LOGICAL_RESULT:logicalResult,RESULT:comparisonResult}
@@ -412,10 +544,12 @@ class DataAnalyzer(object):
 class DataCollector(object):
     """ Helper Class to collect stats and data from clusters """
 
-    def collect_data(self,servers,buckets,userId="Administrator",password="password", data_path = None, perNode = True, getReplica = False, mode = "memory"):
+    def collect_data(self,servers,buckets,userId="Administrator",password="password", data_path = None, perNode = True, getReplica = False, mode = "memory", fingerprints = False):
         """
             Method to extract all data information from memory or disk using cbtransfer
             The output is organized like { bucket :{ node { document-key : list of values }}}
+            cbtransfer runs on all servers in parallel and each csv is streamed
+            into a DataSetIndex as it is read
 
             Paramters:
 
@@ -425,6 +559,8 @@ class DataCollector(object):
             password: password of cb server
             data_path: data path on servers, if given we will do cbtransfer on files
             perNode: if set we organize data for each bucket per node basis else we take a union
+            fingerprints: if set only keep a fingerprint and rev per key instead of the csv row,
+                          enough for compare_all_dataset/compare_per_node_dataset on large buckets
 
             Returns:
 
@@ -435,28 +571,54 @@ class DataCollector(object):
         """
         completeMap = {}
         for bucket in buckets:
-            completeMap[bucket.name] = {}
-        headerInfo = None
-        for server in servers:
-            if  mode  ==  "disk" and data_path == None:
-                rest = RestConnection(server)
-                data_path = rest.get_data_path()
-            headerInfo = []
-            bucketMap = {}
-            if  server.ip == "127.0.0.1":
-                headerInfo,bucketMap = self.get_local_data_map_using_cbtransfer(server,buckets, data_path=data_path, userId=userId,password=password, getReplica = getReplica, mode = mode)
+            if perNode:
+                completeMap[bucket.name] = {}
             else:
-                remote_client = RemoteMachineShellConnection(server)
-                headerInfo,bucketMap = remote_client.get_data_map_using_cbtransfer(buckets, data_path=data_path, userId=userId,password=password, getReplica = getReplica, mode = mode)
-                remote_client.disconnect()
-            for bucket in bucketMap.keys():
-                newMap = self.translateDataFromCSVToMap(0,bucketMap[bucket])
+                completeMap[bucket.name] = DataSetIndex(fingerprints=fingerprints)
+        if  mode  ==  "disk" and data_path == None and servers:
+            rest = RestConnection(servers[0])
+            data_path = rest.get_data_path()
+
+        def collect(server):
+            def loader(bucket, header, lines):
                 if perNode:
-                    completeMap[bucket][server.ip] = newMap
+                    index = DataSetIndex(fingerprints=fingerprints)
+                    completeMap.setdefault(bucket, {})[server.ip] = index
                 else:
-                    completeMap[bucket].update(newMap)
+                    index = completeMap.setdefault(bucket, DataSetIndex(fingerprints=fingerprints))
+                return index.load(lines, header)
+            if  server.ip == "127.0.0.1":
+                return self.get_local_data_map_using_cbtransfer(server,buckets, data_path=data_path, userId=userId,password=password, getReplica = getReplica, mode = mode, loader = loader)
+            remote_client = RemoteMachineShellConnection(server)
+            try:
+                return remote_client.get_data_map_using_cbtransfer(buckets, data_path=data_path, userId=userId,password=password, getReplica = getReplica, mode = mode, loader = loader)
+            finally:
+                remote_client.disconnect()
+
+        headerInfo = None
+        for header, bucketMap in self._run_on_servers(servers, collect):
+            headerInfo = header
         return headerInfo,completeMap
 
+    def _run_on_servers(self, servers, func):
+        """ Runs func(server) for all servers in parallel, returns the results in server order """
+        results = [None] * len(servers)
+        errors = []
+        def run(i, server):
+            try:
+                results[i] = func(server)
+            except Exception, e:
+                errors.append(e)
+        threads = [Thread(target=run, args=(i, server), name="collect_{0}".format(server.ip))
+                   for i, server in enumerate(servers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
     def collect_vbucket_stats(self,buckets,servers,collect_vbucket = True,collect_vbucket_seqno = True,collect_vbucket_details = True,perNode = True):
         """
             Method to extract the vbuckets stats given by cbstats tool
@@ -693,22 +855,11 @@ class DataCollector(object):
                     m["state"] = value
                     map_data[vb] = m
 
-    def translateDataFromCSVToMap(self,index,dataInCSV):
+    def translateDataFromCSVToMap(self,index,dataInCSV,headerInfo=None,fingerprints=False):
         """ Helper method to translate cbtransfer per line data into key: value pairs"""
-        bucketMap = {}
-        revIdIndex = 5
-        for value in dataInCSV:
-            values = value.split(",")
-            if values[index] in bucketMap.keys():
-                prev_revId =  int(bucketMap[values[index]][revIdIndex])
-                new_revId = int(values[revIdIndex])
-                if prev_revId < new_revId:
-                    bucketMap[values[index]] = value
-            else:
-                bucketMap[values[index]] = value
-        return bucketMap
+        return DataSetIndex(headerInfo, fingerprints, key_index=index).load(dataInCSV)
 
-    def get_local_data_map_using_cbtransfer(self, server, buckets, data_path=None, userId="Administrator", password="password", getReplica=False, mode = "memory"):
+    def get_local_data_map_using_cbtransfer(self, server, buckets, data_path=None, userId="Administrator", password="password", getReplica=False, mode = "memory", loader=None):
         """ Get Local CSV information :: method used when running simple tests only """
         temp_path = "/tmp/"
         replicaOption = ""
@@ -733,7 +884,7 @@ class DataCollector(object):
                 options = " -b " + bucket.name + " -u " + userId + " -p " + password + " " + replicaOption
             suffix = "_" + bucket.name + "_N%2FA.csv"
             if mode == "memory" or mode == "backup":
-               suffix = "_" + bucket.name + "_" + self.ip + "%3A"+server.port+".csv"
+               suffix = "_" + bucket.name + "_" + server.ip + "%3A"+server.port+".csv"
             genFileName = prefix + suffix
             csv_path = temp_path + fileName
             dest_path = temp_path+"/"+genFileName
@@ -747,7 +898,10 @@ class DataCollector(object):
                 headerInfo = ""
                 with open(dest_path) as f:
                     headerInfo = f.readline()
-                    content = f.readlines()
+                    if loader is None:
+                        content = f.readlines()
+                    else:
+                        content = loader(bucket.name, headerInfo, f)
                 bucketMap[bucket.name] = content
                 os.remove(dest_path)
         return headerInfo, bucketMap
@@ -0,0 +1,217 @@
+import copy
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from threading import Lock
+
+from couchbase_helper.documentgenerator import DocumentGenerator
+
+
+MAX_CACHED_INDEXES = 16
+
+_indexes = OrderedDict()
+_indexes_lock = Lock()
+
+
+def emitted_row_index(spec, emit):
+    """Returns the index cached for spec, a hashable description of the
+    rows emit produces (e.g. the map function and whether rows carry a
+    value), or a new empty one. Hold its lock while updating and reading it.
+    """
+    with _indexes_lock:
+        index = _indexes.pop(spec, None)
+        if index is None:
+            index = EmittedRowIndex(emit)
+        _indexes[spec] = index
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start < merged[-1][1]:
+            # overlapping ranges emit the same documents twice
+            return None
+        if merged and start == merged[-1][1]:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _subtract_ranges(ranges, other):
+    """Parts of the sorted, disjoint ranges not covered by other"""
+    result = []
+    for start, end in ranges:
+        for other_start, other_end in other:
+            if other_end <= start or other_start >= end:
+                continue
+            if other_start > start:
+                result.append((start, other_start))
+            start = max(start, other_end)
+            if start >= end:
+                break
+        if start < end:
+            result.append((start, end))
+    return result
+
+
+def _generator_ranges(generators):
+    """Returns {fingerprint: (generator, ranges)} when every generator is an
+    idempotent DocumentGenerator, None otherwise"""
+    grouped = {}
+    for gen in generators:
+        if type(gen) is not DocumentGenerator or gen.name == "random_keys":
+            return None
+        if gen.itr >= gen.end:
+            continue
+        fingerprint = (gen.name, gen.template, repr(gen.args))
+        grouped.setdefault(fingerprint, (gen, []))[1].append((gen.itr, gen.end))
+    wanted = {}
+    for fingerprint, (gen, ranges) in grouped.iteritems():
+        ranges = _merge_ranges(ranges)
+        if ranges is None:
+            return None
+        wanted[fingerprint] = (gen, ranges)
+    return wanted
+
+
+class EmittedRowIndex(object):
+    """Rows a view emits for the documents of a set of generators, sorted in
+    view order (by key, then doc id) so that key ranges, single keys and
+    doc id bounds are found with bisect instead of scanning every row.
+
+    emit(doc_id, doc) returns the row of one document, or None when the map
+    function does not emit it. update() moves the index to another generator
+    set, only emitting the documents of DocumentGenerator ranges that were
+    added and dropping the rows of the ranges that are gone, e.g. after a
+    range was deleted. The rows are shared and must not be modified.
+    """
+
+    def __init__(self, emit):
+        self.emit = emit
+        self.lock = Lock()
+        # (key, id, origin, row), origin is (generator number, doc number)
+        self.entries = []
+        self.keys = []
+        self.key_ids = []
+        self.ranges = {}
+        self.numbers = {}
+        self.aggregates = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _emit_rows(self, gen, number):
+        rows = []
+        seq = gen.itr
+        while gen.has_next():
+            doc_id, doc = gen.next()
+            row = self.emit(doc_id, doc)
+            if row is not None:
+                rows.append((row['key'], doc_id, (number, seq), row))
+            seq += 1
+        return rows
+
+    def _range_rows(self, gen, number, start, end):
+        gen = copy.copy(gen)
+        gen.itr, gen.end = start, end
+        return self._emit_rows(gen, number)
+
+    def _rebuild(self, generators):
+        entries = []
+        for number, gen in enumerate(generators):
+            entries.extend(self._emit_rows(copy.deepcopy(gen), number))
+        entries.sort()
+        self.ranges = {}
+        self.numbers = {}
+        self._set_entries(entries)
+
+    def _set_entries(self, entries):
+        self.entries = entries
+        self.keys = [entry[0] for entry in entries]
+        self.key_ids = [(entry[0], entry[1]) for entry in entries]
+        self.aggregates = {}
+
+    def update(self, generators):
+        """Makes the index hold the rows of generators, each one from its
+        current position to its end like the loaders iterate them"""
+        wanted = _generator_ranges(generators)
+        if wanted is None:
+            self._rebuild(generators)
+            return
+        removed = {}
+        for fingerprint, ranges in self.ranges.iteritems():
+            gone = _subtract_ranges(ranges, wanted.get(fingerprint, (None, []))[1])
+            if gone:
+                removed[self.numbers[fingerprint]] = gone
+        added = []
+        for fingerprint, (gen, ranges) in wanted.iteritems():
+            number = self.numbers.setdefault(fingerprint, len(self.numbers))
+            for start, end in _subtract_ranges(ranges, self.ranges.get(fingerprint, [])):
+                added.extend(self._range_rows(gen, number, start, end))
+        self.ranges = dict((fingerprint, ranges)
+                           for fingerprint, (_, ranges) in wanted.iteritems())
+        if not removed and not added:
+            return
+        entries = self.entries
+        if removed:
+            def kept(entry):
+                gone = removed.get(entry[2][0])
+                if gone is None:
+                    return True
+                seq = entry[2][1]
+                for start, end in gone:
+                    if start <= seq < end:
+                        return False
+                return True
+            entries = [entry for entry in entries if kept(entry)]
+        if added:
+            added.sort()
+            entries = list(heapq.merge(entries, added))
+        self._set_entries(entries)
+
+    def first_key(self):
+        return self.keys[0] if self.keys else None
+
+    def last_key(self):
+        return self.keys[-1] if self.keys else None
+
+    def key_range(self, start_key, end_key, lo=0, hi=None):
+        """Bounds of the rows with start_key <= key <= end_key within lo:hi"""
+        if hi is None:
+            hi = len(self.keys)
+        return max(lo, bisect_left(self.keys, start_key)), \
+            min(hi, bisect_right(self.keys, end_key))
+
+    def before_key(self, key, hi):
+        """Drops the rows with keys >= key from the end of lo:hi"""
+        return min(hi, bisect_left(self.keys, key))
+
+    def from_key_id(self, key, doc_id, lo):
+        """Drops the rows before (key, doc_id) from the start of lo:hi"""
+        return max(lo, bisect_left(self.key_ids, (key, doc_id)))
+
+    def through_key_id(self, key, doc_id, hi):
+        """Drops the rows after (key, doc_id) from the end of lo:hi"""
+        return min(hi, bisect_right(self.key_ids, (key, doc_id)))
+
+    def before_key_id(self, key, doc_id, hi):
+        """Drops the rows from (key, doc_id) on from the end of lo:hi"""
+        return min(hi, bisect_left(self.key_ids, (key, doc_id)))
+
+    def rows(self, lo=0, hi=None, descending=False):
+        entries = self.entries[lo:hi]
+        if descending:
+            entries.reverse()
+        return [entry[3] for entry in entries]
+
+    def aggregate(self, name, lo, hi, descending, reduce_rows):
+        """Result of reduce_rows(rows) over lo:hi, computed once for each
+        name and slice until the index changes"""
+        key = (name, lo, hi, descending)
+        if key not in self.aggregates:
+            self.aggregates[key] = reduce_rows(self.rows(lo, hi, descending))
+        return self.aggregates[key]
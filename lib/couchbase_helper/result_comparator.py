@@ -0,0 +1,160 @@
+from collections import Counter
+from decimal import Decimal
+
+
+def canonical(value, float_digits=6, sort_lists=True):
+    """Returns a hashable form of a query result row or value.
+
+    Numbers compare by value whatever their type (Decimal, long, integral
+    floats), floats are rounded to float_digits decimals, str and unicode
+    compare equal, objects become sorted item tuples and lists become
+    tuples, sorted unless sort_lists is False.
+    """
+    return _canonicalizer(float_digits, sort_lists)(value)
+
+
+def _canonicalizer(float_digits, sort_lists):
+    def convert_float(value):
+        if value.is_integer():
+            return int(value)
+        if float_digits is not None:
+            return round(value, float_digits)
+        return value
+
+    def convert_str(value):
+        # ascii str and unicode already compare equal
+        if value and max(value) > '\x7f':
+            try:
+                return value.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        return value
+
+    def convert_dict(value):
+        return tuple(sorted([(convert(k), convert(v)) for k, v in value.iteritems()]))
+
+    def convert_list(value):
+        items = [convert(v) for v in value]
+        if sort_lists:
+            items.sort()
+        return tuple(items)
+
+    def convert_set(value):
+        return tuple(sorted([convert(v) for v in value]))
+
+    converters = {float: convert_float,
+                  str: convert_str,
+                  long: int,
+                  Decimal: lambda value: convert_float(float(value)),
+                  dict: convert_dict,
+                  list: convert_list,
+                  tuple: convert_list,
+                  set: convert_set}
+
+    def convert(value):
+        converter = converters.get(type(value))
+        if converter is None:
+            return value
+        return converter(value)
+    return convert
+
+
+class ResultComparison(object):
+    """Outcome of compare_results: counts plus bounded samples of the rows
+    that are missing from, extra in, or different in the actual result"""
+
+    def __init__(self, num_actual, num_expected, missing, extra, different,
+                 num_missing, num_extra):
+        self.num_actual = num_actual
+        self.num_expected = num_expected
+        self.missing = missing
+        self.extra = extra
+        self.different = different
+        self.num_missing = num_missing
+        self.num_extra = num_extra
+
+    @property
+    def matches(self):
+        return self.num_missing == 0 and self.num_extra == 0
+
+    def __nonzero__(self):
+        return self.matches
+
+    def __str__(self):
+        if self.matches:
+            return "results match :: {0} rows".format(self.num_actual)
+        msg = "results mismatch :: actual {0} rows, expected {1} rows, {2} missing, {3} extra" \
+            .format(self.num_actual, self.num_expected, self.num_missing, self.num_extra)
+        if self.different:
+            msg += "\n different (expected, actual) :: {0}".format(self.different)
+        if self.missing:
+            msg += "\n missing :: {0}".format(self.missing)
+        if self.extra:
+            msg += "\n extra :: {0}".format(self.extra)
+        return msg
+
+
+def _count(rows, convert):
+    counts = Counter()
+    originals = {}
+    for row in rows:
+        key = convert(row)
+        counts[key] += 1
+        if key not in originals:
+            originals[key] = row
+    return counts, originals
+
+
+def _expand(counts, originals, limit=None):
+    rows = []
+    for key, count in counts.iteritems():
+        for _ in xrange(count):
+            if limit is not None and len(rows) >= limit:
+                return rows
+            rows.append(originals[key])
+    return rows
+
+
+def compare_results(actual, expected, key=None, max_samples=10, float_digits=6,
+                    sort_lists=True):
+    """Compares two query results as multisets of rows in linear time.
+
+    key -- optional field identifying a row, missing and extra rows with the
+           same value for it are reported as different instead
+    max_samples -- maximum number of rows kept for each kind of difference,
+                   None keeps all of them
+    """
+    actual = actual or []
+    expected = expected or []
+    convert = _canonicalizer(float_digits, sort_lists)
+    actual_counts, actual_rows = _count(actual, convert)
+    expected_counts, expected_rows = _count(expected, convert)
+    missing = expected_counts - actual_counts
+    extra = actual_counts - expected_counts
+    different = []
+    if key is not None and missing and extra:
+        extra_by_key = {}
+        for row_key in extra:
+            row = actual_rows[row_key]
+            if isinstance(row, dict) and key in row:
+                extra_by_key.setdefault(convert(row[key]), row)
+        for row_key in missing:
+            row = expected_rows[row_key]
+            if isinstance(row, dict) and key in row:
+                match = extra_by_key.get(convert(row[key]))
+                if match is not None:
+                    different.append((row, match))
+                    if max_samples is not None and len(different) >= max_samples:
+                        break
+    return ResultComparison(len(actual), len(expected),
+                            _expand(missing, expected_rows, max_samples),
+                            _expand(extra, actual_rows, max_samples),
+                            different,
+                            sum(missing.itervalues()), sum(extra.itervalues()))
+
+
+def check_missing_and_extra(actual, expected):
+    """Returns the rows missing from actual and the extra rows in it"""
+    comparison = compare_results(actual, expected, max_samples=None, float_digits=None,
+                                 sort_lists=False)
+    return comparison.missing, comparison.extra
@@ -1,6 +1,8 @@
 import copy
 from documentgenerator import  DocumentGenerator
 import re
+import ast
+import bisect
 import datetime
 import json
 import random, string
@@ -11,11 +13,43 @@ from data import COUNTRIES, COUNTRY_CODE, FIRST_NAMES, LAST_NAMES
 
 log = logger.Logger.get_logger()
 
+# full sets smaller than this are always scanned
+INDEX_MIN_DOCS = 1000
+INDEXED_CONDITION = re.compile(r'^doc\["(\w+)"\]\s*(==|>=|<=|>|<)\s*(.+)$')
+
+
+class FieldIndex(object):
+    """Positions of the documents of a full set by the value of one top level
+    field, used to narrow equality and range WHERE conditions"""
+
+    def __init__(self, values):
+        self.by_value = {}
+        for pos, value in enumerate(values):
+            self.by_value.setdefault(value, []).append(pos)
+        self.order = sorted(xrange(len(values)), key=values.__getitem__)
+        self.sorted_values = [values[pos] for pos in self.order]
+
+    def lookup(self, op, value):
+        if op == '==':
+            return self.by_value.get(value, [])
+        if op == '>':
+            return self.order[bisect.bisect_right(self.sorted_values, value):]
+        if op == '>=':
+            return self.order[bisect.bisect_left(self.sorted_values, value):]
+        if op == '<':
+            return self.order[:bisect.bisect_left(self.sorted_values, value)]
+        if op == '<=':
+            return self.order[:bisect.bisect_right(self.sorted_values, value)]
+
+
 class TuqGenerators(object):
 
-    def __init__(self, log, full_set):
+    def __init__(self, log, full_set, use_index=True):
         self.log = log
         self.full_set = full_set
+        self.use_index = use_index
+        self.indexes = {}
+        self.compiled = {}
         self.query = None
         self.type_args = {}
         self.nests = self._all_nested_objects(full_set[0])
@@ -324,35 +358,136 @@ class TuqGenerators(object):
                         else:
                             select_clause = select_clause + '"%s" : %s,' %([at.replace('"','') for at in re.compile('"\w+"').findall(attr)][0], attr)
                     select_clause = select_clause + '}'
+        select = self._compile(select_clause)
         if where_clause:
-            result = [eval(select_clause) for doc in self.full_set if eval(where_clause)]
+            where = self._compile(where_clause)
+            result = [select(doc) for doc in self._candidates(where_clause) if where(doc)]
         else:
-            result = [eval(select_clause) for doc in self.full_set]
+            result = map(select, self.full_set)
         if self.distinct:
-            result = [dict(y) for y in set(tuple(x.items()) for x in result)]
+            result = self._distinct(result)
         if unnest_clause:
             unnest_attr = unnest_clause[5:-2]
+            unnest = self._compile(unnest_clause)
             if unnest_attr in self.aliases:
+                # the unnested documents share everything but their own top
+                # level dict with the source document
                 def res_generator():
                     for doc in result:
-                        doc_temp = copy.deepcopy(doc)
+                        doc_temp = dict(doc)
                         del doc_temp[unnest_attr]
-                        for item in eval(unnest_clause):
-                            doc_to_append = copy.deepcopy(doc_temp)
-                            doc_to_append[unnest_attr] = copy.deepcopy(item)
+                        for item in unnest(doc):
+                            doc_to_append = dict(doc_temp)
+                            doc_to_append[unnest_attr] = item
                             yield doc_to_append
                 result = list(res_generator())
             else:
-                result = [item for doc in result for item in eval(unnest_clause)]
-        if self._create_groups()[0]:
+                result = [item for doc in result for item in unnest(doc)]
+        grouped = self._create_groups()[0]
+        if grouped:
             result = self._group_results(result)
         if self.aggr_fns:
-            if not self._create_groups()[0] or len(result) == 0:
+            if not grouped or len(result) == 0:
                 for fn_name, params in self.aggr_fns.iteritems():
                     if fn_name == 'COUNT':
                         result = [{params['alias'] : len(result)}]
         return result
 
+    def _compile(self, expression):
+        """Returns the clause expression compiled once into a function of doc"""
+        func = self.compiled.get(expression)
+        if func is None:
+            func = eval('lambda doc: (%s)' % expression, globals())
+            self.compiled[expression] = func
+        return func
+
+    def _distinct(self, result):
+        seen = set()
+        distinct = []
+        for doc in result:
+            key = self._hashable(doc)
+            if key not in seen:
+                seen.add(key)
+                distinct.append(doc)
+        return distinct
+
+    def _hashable(self, value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, self._hashable(v)) for k, v in value.iteritems()))
+        if isinstance(value, list):
+            return tuple([self._hashable(v) for v in value])
+        return value
+
+    def _candidates(self, where_clause):
+        """Documents of the full set that can match the where clause: if one
+        of its top level AND conditions compares a field with a literal, only
+        the documents the field index selects for it"""
+        if not self.use_index or len(self.full_set) < INDEX_MIN_DOCS:
+            return self.full_set
+        best = None
+        for condition in self._split_conditions(where_clause) or []:
+            match = INDEXED_CONDITION.match(condition)
+            if not match:
+                continue
+            field, op, literal = match.groups()
+            try:
+                value = ast.literal_eval(literal.strip())
+            except (ValueError, SyntaxError):
+                continue
+            index = self._get_index(field)
+            if index is None or isinstance(value, (dict, list)):
+                continue
+            positions = index.lookup(op, value)
+            if best is None or len(positions) < len(best):
+                best = positions
+        if best is None:
+            return self.full_set
+        return [self.full_set[pos] for pos in sorted(best)]
+
+    def _split_conditions(self, clause):
+        """Splits a python where clause on its top level 'and's, returns None
+        if it has a top level 'or' or conditional expression"""
+        conditions = []
+        depth = 0
+        quote = None
+        start = 0
+        i = 0
+        while i < len(clause):
+            char = clause[i]
+            if quote:
+                if char == '\\':
+                    i += 1
+                elif char == quote:
+                    quote = None
+            elif char in '"\'':
+                quote = char
+            elif char in '([{':
+                depth += 1
+            elif char in ')]}':
+                depth -= 1
+            elif depth == 0 and char == ' ':
+                word = re.match(r' (and|or|if|lambda) ', clause[i:])
+                if word and word.group(1) != 'and':
+                    return None
+                if word:
+                    conditions.append(clause[start:i].strip())
+                    start = i + len(word.group(0)) - 1
+            i += 1
+        conditions.append(clause[start:].strip())
+        return conditions
+
+    def _get_index(self, field):
+        if field not in self.indexes:
+            index = None
+            try:
+                values = [doc[field] for doc in self.full_set]
+                if not [value for value in values if isinstance(value, (dict, list))]:
+                    index = FieldIndex(values)
+            except (KeyError, TypeError):
+                pass
+            self.indexes[field] = index
+        return self.indexes[field]
+
     def _order_clause_greater_than_select(self, select_clause):
         order_clause = self._get_order_clause()
         if not order_clause:
@@ -439,7 +574,10 @@ class TuqGenerators(object):
                                                          if params['field'] == att_name[1:-1]][0])
             if order_clause.find(',"') != -1:
                 order_clause = order_clause.replace(',"', '"')
-            key = lambda doc: eval(order_clause)
+            try:
+                key = self._compile(order_clause)
+            except SyntaxError:
+                return result
         try:
             result = sorted(result, key=key, reverse=reverse)
         except:
@@ -512,7 +650,7 @@ class TuqGenerators(object):
                                 if doc[attrs[0]]==group])}
                           for group in groups]
         else:
-            result = [dict(y) for y in set(tuple(x.items()) for x in result)]
+            result = self._distinct(result)
         return result
 
     def get_alias_for(self, value_search):
@@ -10,6 +10,7 @@ import datetime
 import time
 from datetime import date
 from couchbase_helper.tuq_generators import TuqGenerators
+from couchbase_helper.result_comparator import check_missing_and_extra, compare_results
 from remote.remote_util import RemoteMachineShellConnection
 from membase.api.exception import CBQError, ReadDocumentException
 from membase.api.rest_client import RestConnection
@@ -131,16 +132,16 @@ class N1QLHelper():
             actual_result = []
         if check:
             actual_result = self._gen_dict(n1ql_result)
-
-        actual_result = sorted(actual_result)
-        expected_result = sorted(sql_result)
+        expected_result = sql_result
 
         if len(actual_result) != len(expected_result):
-            extra_msg = self._get_failure_message(expected_result, actual_result)
-            raise Exception("Results are incorrect. Actual num %s. Expected num: %s. :: %s \n" % (len(actual_result), len(expected_result), extra_msg))
+            comparison = compare_results(actual_result, expected_result, key="primary_key_id")
+            raise Exception("Results are incorrect. Actual num %s. Expected num: %s. :: %s \n" % (len(actual_result), len(expected_result), comparison))
 
         msg = "The number of rows match but the results mismatch, please check"
         if subquery:
+            actual_result = sorted(actual_result)
+            expected_result = sorted(expected_result)
             for x, y in zip(actual_result, expected_result):
                 if aggregate:
                     productId = x['ABC'][0]['$1']
@@ -159,9 +160,11 @@ class N1QLHelper():
                     extra_msg = self._get_failure_message(expected_result, actual_result)
                     raise Exception(msg+"\n "+extra_msg)
         else:
-            if self._sort_data(actual_result) != self._sort_data(expected_result):
-                extra_msg = self._get_failure_message(expected_result, actual_result)
-                raise Exception(msg+"\n "+extra_msg)
+            # mysql_client rounds floats and decimals to integers, compare the
+            # n1ql ones the same way like _gen_dict_n1ql_func_result does
+            comparison = compare_results(actual_result, expected_result, key="primary_key_id", float_digits=0)
+            if not comparison.matches:
+                raise Exception(msg+"\n "+str(comparison))
 
     def _sort_data(self, result):
         new_data = []
@@ -299,15 +302,7 @@ class N1QLHelper():
             self.log.info(" example key {0}".format(different_values[0]))
 
     def check_missing_and_extra(self, actual, expected):
-        missing = []
-        extra = []
-        for item in actual:
-            if not (item in expected):
-                extra.append(item)
-        for item in expected:
-            if not (item in actual):
-                missing.append(item)
-        return missing, extra
+        return check_missing_and_extra(actual, expected)
 
     def build_url(self, version):
         info = self.shell.extract_remote_info()
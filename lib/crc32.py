@@ -4,6 +4,11 @@
 # * src/usr.bin/cksum/crc32.c.
 # */
 
+import os
+import sys
+import time
+import zlib
+
 
 crc32tab = [
   0x00000000, 0x77073096, 0xee0e612c, 0x990951ba,
@@ -72,8 +77,51 @@ crc32tab = [
   0xb40bbe37, 0xc30c8ea1, 0x5a05df1b, 0x2d02ef8d]
 
 
-def crc32_hash(key):
+def _crc32_hash_py(key):
     crc = pow(2, 32) - 1
     for ch in key:
         crc = (crc >> 8) ^ crc32tab[int((crc ^ ord(ch)) & 0xff)]
     return ((~crc) >> 16) & 0x7fff
+
+
+# crc32tab is the standard reflected CRC-32 table, so bits 16-30 of
+# zlib.crc32() are exactly the 15 bit hash computed by _crc32_hash_py().
+# The table loop is only kept for unicode values zlib can't encode.
+def crc32_hash(key):
+    try:
+        return (zlib.crc32(key) >> 16) & 0x7fff
+    except UnicodeEncodeError:
+        return _crc32_hash_py(key)
+
+
+def crc32_hash_batch(values):
+    """Returns the list of crc32_hash() results for an iterable of values"""
+    crc = zlib.crc32
+    hashes = []
+    append = hashes.append
+    for value in values:
+        try:
+            append((crc(value) >> 16) & 0x7fff)
+        except UnicodeEncodeError:
+            append(_crc32_hash_py(value))
+    return hashes
+
+
+def benchmark(count=10000, size=1024):
+    """Checks crc32_hash_batch() against the pure python hash on random
+    values and prints the time taken by both"""
+    values = [os.urandom(size) for _ in xrange(count)]
+    start = time.time()
+    expected = [_crc32_hash_py(value) for value in values]
+    py_time = time.time() - start
+    start = time.time()
+    hashes = crc32_hash_batch(values)
+    batch_time = time.time() - start
+    if hashes != expected:
+        raise AssertionError("crc32_hash_batch is not compatible with the pure python hash")
+    print "hashed {0} values of {1} bytes: python {2:.3f}s, batch {3:.3f}s ({4:.0f}x)".format(
+        count, size, py_time, batch_time, py_time / max(batch_time, 1e-9))
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
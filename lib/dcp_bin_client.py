@@ -5,6 +5,14 @@ import Queue
 import time
 
 MAX_SEQNO = 0xFFFFFFFFFFFFFFFF
+DEFAULT_BUFFER_SIZE = 10 * 1024 * 1024
+
+# messages the producer counts against the flow control buffer
+FLOW_CONTROLLED_OPCODES = (constants.CMD_STREAM_END,
+                           constants.CMD_SNAPSHOT_MARKER,
+                           constants.CMD_MUTATION,
+                           constants.CMD_DELETION,
+                           constants.CMD_EXPIRATION)
 
 
 class DcpClient(MemcachedClient):
@@ -25,6 +33,13 @@ class DcpClient(MemcachedClient):
 
         self.dead = False
 
+        # flow control buffer size, 0 when flow control is off
+        self.buffer_size = 0
+        # bytes received but not yet acked, acks are sent after
+        # ack_ratio * buffer_size bytes
+        self.unacked_bytes = 0
+        self.ack_ratio = 0.5
+
     def _open(self, op):
         return self._handle_op(op)
 
@@ -61,7 +76,11 @@ class DcpClient(MemcachedClient):
             while streaming mutations"""
 
         op = FlowControl(buffer_size)
-        return self._handle_op(op)
+        response = self._handle_op(op)
+        if response and response['status'] == 0:
+            self.buffer_size = buffer_size
+            self.unacked_bytes = 0
+        return response
 
     def ack(self, nbytes):
         """ sent to notify producer number of bytes client has received"""
@@ -69,6 +88,18 @@ class DcpClient(MemcachedClient):
         op = Ack(nbytes)
         return self._handle_op(op, 1)
 
+    def buffer_ack(self, opcode, body):
+        """ accounts a received message against the flow control buffer and
+            acks the consumed bytes once enough of the buffer is used.
+            the ack gets no response, so it is only sent """
+
+        if not self.buffer_size or opcode not in FLOW_CONTROLLED_OPCODES:
+            return
+        self.unacked_bytes += constants.MIN_RECV_PACKET + len(body)
+        if self.unacked_bytes >= self.buffer_size * self.ack_ratio:
+            self.send_op(Ack(self.unacked_bytes))
+            self.unacked_bytes = 0
+
     def quit(self):
         """ send quit command to mc - when response is recieved quit reader """
         op = Quit()
@@ -179,6 +210,7 @@ class DcpClient(MemcachedClient):
 
                 opcode, status, opaque, cas, keylen, extlen, body = \
                     self._recvMsg()
+                self.buffer_ack(opcode, body)
 
                 if opaque == op.opaque:
                     response = op.formated_response(opcode, keylen,
@@ -195,8 +227,9 @@ class DcpClient(MemcachedClient):
                     # save for later
                     cached_op.queue.put(response)
 
-                elif opcode == constants.CMD_FLOW_CONTROL:
-                    # TODO: handle
+                elif opcode in (constants.CMD_FLOW_CONTROL,
+                                constants.CMD_UPR_ACK):
+                    # responses to control messages nobody is waiting for
                     continue
 
                 elif opcode == constants.CMD_STREAM_REQ:
@@ -268,9 +301,8 @@ class DcpStream(object):
     def has_response(self):
         return not self._ended
 
-    def run(self, to_seqno=MAX_SEQNO, retries=10):
-
-        responses = []
+    def responses(self, to_seqno=MAX_SEQNO, retries=10):
+        """ yields responses until the stream ends or reaches to_seqno """
 
         try:
             while self.has_response():
@@ -283,7 +315,7 @@ class DcpStream(object):
                         "ERROR: vbucket (%s) stream stopped receiving " \
                         "mutations " % self.vbucket
                     continue
-                responses.append(r)
+                yield r
 
                 if 'status' in r and r['status'] == 0xff:
                     break
@@ -295,7 +327,148 @@ class DcpStream(object):
             self._ended = True
             del self.__generator
 
-        return responses
+    def run(self, to_seqno=MAX_SEQNO, retries=10, callback=None):
+        """ returns the list of responses, or passes each one to callback
+            and returns None so that nothing is kept in memory """
+
+        if callback is None:
+            return list(self.responses(to_seqno, retries))
+        for r in self.responses(to_seqno, retries):
+            callback(r)
+
+
+class VBucketStream(object):
+    """ state of one vbucket stream opened by DcpConsumer """
+
+    def __init__(self, op, callback=None):
+        self.op = op
+        self.vbucket = op.vbucket
+        self.callback = callback
+        self.status = None
+        self.failover_log = None
+        self.err_msg = None
+        self.rollback = None
+        self.rollback_seqno = None
+        self.last_by_seqno = 0
+        self.snap_start = None
+        self.snap_end = None
+        self.mutations = 0
+        self.deletions = 0
+        self.ended = False
+
+    def update(self, response):
+        opcode = response['opcode']
+        if opcode == constants.CMD_STREAM_REQ:
+            self.status = response['status']
+            self.failover_log = response.get('failover_log')
+            self.err_msg = response.get('err_msg')
+            self.rollback = response.get('rollback')
+            self.rollback_seqno = response.get('seqno')
+            # a rejected stream request ends the stream
+            self.ended = self.status != 0
+        elif opcode in (constants.CMD_MUTATION, constants.CMD_DELETION):
+            assert response['by_seqno'] > self.last_by_seqno, \
+                "ERROR: Out of order response on vbucket %s: %s" \
+                % (self.vbucket, response)
+            self.last_by_seqno = response['by_seqno']
+            if opcode == constants.CMD_MUTATION:
+                self.mutations += 1
+            else:
+                self.deletions += 1
+        elif opcode == constants.CMD_SNAPSHOT_MARKER:
+            self.snap_start = response['snap_start_seqno']
+            self.snap_end = response['snap_end_seqno']
+        elif opcode == constants.CMD_STREAM_END:
+            self.ended = True
+
+
+class DcpConsumer(object):
+    """ streams many vbuckets over one DcpClient connection.
+
+        stream requests are all sent up front and every message received
+        is routed by opaque to its VBucketStream, then handed to that
+        stream's callback or yielded from responses(). nothing is
+        buffered, and with flow control on the producer never has more
+        than buffer_size bytes in flight, so memory stays bounded no
+        matter how many items are streamed """
+
+    def __init__(self, client, buffer_size=DEFAULT_BUFFER_SIZE, ack_ratio=0.5):
+        self.client = client
+        self.buffer_size = buffer_size
+        self.client.ack_ratio = ack_ratio
+        # key = opaque, val = VBucketStream
+        self.streams = {}
+
+    def open(self, name):
+        """ opens the producer connection and turns on flow control """
+
+        response = self.client.open_producer(name)
+        if response['status'] == 0 and self.buffer_size:
+            response = self.client.flow_control(self.buffer_size)
+        return response
+
+    def add_stream(self, vbucket, start_seqno=0, end_seqno=MAX_SEQNO,
+                   vb_uuid=0, snap_start=None, snap_end=None,
+                   callback=None, takeover=0):
+        """ sends a stream request without waiting for the response,
+            callback(response) is called for every message of the stream """
+
+        op = StreamRequest(vbucket, takeover, start_seqno, end_seqno,
+                           vb_uuid, snap_start, snap_end)
+        while op.opaque in self.streams:
+            op.opaque = random.Random().randint(0, 2 ** 32)
+        stream = VBucketStream(op, callback)
+        self.streams[op.opaque] = stream
+        self.client.send_op(op)
+        return stream
+
+    def get_stream(self, vbucket):
+        for stream in self.streams.itervalues():
+            if stream.vbucket == vbucket:
+                return stream
+
+    def active(self):
+        return [stream for stream in self.streams.itervalues()
+                if not stream.ended]
+
+    def responses(self, timeout=30):
+        """ yields (stream, response) until every stream has ended.
+            raises EOFError if nothing arrives for timeout seconds """
+
+        idle = 0
+        active = len(self.active())
+        while active:
+            try:
+                opcode, status, opaque, cas, keylen, extlen, body = \
+                    self.client._recvMsg()
+            except EOFError as ex:
+                if 'died' in str(ex):
+                    raise
+                idle += self.client.timeout
+                if idle >= timeout:
+                    raise EOFError("No dcp messages for %s sec, %s streams "
+                                   "still open" % (idle, active))
+                continue
+            idle = 0
+            self.client.buffer_ack(opcode, body)
+            stream = self.streams.get(opaque)
+            if stream is None:
+                continue
+            response = stream.op.formated_response(opcode, keylen, extlen,
+                                                   status, cas, body, opaque)
+            was_ended = stream.ended
+            stream.update(response)
+            if stream.ended and not was_ended:
+                active -= 1
+            yield stream, response
+
+    def run(self, timeout=30):
+        """ drains all streams into their callbacks, returns the streams """
+
+        for stream, response in self.responses(timeout):
+            if stream.callback:
+                stream.callback(response)
+        return self.streams.values()
 
 
 class Operation(object):
@@ -8,6 +8,7 @@ from TestInput import TestInputServer
 import mc_bin_client
 from membase.api.rest_client import RestConnection
 from memcached.helper.data_helper import VBucketAwareMemcached
+from perf_engines.pacing import LatencyHistogram, Pacer
 
 
 class FakeMemcachedClient(object):
@@ -72,6 +73,12 @@ class LoadThread(threading.Thread):
                 self.valuesize_sequence.append(op)
 
         self.max_operation_rate = int(load_info['operation_info'].get('operation_rate', 0) / threads)
+        # operations run on an open loop schedule at max_operation_rate,
+        # their latency is measured from the time they were due
+        self.pacer = None
+        if self.max_operation_rate:
+            self.pacer = Pacer(self.max_operation_rate)
+        self.latency = {'set': LatencyHistogram(), 'get': LatencyHistogram()}
 
         self.uuid = uuid.uuid4()
         self.name = str(self.uuid) + self.name
@@ -103,10 +110,14 @@ class LoadThread(threading.Thread):
     def run(self):
         while True:
             # handle pause/stop
-            while self.paused:
-                if self.stopped:
-                    return
-                time.sleep(1)
+            if self.paused:
+                while self.paused:
+                    if self.stopped:
+                        return
+                    time.sleep(1)
+                # the operations missed while paused are not caught up with
+                if self.pacer:
+                    self.pacer.reset()
             if self.stopped:
                 return
 
@@ -126,9 +137,11 @@ class LoadThread(threading.Thread):
                 self.log.info("size limit reached")
                 return
 
-            # rate limit if we need to
-            if self.max_operation_rate and self.operation_rate > self.max_operation_rate:
-                time.sleep(1.0/float(self.max_operation_rate))
+            # wait until the next operation is due
+            if self.pacer:
+                intended_start = self.pacer.acquire()
+            else:
+                intended_start = time.time()
 
             # do the actual work
             operation = self.get_operation()
@@ -137,6 +150,7 @@ class LoadThread(threading.Thread):
                 try:
 #                    print `self.mutation_index` + " : " + `self.get_mutation_key()`
                     self.poxi.memcached(key).set(key, 0, 0, self.get_data())
+                    self.latency['set'].record(time.time() - intended_start)
                     self.operations += 1
                     self.backoff -= 1
 
@@ -177,6 +191,7 @@ class LoadThread(threading.Thread):
                 key = self.name + '_' + `self.get_get_key()`
                 try:
                     vdata = self.poxi.memcached(key).get(key)
+                    self.latency['get'].record(time.time() - intended_start)
                     self.operations += 1
                     self.backoff -= 1
                     data = vdata[2]
@@ -286,6 +301,8 @@ class LoadRunner(object):
             t = LoadThread(load_info, i % self.num_servers)
             t.start()
             self.threads.append(t)
+        # kept once the threads are done
+        self.latencies = [t.latency for t in self.threads]
 
     # start running load against server
     # this is run in a seperate thread(s)
@@ -341,6 +358,23 @@ class LoadRunner(object):
             'state':state,
         }
 
+    # latency histograms of every operation (set, get) merged over the threads,
+    # measured from the time the operations were due at the configured rate
+    def latency(self):
+        latency = {}
+        for thread_latency in self.latencies:
+            for op, histo in thread_latency.iteritems():
+                latency.setdefault(op, LatencyHistogram()).merge(histo)
+        return latency
+
+    # same as latency() for the operations done since the previous call
+    def latency_interval(self):
+        latency = {}
+        for thread_latency in self.latencies:
+            for op, histo in thread_latency.iteritems():
+                latency.setdefault(op, LatencyHistogram()).merge(histo.interval())
+        return latency
+
     # block till condition
     def wait(self, time_limit=None):
         if time_limit == None:
@@ -11,6 +11,7 @@ import select
 import random
 import struct
 import exceptions
+import errno
 import zlib
 
 from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE
@@ -889,6 +890,288 @@ class MemcachedClient(object):
         self._set_vbucket(key, vbucket)
         return self._doSdCmd(memcacheConstants.CMD_SUBDOC_MULTI_LOOKUP, key, path, expiry, opaque, cas, create)
 
+    def pipeline(self, window=1024, batch_bytes=64 * 1024):
+        """Returns a MemcachedPipeline sharing this client's connection.
+
+        While the pipeline has requests in flight the connection must not be
+        used for synchronous commands."""
+        return MemcachedPipeline(self, window=window, batch_bytes=batch_bytes)
+
+
+class MemcachedFuture(object):
+    """Result of a request submitted through a MemcachedPipeline."""
+
+    def __init__(self, pipeline, transform=None):
+        self._pipeline = pipeline
+        self._transform = transform
+        self._done = False
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """Waits for the response and returns what the equivalent
+        MemcachedClient call would have returned, or raises its error."""
+        if not self._done:
+            self._pipeline.wait(self)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            self._pipeline.wait(self)
+        return self._exception
+
+    def _set_response(self, opaque, cas, data):
+        try:
+            if self._transform:
+                self._result = self._transform(opaque, cas, data)
+            else:
+                self._result = (opaque, cas, data)
+        except Exception, e:
+            self._exception = e
+        self._done = True
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._done = True
+
+
+class MemcachedPipeline(object):
+    """Pipelined request engine over a MemcachedClient connection.
+
+    Requests are packed as they are submitted and coalesced into large
+    writes; responses are parsed out of a reusable receive buffer and matched
+    back to their MemcachedFuture by opaque. At most `window` requests are
+    kept in flight, pending requests are written once `batch_bytes` have
+    accumulated, the window is full, or a result is waited on.
+
+        with client.pipeline(window=512) as p:
+            futures = [p.set(key, 0, 0, value) for key, value in items]
+        failed = [f for f in futures if f.exception()]
+    """
+
+    def __init__(self, client, window=1024, batch_bytes=64 * 1024):
+        self.client = client
+        self.window = max(1, window)
+        self.batch_bytes = batch_bytes
+        self._opaque = 0
+        self._inflight = {}
+        self._pending = []
+        self._pending_bytes = 0
+        self._wbuf = ''
+        self._woffset = 0
+        self._rbuf = bytearray(256 * 1024)
+        self._rview = memoryview(self._rbuf)
+        self._rstart = 0
+        self._rend = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.wait_all()
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def submit(self, cmd, key, val='', extraHeader='', cas=0, vbucket=-1, transform=None):
+        """Queues a request and returns its MemcachedFuture. Without a
+        transform the result is (opaque, cas, data) like _doCmd."""
+        if len(self._inflight) >= self.window:
+            self._io(lambda: len(self._inflight) < self.window)
+        if vbucket < 0:
+            vbucket = (((zlib.crc32(key)) >> 16) & 0x7fff) & (self.client.vbucket_count - 1)
+        self._opaque = (self._opaque + 1) & 0xffffffff
+        opaque = self._opaque
+        msg = struct.pack(REQ_PKT_FMT, REQ_MAGIC_BYTE, cmd, len(key), len(extraHeader), 0, vbucket,
+                          len(key) + len(extraHeader) + len(val), opaque, cas)
+        self._pending.append(msg)
+        self._pending.append(extraHeader)
+        self._pending.append(key)
+        self._pending.append(val)
+        self._pending_bytes += len(msg) + len(extraHeader) + len(key) + len(val)
+        future = MemcachedFuture(self, transform)
+        future.vbucket = vbucket
+        self._inflight[opaque] = future
+        if self._pending_bytes >= self.batch_bytes or len(self._inflight) >= self.window:
+            self.flush()
+        return future
+
+    def flush(self):
+        """Writes all queued requests without waiting for their responses."""
+        self._io(lambda: not self._pending and self._woffset >= len(self._wbuf))
+
+    def wait(self, future):
+        self._io(future.done)
+
+    def wait_all(self):
+        """Waits until every submitted request has been answered."""
+        self._io(lambda: not self._inflight)
+
+    def _io(self, until):
+        sock = self.client.s
+        timeout = self.client.timeout
+        sock.setblocking(0)
+        try:
+            while not until():
+                if self._woffset >= len(self._wbuf) and self._pending:
+                    self._wbuf = ''.join(self._pending)
+                    self._woffset = 0
+                    self._pending = []
+                    self._pending_bytes = 0
+                wlist = [sock] if self._woffset < len(self._wbuf) else []
+                rlist = [sock] if self._inflight else []
+                if not wlist and not rlist:
+                    break
+                r, w, _ = select.select(rlist, wlist, [], timeout)
+                if not r and not w:
+                    raise exceptions.EOFError("Timeout waiting for socket io. from {0}".format(self.client.host))
+                if w:
+                    try:
+                        self._woffset += sock.send(buffer(self._wbuf, self._woffset))
+                    except socket.error, e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            raise
+                if r:
+                    self._recv(sock)
+        finally:
+            sock.setblocking(1)
+
+    def _recv(self, sock):
+        if self._rend == len(self._rbuf):
+            self._compact(MIN_RECV_PACKET)
+        try:
+            n = sock.recv_into(self._rview[self._rend:])
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if n == 0:
+            raise exceptions.EOFError("Got empty data (remote died?). from {0}".format(self.client.host))
+        self._rend += n
+        self._parse()
+
+    def _compact(self, needed):
+        avail = self._rend - self._rstart
+        if needed > len(self._rbuf):
+            self._rbuf = self._rbuf[self._rstart:self._rend] + bytearray(max(needed, 2 * len(self._rbuf)) - avail)
+            self._rview = memoryview(self._rbuf)
+        elif self._rstart:
+            self._rbuf[0:avail] = self._rview[self._rstart:self._rend]
+        self._rstart = 0
+        self._rend = avail
+
+    def _parse(self):
+        while self._rend - self._rstart >= MIN_RECV_PACKET:
+            magic, cmd, keylen, extralen, dtype, errcode, remaining, opaque, cas = \
+                struct.unpack_from(RES_PKT_FMT, self._rbuf, self._rstart)
+            assert (magic in (RES_MAGIC_BYTE, REQ_MAGIC_BYTE)), "Got magic: %d" % magic
+            total = MIN_RECV_PACKET + remaining
+            if self._rend - self._rstart < total:
+                if self._rstart + total > len(self._rbuf):
+                    self._compact(total)
+                return
+            body_start = self._rstart + MIN_RECV_PACKET
+            data = self._rview[body_start:body_start + remaining].tobytes()
+            self._rstart += total
+            future = self._inflight.pop(opaque, None)
+            if future is None:
+                continue
+            if errcode:
+                data += " for vbucket :{0} to mc {1}:{2}".format(future.vbucket, self.client.host, self.client.port)
+                future._set_exception(MemcachedError(errcode, data))
+            else:
+                future._set_response(opaque, cas, data)
+        if self._rstart == self._rend:
+            self._rstart = self._rend = 0
+
+    @staticmethod
+    def _parse_get(opaque, cas, data):
+        return struct.unpack(memcacheConstants.GET_RES_FMT, data[:4])[0], cas, data[4:]
+
+    def get(self, key, vbucket=-1):
+        return self.submit(memcacheConstants.CMD_GET, key, vbucket=vbucket, transform=self._parse_get)
+
+    def getr(self, key, vbucket=-1):
+        return self.submit(memcacheConstants.CMD_GET_REPLICA, key, vbucket=vbucket,
+                           transform=lambda opaque, cas, data: (struct.unpack(memcacheConstants.GET_RES_FMT, data[:4])[0],
+                                                                cas, data[4 + len(key):]))
+
+    def _mutate(self, cmd, key, exp, flags, cas, val, vbucket):
+        return self.submit(cmd, key, val, struct.pack(SET_PKT_FMT, flags, exp), cas, vbucket)
+
+    def set(self, key, exp, flags, val, vbucket=-1):
+        return self._mutate(memcacheConstants.CMD_SET, key, exp, flags, 0, val, vbucket)
+
+    def add(self, key, exp, flags, val, vbucket=-1):
+        return self._mutate(memcacheConstants.CMD_ADD, key, exp, flags, 0, val, vbucket)
+
+    def replace(self, key, exp, flags, val, vbucket=-1):
+        return self._mutate(memcacheConstants.CMD_REPLACE, key, exp, flags, 0, val, vbucket)
+
+    def cas(self, key, exp, flags, oldVal, val, vbucket=-1):
+        return self._mutate(memcacheConstants.CMD_SET, key, exp, flags, oldVal, val, vbucket)
+
+    def append(self, key, value, cas=0, vbucket=-1):
+        return self.submit(memcacheConstants.CMD_APPEND, key, value, '', cas, vbucket)
+
+    def prepend(self, key, value, cas=0, vbucket=-1):
+        return self.submit(memcacheConstants.CMD_PREPEND, key, value, '', cas, vbucket)
+
+    def delete(self, key, cas=0, vbucket=-1):
+        return self.submit(memcacheConstants.CMD_DELETE, key, '', '', cas, vbucket)
+
+    def touch(self, key, exp, vbucket=-1):
+        return self.submit(memcacheConstants.CMD_TOUCH, key, '', struct.pack(TOUCH_PKT_FMT, exp),
+                           vbucket=vbucket)
+
+    def getMeta(self, key, vbucket=-1):
+        return self.submit(memcacheConstants.CMD_GET_META, key, vbucket=vbucket,
+                           transform=lambda opaque, cas, data: struct.unpack('>IIIQ', data[0:20]) + (cas,))
+
+    def _doSdCmd(self, cmd, key, path, val=None, cas=0, create=False, vbucket=-1):
+        createFlag = SUBDOC_FLAGS_MKDIR_P if create else 0
+        body = path
+        if val != None:
+            body += str(val)
+        return self.submit(cmd, key, body, struct.pack(REQ_PKT_SD_EXTRAS, len(path), createFlag), cas, vbucket)
+
+    def get_sd(self, key, path, cas=0, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_GET, key, path, cas=cas, vbucket=vbucket)
+
+    def exists_sd(self, key, path, cas=0, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_EXISTS, key, path, cas=cas, vbucket=vbucket)
+
+    def dict_add_sd(self, key, path, value, cas=0, create=False, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_DICT_ADD, key, path, value, cas, create, vbucket)
+
+    def dict_upsert_sd(self, key, path, value, cas=0, create=False, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_DICT_UPSERT, key, path, value, cas, create, vbucket)
+
+    def delete_sd(self, key, path, cas=0, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_DELETE, key, path, cas=cas, vbucket=vbucket)
+
+    def replace_sd(self, key, path, value, cas=0, create=False, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_REPLACE, key, path, value, cas, create, vbucket)
+
+    def array_push_last_sd(self, key, path, value, cas=0, create=False, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_ARRAY_PUSH_LAST, key, path, value, cas, create, vbucket)
+
+    def array_push_first_sd(self, key, path, value, cas=0, create=False, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_ARRAY_PUSH_FIRST, key, path, value, cas, create, vbucket)
+
+    def array_add_unique_sd(self, key, path, value, cas=0, create=False, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_ARRAY_ADD_UNIQUE, key, path, value, cas, create, vbucket)
+
+    def counter_sd(self, key, path, value, cas=0, create=False, vbucket=-1):
+        return self._doSdCmd(memcacheConstants.CMD_SUBDOC_COUNTER, key, path, value, cas, create, vbucket)
+
+
 def error_to_str(errno):
     if errno == 0x01:
         return "Not found"
@@ -6,7 +6,13 @@ Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
 """
 
 import asyncore
+import errno
+import getopt
+import itertools
+import os
 import random
+import select
+import signal
 import string
 import socket
 import struct
@@ -14,6 +20,7 @@ import time
 import hmac
 import heapq
 import sys
+from multiprocessing import Process
 
 import memcacheConstants
 from memcacheConstants import MIN_RECV_PACKET, REQ_PKT_FMT, RES_PKT_FMT
@@ -22,6 +29,12 @@ from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE, EXTRA_HDR_FMTS
 
 VERSION = "1.0"
 
+# deleted, flags, expiration, seqno
+GET_META_RES_FMT = ">IIIQ"
+# not exported by the socket module of python 2
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
 
 class BaseBackend(object):
     """Higher-level backend (processes commands and stuff)."""
@@ -302,7 +315,7 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
     """A channel implementing the binary protocol for memcached."""
 
     # Receive buffer size
-    BUFFER_SIZE = 4096
+    BUFFER_SIZE = 64 * 1024
 
     def __init__(self, channel, backend, wbuf=""):
         asyncore.dispatcher.__init__(self, channel)
@@ -311,32 +324,28 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
         self.wbuf = wbuf
         self.rbuf = ""
 
-    def __hasEnoughBytes(self):
-        rv = False
-        if len(self.rbuf) >= MIN_RECV_PACKET:
-            magic, cmd, keylen, extralen, datatype, vb, remaining, opaque, cas =\
-                struct.unpack(REQ_PKT_FMT, self.rbuf[:MIN_RECV_PACKET])
-            rv = len(self.rbuf) - MIN_RECV_PACKET >= remaining
-        return rv
-
-    def processCommand(self, cmd, keylen, vb, cas, data):
+    def processCommand(self, cmd, keylen, vb, extralen, cas, data):
         return self.backend.processCommand(cmd, keylen, vb, cas, data)
 
     def handle_read(self):
         self.rbuf += self.recv(self.BUFFER_SIZE)
-        while self.__hasEnoughBytes():
+        # parse every complete request in the buffer, then drop them all at once
+        pos = 0
+        responses = []
+        while len(self.rbuf) - pos >= MIN_RECV_PACKET:
             magic, cmd, keylen, extralen, datatype, vb, remaining, opaque, cas =\
-                struct.unpack(REQ_PKT_FMT, self.rbuf[:MIN_RECV_PACKET])
+                struct.unpack_from(REQ_PKT_FMT, self.rbuf, pos)
+            if len(self.rbuf) - pos - MIN_RECV_PACKET < remaining:
+                break
             assert magic == REQ_MAGIC_BYTE
             assert keylen <= remaining, "Keylen is too big: %d > %d" \
                 % (keylen, remaining)
             assert extralen == memcacheConstants.EXTRA_HDR_SIZES.get(cmd, 0), \
                 "Extralen is too large for cmd 0x%x: %d" % (cmd, extralen)
             # Grab the data section of this request
-            data = self.rbuf[MIN_RECV_PACKET:MIN_RECV_PACKET + remaining]
+            data = self.rbuf[pos + MIN_RECV_PACKET:pos + MIN_RECV_PACKET + remaining]
             assert len(data) == remaining
-            # Remove this request from the read buffer
-            self.rbuf = self.rbuf[MIN_RECV_PACKET + remaining:]
+            pos += MIN_RECV_PACKET + remaining
             # Process the command
             cmdVal = self.processCommand(cmd, keylen, vb, extralen, cas, data)
             # Queue the response to the client if applicable.
@@ -348,10 +357,13 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
                     raise
                 dtype = 0
                 extralen = memcacheConstants.EXTRA_HDR_SIZES.get(cmd, 0)
-                self.wbuf += struct.pack(RES_PKT_FMT,
-                                         RES_MAGIC_BYTE, cmd, keylen,
-                                         extralen, dtype, status,
-                                         len(response), opaque, cas) + response
+                responses.append(struct.pack(RES_PKT_FMT,
+                                             RES_MAGIC_BYTE, cmd, keylen,
+                                             extralen, dtype, status,
+                                             len(response), opaque, cas) + response)
+        self.rbuf = self.rbuf[pos:]
+        if responses:
+            self.wbuf += ''.join(responses)
 
     def writable(self):
         return self.wbuf
@@ -383,10 +395,706 @@ class MemcachedServer(asyncore.dispatcher):
         channel, addr = self.accept()
         self.handler(channel, self.backend)
 
+class VBucket(object):
+    """Items of one vbucket, key -> (flags, exp, cas, seqno, value), value
+    None for deleted items. A copy made with source shares the items of
+    that vbucket, e.g. a replica on another backend."""
+
+    __slots__ = ('state', 'items', 'seqno', 'live', 'source')
+
+    def __init__(self, state, source=None):
+        self.state = state
+        self.items = {} if source is None else source.items
+        self.seqno = 0
+        self.live = 0
+        self.source = source
+
+    def num_items(self):
+        if self.source is not None:
+            return self.source.live
+        return self.live
+
+
+class VBucketBackend(object):
+    """Fast in-memory backend honouring vbucket ids and states.
+
+    Key commands are only served by vbuckets in the active state (replica
+    ones for CMD_GET_REPLICA), other vbuckets answer NOT_MY_VBUCKET like the
+    real engine, pending ones ETMPFAIL. vbucket states can be changed by
+    clients with set_vbucket_state or directly through the methods below,
+    e.g. to emulate a rebalance. Commands return (status, cas, extras, key,
+    value), None when a quiet command has nothing to say, or a list of
+    responses for stats. Nothing is logged per command.
+    """
+
+    RELATIVE_EXPIRY = 30 * 24 * 3600
+
+    def __init__(self, num_vbuckets=1024, vbuckets=None,
+                 state=memcacheConstants.VB_STATE_ACTIVE):
+        """vbuckets -- the vbucket ids to create in the given state, all of
+        them by default"""
+        self.num_vbuckets = num_vbuckets
+        self.vbuckets = [None] * num_vbuckets
+        if vbuckets is None:
+            vbuckets = xrange(num_vbuckets)
+        for vbucket in vbuckets:
+            self.vbuckets[vbucket] = VBucket(state)
+        self.cas = itertools.count(int(time.time()) << 16)
+        self.cluster_config = None
+        self.counters = dict.fromkeys(['cmd_get', 'cmd_set', 'get_hits', 'get_misses',
+                                       'delete_hits', 'delete_misses',
+                                       'ep_num_not_my_vbuckets'], 0)
+        C = memcacheConstants
+        self.handlers = {
+            C.CMD_GET: self.handle_get,
+            C.CMD_GETQ: self._quiet_get(self.handle_get),
+            C.CMD_GETK: self.handle_getk,
+            C.CMD_GETKQ: self._quiet_get(self.handle_getk),
+            C.CMD_GET_REPLICA: self.handle_get_replica,
+            C.CMD_GET_META: self.handle_get_meta,
+            C.CMD_SET: self.handle_set,
+            C.CMD_SETQ: self._quiet(self.handle_set),
+            C.CMD_ADD: self.handle_add,
+            C.CMD_ADDQ: self._quiet(self.handle_add),
+            C.CMD_REPLACE: self.handle_replace,
+            C.CMD_REPLACEQ: self._quiet(self.handle_replace),
+            C.CMD_APPEND: self.handle_append,
+            C.CMD_PREPEND: self.handle_prepend,
+            C.CMD_DELETE: self.handle_delete,
+            C.CMD_DELETEQ: self._quiet(self.handle_delete),
+            C.CMD_INCR: self.handle_incr,
+            C.CMD_DECR: self.handle_decr,
+            C.CMD_TOUCH: self.handle_touch,
+            C.CMD_FLUSH: self.handle_flush,
+            C.CMD_NOOP: self.handle_ok,
+            C.CMD_QUIT: self.handle_ok,
+            C.CMD_VERSION: self.handle_version,
+            C.CMD_STAT: self.handle_stat,
+            C.CMD_HELLO: self.handle_ok,
+            C.CMD_SASL_LIST_MECHS: self.handle_sasl_mechs,
+            C.CMD_SASL_AUTH: self.handle_ok,
+            C.CMD_SELECT_BUCKET: self.handle_ok,
+            C.CMD_SET_VBUCKET_STATE: self.handle_set_vbucket_state,
+            C.CMD_GET_VBUCKET_STATE: self.handle_get_vbucket_state,
+            C.CMD_DELETE_VBUCKET: self.handle_delete_vbucket,
+            C.CMD_GET_CLUSTER_CONFIG: self.handle_get_cluster_config,
+        }
+
+    def process(self, cmd, vbucket, extras, key, value, cas):
+        handler = self.handlers.get(cmd)
+        if handler is None:
+            return (memcacheConstants.ERR_UNKNOWN_CMD, 0, '', '',
+                    "The command %d is unknown" % cmd)
+        return handler(vbucket, extras, key, value, cas)
+
+    @staticmethod
+    def _error(status, msg):
+        return status, 0, '', '', msg
+
+    @staticmethod
+    def _quiet(handler):
+        def quiet(vbucket, extras, key, value, cas):
+            rv = handler(vbucket, extras, key, value, cas)
+            if rv[0] != 0:
+                return rv
+        return quiet
+
+    @staticmethod
+    def _quiet_get(handler):
+        def quiet(vbucket, extras, key, value, cas):
+            rv = handler(vbucket, extras, key, value, cas)
+            if rv[0] != memcacheConstants.ERR_NOT_FOUND:
+                return rv
+        return quiet
+
+    # vbucket management
+
+    def set_vbucket_state(self, vbucket, state):
+        """Creates the vbucket if needed, state is a state id or name"""
+        state = memcacheConstants.VB_STATE_NAMES.get(state, state)
+        vb = self.vbuckets[vbucket]
+        if vb is None:
+            self.vbuckets[vbucket] = VBucket(state)
+        else:
+            vb.state = state
+
+    def get_vbucket_state(self, vbucket):
+        vb = self.vbuckets[vbucket]
+        return 0 if vb is None else vb.state
+
+    def delete_vbucket(self, vbucket):
+        self.vbuckets[vbucket] = None
+
+    def _vbucket(self, vbucket, state=memcacheConstants.VB_STATE_ACTIVE):
+        if vbucket < self.num_vbuckets:
+            vb = self.vbuckets[vbucket]
+            if vb is not None and vb.state == state:
+                return vb
+        return None
+
+    def _not_my_vbucket(self, vbucket):
+        if vbucket < self.num_vbuckets and self.vbuckets[vbucket] is not None and \
+                self.vbuckets[vbucket].state == memcacheConstants.VB_STATE_PENDING:
+            return self._error(memcacheConstants.ERR_ETMPFAIL, 'Temporary failure')
+        self.counters['ep_num_not_my_vbuckets'] += 1
+        # like the real engine, send the current cluster config when known
+        return self._error(memcacheConstants.ERR_NOT_MY_VBUCKET,
+                           self.cluster_config or 'Not my vbucket')
+
+    # items
+
+    def _expiry(self, exp):
+        if exp and exp <= self.RELATIVE_EXPIRY:
+            return int(time.time()) + exp
+        return exp
+
+    def _lookup(self, vb, key):
+        item = vb.items.get(key)
+        if item is None or item[4] is None:
+            return None
+        if item[1] and item[1] <= time.time():
+            self._remove(vb, key, item)
+            return None
+        return item
+
+    def _store(self, vb, key, flags, exp, value):
+        old = vb.items.get(key)
+        if old is None or old[4] is None:
+            vb.live += 1
+        vb.seqno += 1
+        cas = self.cas.next()
+        vb.items[key] = (flags, exp, cas, vb.seqno, value)
+        return cas
+
+    def _remove(self, vb, key, item):
+        vb.live -= 1
+        vb.seqno += 1
+        cas = self.cas.next()
+        vb.items[key] = (item[0], 0, cas, vb.seqno, None)
+        return cas
+
+    def _get(self, vbucket, key, with_key, state=memcacheConstants.VB_STATE_ACTIVE):
+        vb = self._vbucket(vbucket, state)
+        if vb is None:
+            return self._not_my_vbucket(vbucket)
+        self.counters['cmd_get'] += 1
+        item = self._lookup(vb, key)
+        if item is None:
+            self.counters['get_misses'] += 1
+            return self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+        self.counters['get_hits'] += 1
+        return 0, item[2], struct.pack(memcacheConstants.GET_RES_FMT, item[0]), \
+            key if with_key else '', item[4]
+
+    def handle_get(self, vbucket, extras, key, value, cas):
+        return self._get(vbucket, key, False)
+
+    def handle_getk(self, vbucket, extras, key, value, cas):
+        return self._get(vbucket, key, True)
+
+    def handle_get_replica(self, vbucket, extras, key, value, cas):
+        return self._get(vbucket, key, False, memcacheConstants.VB_STATE_REPLICA)
+
+    def handle_get_meta(self, vbucket, extras, key, value, cas):
+        vb = self._vbucket(vbucket)
+        if vb is None:
+            return self._not_my_vbucket(vbucket)
+        self._lookup(vb, key)
+        item = vb.items.get(key)
+        if item is None:
+            return self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+        meta = struct.pack(GET_META_RES_FMT, item[4] is None, item[0], item[1], item[3])
+        if extras:
+            # conflict resolution mode, requested with the extended meta data flag
+            meta += '\x00'
+        return 0, item[2], '', '', meta
+
+    def _mutate(self, vbucket, extras, key, value, cas, must_exist=None):
+        """Stores value, must_exist True/False for replace/add"""
+        vb = self._vbucket(vbucket)
+        if vb is None:
+            return self._not_my_vbucket(vbucket)
+        self.counters['cmd_set'] += 1
+        flags, exp = struct.unpack(memcacheConstants.SET_PKT_FMT, extras)
+        if cas or must_exist is not None:
+            item = self._lookup(vb, key)
+            if must_exist is False and item is not None:
+                return self._error(memcacheConstants.ERR_EXISTS, 'Data exists for key')
+            if (must_exist or cas) and item is None:
+                return self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+            if cas and item[2] != cas:
+                return self._error(memcacheConstants.ERR_EXISTS, 'Exists')
+        return 0, self._store(vb, key, flags, self._expiry(exp), value), '', '', ''
+
+    def handle_set(self, vbucket, extras, key, value, cas):
+        return self._mutate(vbucket, extras, key, value, cas)
+
+    def handle_add(self, vbucket, extras, key, value, cas):
+        return self._mutate(vbucket, extras, key, value, cas, must_exist=False)
+
+    def handle_replace(self, vbucket, extras, key, value, cas):
+        return self._mutate(vbucket, extras, key, value, cas, must_exist=True)
+
+    def _concat(self, vbucket, key, value, cas, append):
+        vb = self._vbucket(vbucket)
+        if vb is None:
+            return self._not_my_vbucket(vbucket)
+        item = self._lookup(vb, key)
+        if item is None:
+            return self._error(memcacheConstants.ERR_NOT_STORED, 'Not stored')
+        if cas and item[2] != cas:
+            return self._error(memcacheConstants.ERR_EXISTS, 'Exists')
+        value = item[4] + value if append else value + item[4]
+        return 0, self._store(vb, key, item[0], item[1], value), '', '', ''
+
+    def handle_append(self, vbucket, extras, key, value, cas):
+        return self._concat(vbucket, key, value, cas, True)
+
+    def handle_prepend(self, vbucket, extras, key, value, cas):
+        return self._concat(vbucket, key, value, cas, False)
+
+    def handle_delete(self, vbucket, extras, key, value, cas):
+        vb = self._vbucket(vbucket)
+        if vb is None:
+            return self._not_my_vbucket(vbucket)
+        item = self._lookup(vb, key)
+        if item is None:
+            self.counters['delete_misses'] += 1
+            return self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+        if cas and item[2] != cas:
+            return self._error(memcacheConstants.ERR_EXISTS, 'Exists')
+        self.counters['delete_hits'] += 1
+        return 0, self._remove(vb, key, item), '', '', ''
+
+    def _arith(self, vbucket, extras, key, multiplier):
+        vb = self._vbucket(vbucket)
+        if vb is None:
+            return self._not_my_vbucket(vbucket)
+        amount, initial, exp = struct.unpack(memcacheConstants.INCRDECR_PKT_FMT, extras)
+        item = self._lookup(vb, key)
+        if item is None:
+            if exp == memcacheConstants.INCRDECR_SPECIAL:
+                return self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+            counter, flags, exp = initial, 0, self._expiry(exp)
+        else:
+            try:
+                counter = long(item[4])
+            except ValueError:
+                return self._error(memcacheConstants.ERR_BAD_DELTA, 'Non-numeric server-side value')
+            counter = max(0, counter + multiplier * amount) % 2 ** 64
+            flags, exp = item[0], item[1]
+        cas = self._store(vb, key, flags, exp, str(counter))
+        return 0, cas, '', '', struct.pack(memcacheConstants.INCRDECR_RES_FMT, counter)
+
+    def handle_incr(self, vbucket, extras, key, value, cas):
+        return self._arith(vbucket, extras, key, 1)
+
+    def handle_decr(self, vbucket, extras, key, value, cas):
+        return self._arith(vbucket, extras, key, -1)
+
+    def handle_touch(self, vbucket, extras, key, value, cas):
+        vb = self._vbucket(vbucket)
+        if vb is None:
+            return self._not_my_vbucket(vbucket)
+        item = self._lookup(vb, key)
+        if item is None:
+            return self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+        exp = struct.unpack(memcacheConstants.TOUCH_PKT_FMT, extras)[0]
+        return 0, self._store(vb, key, item[0], self._expiry(exp), item[4]), '', '', ''
+
+    def handle_flush(self, vbucket, extras, key, value, cas):
+        for vb in self.vbuckets:
+            if vb is not None and vb.state == memcacheConstants.VB_STATE_ACTIVE:
+                vb.items.clear()
+                vb.live = 0
+        return 0, 0, '', '', ''
+
+    # everything else
+
+    def handle_ok(self, vbucket, extras, key, value, cas):
+        return 0, 0, '', '', ''
+
+    def handle_version(self, vbucket, extras, key, value, cas):
+        return 0, 0, '', '', "Python test memcached server %s" % VERSION
+
+    def handle_sasl_mechs(self, vbucket, extras, key, value, cas):
+        return 0, 0, '', '', 'PLAIN'
+
+    def handle_set_vbucket_state(self, vbucket, extras, key, value, cas):
+        if vbucket >= self.num_vbuckets:
+            return self._error(memcacheConstants.ERR_EINVAL, 'Invalid vbucket')
+        self.set_vbucket_state(vbucket, struct.unpack(memcacheConstants.VB_SET_PKT_FMT, extras)[0])
+        return 0, 0, '', '', ''
+
+    def handle_get_vbucket_state(self, vbucket, extras, key, value, cas):
+        if vbucket >= self.num_vbuckets:
+            return self._error(memcacheConstants.ERR_EINVAL, 'Invalid vbucket')
+        return 0, 0, '', '', struct.pack('>I', self.get_vbucket_state(vbucket))
+
+    def handle_delete_vbucket(self, vbucket, extras, key, value, cas):
+        if vbucket >= self.num_vbuckets or self.vbuckets[vbucket] is None:
+            return self._not_my_vbucket(vbucket)
+        self.delete_vbucket(vbucket)
+        return 0, 0, '', '', ''
+
+    def handle_get_cluster_config(self, vbucket, extras, key, value, cas):
+        if self.cluster_config is None:
+            return self._error(memcacheConstants.ERR_NOT_SUPPORTED, 'Not supported')
+        return 0, 0, '', '', self.cluster_config
+
+    def stats(self, group=''):
+        """The stats of one group as a dict of strings"""
+        names = dict((state, name) for name, state in memcacheConstants.VB_STATE_NAMES.iteritems())
+        if group == 'vbucket':
+            return dict(("vb_%d" % vbucket, names.get(vb.state, 'dead'))
+                        for vbucket, vb in enumerate(self.vbuckets) if vb is not None)
+        if group != '':
+            return {}
+        stats = dict(self.counters)
+        for name in names.itervalues():
+            stats["vb_%s_num" % name] = 0
+            stats["vb_%s_curr_items" % name] = 0
+        for vb in self.vbuckets:
+            if vb is not None:
+                name = names.get(vb.state, 'dead')
+                stats["vb_%s_num" % name] += 1
+                stats["vb_%s_curr_items" % name] += vb.num_items()
+        stats.update({"curr_items": stats["vb_active_curr_items"],
+                      "curr_items_tot": stats["vb_active_curr_items"] +
+                                        stats["vb_replica_curr_items"],
+                      "ep_queue_size": 0, "ep_flusher_todo": 0,
+                      "ep_uncommitted_items": 0, "ep_warmup_thread": "complete",
+                      "version": VERSION, "time": int(time.time())})
+        return dict((k, str(v)) for k, v in stats.iteritems())
+
+    def handle_stat(self, vbucket, extras, key, value, cas):
+        rv = [(0, 0, '', k, v) for k, v in sorted(self.stats(key).iteritems())]
+        rv.append((0, 0, '', '', ''))
+        return rv
+
+
+class FastMemcachedChannel(object):
+    """One client connection of a FastMemcachedServer.
+
+    Requests are parsed in place out of a reusable bytearray read buffer,
+    and the responses to everything received in one read go out in a single
+    send, the rest being buffered until the socket is writable again.
+    """
+
+    BUFFER_SIZE = 256 * 1024
+    # stop reading from clients that do not read their responses
+    MAX_PENDING_WRITE = 4 * 1024 * 1024
+
+    def __init__(self, sock, server):
+        self.sock = sock
+        self.server = server
+        self.backend = server.backend
+        self.rbuf = bytearray(self.BUFFER_SIZE)
+        self.rview = memoryview(self.rbuf)
+        self.rstart = self.rend = 0
+        self.wbuf = bytearray()
+        self.wpos = 0
+        self.closing = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _make_room(self):
+        pending = self.rend - self.rstart
+        if self.rstart:
+            self.rbuf[:pending] = self.rview[self.rstart:self.rend].tobytes()
+        else:
+            # a single request bigger than the buffer
+            rbuf = bytearray(len(self.rbuf) * 2)
+            rbuf[:pending] = self.rview[:pending].tobytes()
+            self.rbuf, self.rview = rbuf, memoryview(rbuf)
+        self.rstart, self.rend = 0, pending
+
+    def handle_read(self):
+        """Returns False once the connection should be closed"""
+        if self.rend == len(self.rbuf):
+            self._make_room()
+        try:
+            received = self.sock.recv_into(self.rview[self.rend:])
+        except socket.error, e:
+            return e.errno in RETRY_ERRNOS
+        if not received:
+            return False
+        self.rend += received
+        return self._process()
+
+    def _process(self):
+        buf, view = self.rbuf, self.rview
+        pos, end = self.rstart, self.rend
+        process = self.backend.process
+        out = []
+        while end - pos >= MIN_RECV_PACKET:
+            magic, cmd, keylen, extralen, datatype, vbucket, bodylen, opaque, cas = \
+                struct.unpack_from(REQ_PKT_FMT, buf, pos)
+            if magic != REQ_MAGIC_BYTE:
+                print "Bad magic 0x%x, closing connection" % magic
+                return False
+            start = pos + MIN_RECV_PACKET
+            if end - start < bodylen:
+                break
+            pos = start + bodylen
+            key_start = start + extralen
+            value_start = key_start + keylen
+            extras = view[start:key_start].tobytes() if extralen else ''
+            key = view[key_start:value_start].tobytes()
+            value = view[value_start:pos].tobytes() if value_start < pos else ''
+            if cmd in self.server.bucket_cmds:
+                rv = self._select_bucket(cmd, key, value)
+            else:
+                rv = process(cmd, vbucket, extras, key, value, cas)
+            if rv is None:
+                continue
+            if type(rv) is not list:
+                rv = [rv]
+            for status, rcas, rextras, rkey, rvalue in rv:
+                out.append(struct.pack(RES_PKT_FMT, RES_MAGIC_BYTE, cmd, len(rkey),
+                                       len(rextras), 0, status,
+                                       len(rextras) + len(rkey) + len(rvalue), opaque, rcas))
+                out.append(rextras)
+                out.append(rkey)
+                out.append(rvalue)
+            if cmd == memcacheConstants.CMD_QUIT:
+                self.closing = True
+                break
+        if pos == end:
+            self.rstart = self.rend = 0
+        else:
+            self.rstart = pos
+        if out:
+            return self.write(''.join(out))
+        return not self.closing
+
+    def _select_bucket(self, cmd, key, value):
+        """Switches to the backend of another bucket of the server"""
+        if cmd == memcacheConstants.CMD_SASL_AUTH:
+            name = value.split('\0')[1] if value.count('\0') == 2 else ''
+            if name in self.server.buckets:
+                self.backend = self.server.buckets[name]
+            return 0, 0, '', '', 'Authenticated'
+        if key not in self.server.buckets:
+            return memcacheConstants.ERR_NOT_FOUND, 0, '', '', 'No such bucket'
+        self.backend = self.server.buckets[key]
+        return 0, 0, '', '', ''
+
+    def write(self, data):
+        if not self.wbuf:
+            try:
+                sent = self.sock.send(data)
+            except socket.error, e:
+                if e.errno not in RETRY_ERRNOS:
+                    return False
+                sent = 0
+            if sent == len(data):
+                return not self.closing
+            data = data[sent:]
+        self.wbuf += data
+        self.server.update_events(self)
+        return True
+
+    def handle_write(self):
+        try:
+            self.wpos += self.sock.send(buffer(self.wbuf, self.wpos))
+        except socket.error, e:
+            return e.errno in RETRY_ERRNOS
+        if self.wpos == len(self.wbuf):
+            self.wbuf = bytearray()
+            self.wpos = 0
+            if self.closing:
+                return False
+        elif self.wpos >= self.BUFFER_SIZE:
+            del self.wbuf[:self.wpos]
+            self.wpos = 0
+        self.server.update_events(self)
+        return True
+
+    def events(self):
+        events = 0
+        if len(self.wbuf) - self.wpos < self.MAX_PENDING_WRITE and not self.closing:
+            events |= select.POLLIN
+        if self.wbuf:
+            events |= select.POLLOUT
+        return events
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class Poller(object):
+    """select.epoll where available, select.poll otherwise"""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            self.scale = 1000
+
+    def register(self, fd, events):
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            return self.poller.poll(timeout * self.scale)
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class FastMemcachedServer(object):
+    """A memcached server for driving clients at full speed.
+
+    Serves a VBucketBackend (or anything with the same process method) from
+    a poll loop of FastMemcachedChannel. With processes > 1 that many worker
+    processes each bind their own SO_REUSEPORT listener, so the kernel
+    spreads connections over them. Every process then has its own copy of
+    the backend: a client only sees the items written over connections
+    accepted by the same process.
+
+    buckets -- optional {name: backend}, selected by CMD_SELECT_BUCKET or by
+               authenticating as the bucket name, it may change while serving
+    """
+
+    POLL_TIMEOUT = 0.5
+
+    def __init__(self, backend, port=11211, host='', processes=1, buckets=None):
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self.processes = processes
+        self.buckets = {} if buckets is None else buckets
+        self.bucket_cmds = set()
+        if buckets is not None:
+            self.bucket_cmds = set([memcacheConstants.CMD_SELECT_BUCKET,
+                                    memcacheConstants.CMD_SASL_AUTH])
+        self.running = False
+        self.parent_pid = None
+        self.poller = None
+        self.channels = {}
+        self.listener = None
+        if processes <= 1:
+            self.listener = self._listen(reuse_port=False)
+
+    def _listen(self, reuse_port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(1024)
+        sock.setblocking(0)
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def serve_forever(self):
+        if self.listener is not None:
+            self._serve(self.listener)
+            return
+        if not self.port:
+            raise ValueError("a port is required with processes > 1")
+        workers = [Process(target=self._serve_worker, args=(os.getpid(),))
+                   for _ in range(self.processes)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        # stop the workers when terminated too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+    def _serve_worker(self, parent_pid):
+        self.parent_pid = parent_pid
+        try:
+            self._serve(self._listen(reuse_port=True))
+        except KeyboardInterrupt:
+            pass
+
+    def shutdown(self):
+        """Stops serve_forever within POLL_TIMEOUT"""
+        self.running = False
+
+    def update_events(self, channel):
+        self.poller.modify(channel.fileno(), channel.events())
+
+    def _accept(self, listener):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except socket.error, e:
+                if e.errno in RETRY_ERRNOS or e.errno == errno.ECONNABORTED:
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            channel = FastMemcachedChannel(sock, self)
+            self.channels[sock.fileno()] = channel
+            self.poller.register(sock.fileno(), select.POLLIN)
+
+    def _close(self, fd):
+        channel = self.channels.pop(fd)
+        self.poller.unregister(fd)
+        channel.close()
+
+    def _serve(self, listener):
+        self.poller = Poller()
+        self.poller.register(listener.fileno(), select.POLLIN)
+        self.running = True
+        listener_fd = listener.fileno()
+        try:
+            while self.running:
+                if self.parent_pid is not None and os.getppid() != self.parent_pid:
+                    break
+                for fd, events in self.poller.poll(self.POLL_TIMEOUT):
+                    if fd == listener_fd:
+                        self._accept(listener)
+                        continue
+                    channel = self.channels.get(fd)
+                    if channel is None:
+                        continue
+                    ok = True
+                    if events & select.POLLOUT:
+                        ok = channel.handle_write()
+                    if ok and events & (select.POLLIN | select.POLLERR | select.POLLHUP):
+                        ok = channel.handle_read()
+                    if not ok:
+                        self._close(fd)
+        finally:
+            for fd in self.channels.keys():
+                self._close(fd)
+            listener.close()
+
+
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        port = int(sys.argv[1])
+    opts, args = getopt.getopt(sys.argv[1:], '', ['fast', 'processes=', 'vbuckets='])
+    opts = dict(opts)
+    if args:
+        port = int(args[0])
     else:
         port = 11211
-    server = MemcachedServer(DictBackend(), MemcachedBinaryChannel, port=port)
-    asyncore.loop()
+    if '--fast' in opts:
+        backend = VBucketBackend(int(opts.get('--vbuckets', 1024)))
+        FastMemcachedServer(backend, port=port,
+                            processes=int(opts.get('--processes', 1))).serve_forever()
+    else:
+        server = MemcachedServer(DictBackend(), MemcachedBinaryChannel, port=port)
+        asyncore.loop()
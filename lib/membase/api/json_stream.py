@@ -0,0 +1,102 @@
+import json
+
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+NUMBER_CHARS = '0123456789.eE+-'
+
+
+class JsonRowStream(object):
+    """Iterates over the elements of one array field of a JSON object read
+    from a file-like object such as an httplib response.
+
+    Rows are decoded one at a time as the data arrives, so memory use does
+    not depend on the number of rows. The other top level fields (total_rows,
+    status, errors, metrics...) are collected in meta while iterating, the
+    ones following the array are only there once the stream is consumed.
+    close() also closes connection, e.g. the httplib connection the response
+    was read from.
+    """
+
+    def __init__(self, stream, field, chunk_size=CHUNK_SIZE, connection=None):
+        self.stream = stream
+        self.connection = connection
+        self.field = field
+        self.chunk_size = chunk_size
+        self.meta = {}
+        self.count = 0
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        data = self.stream.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Skips whitespace and returns the next character, '' at the end"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError("expected one of '{0}' at offset {1} of the {2} stream, got '{3}'"
+                             .format(chars, self.pos, self.field, char))
+        self.pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if self.eof or (end < len(self.buf) and self.buf[end] not in NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == self.field and self._peek() == '[':
+                self.pos += 1
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        row = self._value()
+                        self.count += 1
+                        yield row
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.meta[key] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+    def close(self):
+        self.stream.close()
+        if self.connection is not None:
+            self.connection.close()
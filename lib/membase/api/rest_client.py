@@ -1,6 +1,9 @@
 import base64
 import json
+import os
 import urllib
+import urlparse
+import httplib
 import httplib2
 import logger
 import traceback
@@ -9,6 +12,7 @@ import time
 import re
 import uuid
 from copy import deepcopy
+import threading
 from threading import Thread
 from TestInput import TestInputSingleton
 from testconstants import MIN_KV_QUOTA, INDEX_QUOTA, FTS_QUOTA, CBAS_QUOTA
@@ -20,14 +24,96 @@ try:
 except ImportError:
     from lib.couchbase_helper.document import DesignDocument, View
 
-from memcached.helper.kvstore import KVStore
+from memcached.helper.kvstore import KVStore, CompactKVStore
 from exception import ServerAlreadyJoinedException, ServerUnavailableException, InvalidArgumentException
 from membase.api.exception import BucketCreationException, ServerSelfJoinException, ClusterRemoteException, \
     RebalanceFailedException, FailoverFailedException, DesignDocCreationException, QueryViewException, \
     ReadDocumentException, GetBucketInfoFailed, CompactViewFailed, SetViewInfoNotFound, AddNodeException, \
-    BucketFlushFailed, CBRecoveryFailedException, XDCRException, SetRecoveryTypeFailed, BucketCompactionException
+    BucketFlushFailed, CBRecoveryFailedException, XDCRException, SetRecoveryTypeFailed, BucketCompactionException, \
+    CBQError
+from membase.api.json_stream import JsonRowStream
 log = logger.Logger.get_logger()
 
+
+class HttpConnectionPool(object):
+    """Process wide pool of keep-alive httplib2.Http objects.
+
+    Idle Http objects (each holding its open connections) are kept per
+    (host:port, authorization, timeout); a request checks one out, so
+    concurrent threads never share a connection, and returns it afterwards.
+    GETs of CACHEABLE_APIS can also be answered from a short lived response
+    cache, which any non-GET request to the same host invalidates.
+
+    A process forked from the one that made the requests starts with an
+    empty pool and a new lock, it never uses the inherited connections.
+    """
+
+    CACHEABLE_APIS = ('pools/default', 'nodes/self')
+
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.responses = {}
+        self.counters = {'pool_hits': 0, 'pool_misses': 0, 'cache_hits': 0, 'cache_misses': 0}
+
+    def _after_fork(self):
+        """Drops the state inherited from the parent process, its sockets
+        are shared with it and its lock may have been held by another thread"""
+        if self.pid != os.getpid():
+            self.lock = threading.Lock()
+            self.idle = {}
+            self.responses = {}
+            self.pid = os.getpid()
+
+    def request(self, uri, method='GET', body=None, headers=None, timeout=None, cache_ttl=0):
+        self._after_fork()
+        host = urlparse.urlsplit(uri).netloc
+        auth = (headers or {}).get('Authorization')
+        cacheable = cache_ttl > 0 and method == 'GET' and uri.rstrip('/').endswith(self.CACHEABLE_APIS)
+        with self.lock:
+            if method != 'GET':
+                self.responses.pop(host, None)
+            elif cacheable:
+                cached = self.responses.get(host, {}).get((uri, auth))
+                if cached and cached[0] > time.time():
+                    self.counters['cache_hits'] += 1
+                    return cached[1], cached[2]
+                self.counters['cache_misses'] += 1
+            key = (host, auth, timeout)
+            idle = self.idle.get(key)
+            if idle:
+                http = idle.pop()
+                self.counters['pool_hits'] += 1
+            else:
+                http = httplib2.Http(timeout=timeout)
+                self.counters['pool_misses'] += 1
+        response, content = http.request(uri, method, body, headers)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(http)
+            if cacheable and response['status'] in ['200', '201', '202']:
+                self.responses.setdefault(host, {})[(uri, auth)] = (time.time() + cache_ttl, response, content)
+        return response, content
+
+    def stats(self):
+        self._after_fork()
+        with self.lock:
+            stats = dict(self.counters)
+            stats['idle_connections'] = sum([len(idle) for idle in self.idle.values()])
+            return stats
+
+    def clear(self):
+        self._after_fork()
+        with self.lock:
+            self.idle = {}
+            self.responses = {}
+
+
+HTTP_POOL = HttpConnectionPool()
+
 # helper library methods built on top of RestConnection interface
 
 class RestHelper(object):
@@ -219,6 +305,9 @@ class RestHelper(object):
         return vbuckets_servers
 
 class RestConnection(object):
+    # seconds GETs of HttpConnectionPool.CACHEABLE_APIS may be served from
+    # cache, set per run with rest_cache_ttl
+    response_cache_ttl = 0
 
     def __new__(self, serverInfo={}):
 
@@ -304,6 +393,7 @@ class RestConnection(object):
                 new_services=fts-kv-index-n1ql """
             self.services_node_init = self.input.param("new_services", None)
             self.debug_logs = self.input.param("debug-logs", False)
+            self.response_cache_ttl = float(self.input.param("rest_cache_ttl", 0))
         self.baseUrl = "http://{0}:{1}/".format(self.ip, self.port)
         self.fts_baseUrl = "http://{0}:{1}/".format(self.ip, self.fts_port)
         self.index_baseUrl = "http://{0}:{1}/".format(self.ip, self.index_port)
@@ -534,25 +624,95 @@ class RestConnection(object):
             raise QueryViewException(view_name, content, status=stat)
         return json.loads(content)
 
-    def _query(self, design_doc_name, view_name, bucket, view_type, query, timeout):
+    def query_view_rows(self, design_doc_name, view_name, bucket, query, page_size=None,
+                        timeout=120, type="view"):
+        """Yields the rows of a view query as they are read from the response,
+        without loading the whole result.
+
+        With page_size the rows are fetched in pages of that many rows, each
+        page starting after the key and doc id of the last row of the previous
+        one. Queries by keys are always fetched in one request.
+        """
+        query = dict(query)
+        limit = query.pop('limit', None)
+        if limit is not None:
+            limit = int(limit)
+        skip = int(query.pop('skip', 0))
+        if 'keys' in query:
+            page_size = None
+        returned = 0
+        resume = None
+        while True:
+            page = dict(query)
+            if skip:
+                page['skip'] = skip
+            page_limit = page_size
+            if limit is not None:
+                page_limit = limit - returned if not page_size else min(page_size, limit - returned)
+                if page_limit <= 0:
+                    return
+            if page_limit is not None:
+                page['limit'] = page_limit
+            rows = self._query_stream(design_doc_name, view_name, bucket, type, page, timeout)
+            last = None
+            same = 0
+            try:
+                for row in rows:
+                    position = (row.get('key'), row.get('id'))
+                    if position == last:
+                        same += 1
+                    else:
+                        last, same = position, 1
+                    yield row
+            finally:
+                rows.close()
+            if rows.meta.get('errors'):
+                log.error("errors in {0} query results: {1}".format(view_name, rows.meta['errors']))
+            returned += rows.count
+            if not page_size or rows.count < page_limit:
+                return
+            # skip the rows of the last page sharing the position we resume from
+            if same == rows.count and last == resume:
+                skip += same
+            else:
+                skip = same
+            resume = last
+            for param in ['start_key', 'start_key_doc_id', 'startkey_docid']:
+                query.pop(param, None)
+            query['startkey'] = json.dumps(last[0])
+            if last[1] is not None:
+                query['startkey_docid'] = last[1]
+
+    def _view_api(self, design_doc_name, view_name, bucket, view_type, query):
         if design_doc_name.find('/') != -1:
             design_doc_name = design_doc_name.replace('/', '%2f')
         if view_name.find('/') != -1:
             view_name = view_name.replace('/', '%2f')
+        if isinstance(bucket, Bucket):
+            bucket = bucket.name
         api = self.capiBaseUrl + '%s/_design/%s/_%s/%s?%s' % (bucket,
                                                design_doc_name, view_type,
                                                view_name,
                                                urllib.urlencode(query))
-        if isinstance(bucket, Bucket):
-            api = self.capiBaseUrl + '%s/_design/%s/_%s/%s?%s' % (bucket.name,
-                                                  design_doc_name, view_type,
-                                                  view_name,
-                                                  urllib.urlencode(query))
         log.info("index query url: {0}".format(api))
+        return api
+
+    def _query(self, design_doc_name, view_name, bucket, view_type, query, timeout):
+        api = self._view_api(design_doc_name, view_name, bucket, view_type, query)
         status, content, header = self._http_request(api, headers=self._create_capi_headers(),
                                                      timeout=timeout)
         return status, content, header
 
+    def _query_stream(self, design_doc_name, view_name, bucket, view_type, query, timeout):
+        api = self._view_api(design_doc_name, view_name, bucket, view_type, query)
+        status, response, connection = self._stream_request(api, headers=self._create_capi_headers(),
+                                                            timeout=timeout)
+        if not status:
+            content = response.read()
+            connection.close()
+            raise QueryViewException(view_name, content, status=response.status)
+        return JsonRowStream(response, 'rows', connection=connection)
+
     def view_results(self, bucket, ddoc_name, params, limit=100, timeout=120,
                      view_name=None):
         status, json = self._index_results(bucket, "view", ddoc_name, params, limit, timeout=timeout, view_name=view_name)
@@ -789,7 +949,8 @@ class RestConnection(object):
         log.debug("Executing {0} request for following api {1} with Params: {2}  and Headers: {3}".format(method,api,params,headers))
         while True:
             try:
-                response, content = httplib2.Http(timeout=timeout).request(api, method, params, headers)
+                response, content = HTTP_POOL.request(api, method, params, headers, timeout=timeout,
+                                                      cache_ttl=self.response_cache_ttl)
                 if response['status'] in ['200', '201', '202']:
                     return True, content, response
                 else:
@@ -817,6 +978,39 @@ class RestConnection(object):
                     raise ServerUnavailableException(ip=self.ip)
             time.sleep(3)
 
+    def _stream_request(self, api, method='GET', params='', headers=None, timeout=120):
+        """Like _http_request but returns the httplib response with its body
+        still unread, for results too large to hold in one string, and its
+        connection. Close the connection once the body is read: closing it
+        before would also close the response of a keep-alive connection"""
+        if not headers:
+            headers = self._create_headers()
+        # base64.encodestring leaves a newline httplib refuses in header values
+        headers = dict((key, value.strip()) for key, value in headers.iteritems())
+        url = urlparse.urlsplit(api)
+        path = url.path
+        if url.query:
+            path += '?' + url.query
+        connection_class = httplib.HTTPSConnection if url.scheme == 'https' else httplib.HTTPConnection
+        end_time = time.time() + timeout
+        log.debug("Streaming {0} request for following api {1}".format(method, api))
+        while True:
+            connection = connection_class(url.hostname, url.port, timeout=timeout)
+            try:
+                connection.request(method, path, params, headers)
+                response = connection.getresponse()
+                if response.status in [200, 201, 202]:
+                    return True, response, connection
+                log.error('{0} {1} body: {2} error: {3} {4}'.format(method, api, params, response.status,
+                                                                    self._get_auth(headers)))
+                return False, response, connection
+            except socket.error as e:
+                connection.close()
+                log.error("socket error while connecting to {0} error {1} ".format(api, e))
+                if time.time() > end_time:
+                    raise ServerUnavailableException(ip=self.ip)
+            time.sleep(3)
+
     def init_cluster(self, username='Administrator', password='password', port='8091'):
         api = self.baseUrl + 'settings/web'
         params = urllib.urlencode({'port': port,
@@ -1338,7 +1532,7 @@ class RestConnection(object):
         count_cbserver_up = 0
         while break_out < 60 and count_cbserver_up < 2:
             try:
-                response, content = httplib2.Http(timeout=120).request(api, 'GET', '', headers)
+                response, content = HTTP_POOL.request(api, 'GET', '', headers, timeout=120)
                 if response['status'] in ['200', '201', '202'] and count_cbserver_up == 0:
                     log.info("couchbase server is up but down soon.")
                     time.sleep(1)
@@ -3102,7 +3296,7 @@ class RestConnection(object):
 
     '''Start Monitoring/Profiling Rest Calls'''
     def set_completed_requests_collection_duration(self, server, min_time):
-        http = httplib2.Http()
+        http = HTTP_POOL
         n1ql_port = 8093
         api = "http://%s:%s/" % (server.ip, n1ql_port) + "admin/settings"
         body = {"completed-threshold": min_time}
@@ -3111,7 +3305,7 @@ class RestConnection(object):
         return response,content
 
     def set_completed_requests_max_entries(self, server, no_entries):
-        http = httplib2.Http()
+        http = HTTP_POOL
         n1ql_port = 8093
         api = "http://%s:%s/" % (server.ip, n1ql_port) + "admin/settings"
         body = {"completed-limit": no_entries}
@@ -3120,7 +3314,7 @@ class RestConnection(object):
         return response,content
 
     def set_profiling(self, server, setting):
-        http = httplib2.Http()
+        http = HTTP_POOL
         n1ql_port = 8093
         api = "http://%s:%s/" % (server.ip, n1ql_port) + "admin/settings"
         body = {"profile": setting}
@@ -3129,7 +3323,7 @@ class RestConnection(object):
         return response,content
 
     def set_profiling_controls(self, server, setting):
-        http = httplib2.Http()
+        http = HTTP_POOL
         n1ql_port = 8093
         api = "http://%s:%s/" % (server.ip, n1ql_port) + "admin/settings"
         body = {"controls": setting}
@@ -3138,7 +3332,7 @@ class RestConnection(object):
         return response,content
 
     def get_query_admin_settings(self,server):
-        http = httplib2.Http()
+        http = HTTP_POOL
         n1ql_port = 8093
         api = "http://%s:%s/" % (server.ip, n1ql_port) + "admin/settings"
         headers = self._create_headers_with_auth('Administrator', 'password')
@@ -3147,7 +3341,7 @@ class RestConnection(object):
         return result
 
     def get_query_vitals(self,server):
-        http = httplib2.Http()
+        http = HTTP_POOL
         n1ql_port = 8093
         api = "http://%s:%s/" % (server.ip, n1ql_port) + "admin/vitals"
         headers = self._create_headers_with_auth('Administrator', 'password')
@@ -3163,7 +3357,7 @@ class RestConnection(object):
         prepared = json.dumps(query)
         if is_prepared:
             if named_prepare and encoded_plan:
-                http = httplib2.Http()
+                http = HTTP_POOL
                 if len(servers)>1:
                     url = "http://%s:%s/query/service" % (servers[1].ip, port)
                 else:
@@ -3174,7 +3368,7 @@ class RestConnection(object):
 
                 response, content = http.request(url, 'POST', headers=headers, body=json.dumps(body))
 
-                return eval(content)
+                return json.loads(content)
 
             elif named_prepare and not encoded_plan:
                 params = 'prepared=' + urllib.quote(prepared, '~()')
@@ -3207,6 +3401,51 @@ class RestConnection(object):
         except ValueError:
             return content
 
+    def query_tool_rows(self, query, port=8093, timeout=1300, query_params={}, page_size=None):
+        """Yields the results of a N1QL statement as they are read from the
+        response, without loading the whole result.
+
+        With page_size the statement is run once per page with LIMIT and
+        OFFSET appended, so it must not have its own and needs an ORDER BY for
+        the pages to be consistent. Raises CBQError if the query reports errors.
+        """
+        query = query.rstrip().rstrip(';')
+        offset = 0
+        while True:
+            statement = query
+            if page_size:
+                statement = "%s LIMIT %d OFFSET %d" % (query, page_size, offset)
+            rows = self._query_tool_stream(statement, port, timeout, query_params)
+            try:
+                for row in rows:
+                    yield row
+            finally:
+                rows.close()
+            if rows.meta.get('errors'):
+                raise CBQError(rows.meta['errors'], self.ip)
+            if not page_size or rows.count < page_size:
+                return
+            offset += rows.count
+
+    def _query_tool_stream(self, statement, port, timeout, query_params):
+        headers = None
+        params = dict(query_params)
+        creds = params.pop('creds', None)
+        if creds:
+            headers = self._create_headers_with_auth(creds[0]['user'].encode('utf-8'),
+                                                     creds[0]['pass'].encode('utf-8'))
+        params['statement'] = statement
+        params = urllib.urlencode(params)
+        log.info('query params : {0}'.format(params))
+        api = "http://%s:%s/query?%s" % (self.ip, port, params)
+        status, response, connection = self._stream_request(api, 'POST', timeout=timeout,
+                                                            headers=headers)
+        if not status:
+            content = response.read()
+            connection.close()
+            raise CBQError(content, self.ip)
+        return JsonRowStream(response, 'results', connection=connection)
+
     def analytics_tool(self, query, port=8095, timeout=650, query_params={}, is_prepared=False, named_prepare=None,
                    verbose = True, encoded_plan=None, servers=None):
         key = 'prepared' if is_prepared else 'statement'
@@ -3215,7 +3454,7 @@ class RestConnection(object):
         prepared = json.dumps(query)
         if is_prepared:
             if named_prepare and encoded_plan:
-                http = httplib2.Http()
+                http = HTTP_POOL
                 if len(servers)>1:
                     url = "http://%s:%s/query/service" % (servers[1].ip, port)
                 else:
@@ -3226,7 +3465,7 @@ class RestConnection(object):
 
                 response, content = http.request(url, 'POST', headers=headers, body=json.dumps(body))
 
-                return eval(content)
+                return json.loads(content)
 
             elif named_prepare and not encoded_plan:
                 params = 'prepared=' + urllib.quote(prepared, '~()')
@@ -3680,7 +3919,7 @@ class RestConnection(object):
         header = {'Content-type': 'application/x-www-form-urlencoded'}
         params = urllib.urlencode({'user':'{0}'.format(user), 'password':'{0}'.format(password)})
         log.info ("value of param is {0}".format(params))
-        http = httplib2.Http()
+        http = HTTP_POOL
         status, content = http.request(api, 'POST', headers=header, body=params)
         log.info ("Status of login command - {0}".format(status))
         if (getContent):
@@ -4379,6 +4618,9 @@ class Bucket(object):
         self.authType = ""
         self.bucket_size = bucket_size
         self.kvs = {1:KVStore()}
+        if TestInputSingleton.input is not None and \
+                TestInputSingleton.input.param("compact_kvstore", False):
+            self.kvs = {1:CompactKVStore()}
         self.authType = authType
         self.master_id = master_id
         self.eviction_policy = eviction_policy
@@ -9,6 +9,7 @@ import crc32
 import socket
 import ctypes
 from membase.api.rest_client import RestConnection, RestHelper
+from membase.helper.stats_waiter import StatsWaiter
 import memcacheConstants
 from memcached.helper.data_helper import MemcachedClientHelper, VBucketAwareMemcached
 from mc_bin_client import MemcachedClient
@@ -262,14 +263,9 @@ class BucketOperationHelper():
     def wait_for_vbuckets_ready_state(node, bucket, timeout_in_seconds=300, log_msg='', admin_user='cbadminbucket',
                                       admin_pass='password'):
         log = logger.Logger.get_logger()
-        start_time = time.time()
-        end_time = start_time + timeout_in_seconds
-        ready_vbuckets = {}
         rest = RestConnection(node)
-        servers = rest.get_nodes()
         RestHelper(rest).vbucket_map_ready(bucket, 60)
         vbucket_count = len(rest.get_vbuckets(bucket))
-        vbuckets = rest.get_vbuckets(bucket)
         obj = VBucketAwareMemcached(rest, bucket)
         memcacheds, vbucket_map, vbucket_map_replica = obj.request_map(rest, bucket)
         #Create dictionary with key:"ip:port" and value: a list of vbuckets
@@ -277,61 +273,30 @@ class BucketOperationHelper():
         for everyID in range(0, vbucket_count):
             memcached_ip_port = str(vbucket_map[everyID])
             server_dict[memcached_ip_port].append(everyID)
-        while time.time() < end_time and len(ready_vbuckets) < vbucket_count:
-            for every_ip_port in server_dict:
-                #Retrieve memcached ip and port
-                ip = every_ip_port.rsplit(":", 1)[0]
-                port = every_ip_port.rsplit(":", 1)[1]
-                client = MemcachedClient(ip, int(port), timeout=30)
-                client.vbucket_count = len(vbuckets)
-                bucket_info = rest.get_bucket(bucket)
-                cluster_compatibility = rest.check_cluster_compatibility("5.0")
-                if cluster_compatibility is None:
-                    pre_spock = True
-                else:
-                    pre_spock = not cluster_compatibility
-                if pre_spock:
-                    log.info("Atleast 1 of the server is on pre-spock "
-                             "version. Using the old ssl auth to connect to "
-                             "bucket.")
-                    client.sasl_auth_plain(
-                    bucket_info.name.encode('ascii'),
-                    bucket_info.saslPassword.encode('ascii'))
-                else:
-                    client.sasl_auth_plain(admin_user, admin_pass)
-                    bucket = bucket.encode('ascii')
-                    client.bucket_select(bucket)
-                for i in server_dict[every_ip_port]:
-                    try:
-                        (a, b, c) = client.get_vbucket_state(i)
-                    except mc_bin_client.MemcachedError as e:
-                        ex_msg = str(e)
-                        if "Not my vbucket" in log_msg:
-                            log_msg = log_msg[:log_msg.find("vBucketMap") + 12] + "..."
-                        if e.status == memcacheConstants.ERR_NOT_MY_VBUCKET:
-                            # May receive this while waiting for vbuckets, continue and retry...S
-                            continue
-                        log.error("%s: %s" % (log_msg, ex_msg))
-                        continue
-                    except exceptions.EOFError:
-                        # The client was disconnected for some reason. This can
-                        # happen just after the bucket REST API is returned (before
-                        # the buckets are created in each of the memcached processes.)
-                        # See here for some details: http://review.couchbase.org/#/c/49781/
-                        # Longer term when we don't disconnect clients in this state we
-                        # should probably remove this code.
-                        log.error("got disconnected from the server, reconnecting")
-                        client.reconnect()
-                        client.sasl_auth_plain(bucket_info.name.encode('ascii'),
-                                               bucket_info.saslPassword.encode('ascii'))
-                        continue
+        ready_vbuckets = set()
 
-                    if c.find("\x01") > 0 or c.find("\x02") > 0:
-                        ready_vbuckets[i] = True
+        def vbuckets_ready(snapshot):
+            # one "stats vbucket" per node gives the state of all its vbuckets
+            for every_ip_port, stats in snapshot.iteritems():
+                for i in server_dict[every_ip_port]:
+                    state = stats.get("vb_%d" % i)
+                    if state in ("active", "replica"):
+                        ready_vbuckets.add(i)
                     elif i in ready_vbuckets:
-                        log.warning("vbucket state changed from active to {0}".format(c))
-                        del ready_vbuckets[i]
-                client.close()
+                        log.warning("vbucket state changed from active to {0}".format(state))
+                        ready_vbuckets.remove(i)
+            return len(ready_vbuckets) == vbucket_count
+
+        waiter = StatsWaiter(rest, bucket, admin_user, admin_pass)
+        try:
+            waiter.wait(lambda: waiter.mc_stats(server_dict.keys(), "vbucket"),
+                        {"vbuckets_ready": vbuckets_ready}, timeout=timeout_in_seconds,
+                        progress=lambda snapshot: len(ready_vbuckets), verbose=False)
+        finally:
+            waiter.close()
+        if len(ready_vbuckets) < vbucket_count:
+            log.error("{0}: {1} of {2} vbuckets ready after {3} seconds".format(
+                log_msg, len(ready_vbuckets), vbucket_count, timeout_in_seconds))
         return len(ready_vbuckets) == vbucket_count
 
     # try to insert key in all vbuckets before returning from this function
@@ -8,6 +8,7 @@ from membase.api.exception import StatsUnavailableException, \
     AddNodeException
 from membase.api.rest_client import RestConnection, RestHelper, Bucket
 from membase.helper.bucket_helper import BucketOperationHelper
+from membase.helper.stats_waiter import StatsWaiter
 from memcached.helper.data_helper import MemcachedClientHelper, VBucketAwareMemcached
 from mc_bin_client import MemcachedClient, MemcachedError
 
@@ -20,59 +21,41 @@ class RebalanceHelper():
     def wait_for_mc_stats_all_nodes(master, bucket, stat_key, stat_value, timeout_in_seconds=120, verbose=True):
         log.info("waiting for bucket {0} stat : {1} to match {2} on {3}".format(bucket, stat_key, \
                                                                                 stat_value, master.ip))
-        time_to_timeout = 0
-        previous_stat_value = -1
-        curr_stat_value = -1
-        verified = False
-        all_stats = {}
-        while not verified:
-            rest = RestConnection(master)
-            nodes = rest.node_statuses()
-            for node in nodes:
-                _server = {"ip": node.ip, "port": node.port, "username": master.rest_username,
-                           "password": master.rest_password}
-                #failed over node is part of node_statuses but since its failed over memcached connections
-                #to this node will fail
-                node_self = RestConnection(_server).get_nodes_self()
-                if node_self.clusterMembership == 'active':
-                    mc = MemcachedClientHelper.direct_client(_server, bucket)
-                    n_stats = mc.stats("")
-                    mc.close()
-                    all_stats[node.id] = n_stats
-            actual_stat_value = -1
-            for k in all_stats:
-                if all_stats[k] and stat_key in all_stats[k]:
-                    if actual_stat_value == -1:
-                        log.info(all_stats[k][stat_key])
-                        actual_stat_value = int(all_stats[k][stat_key])
-                    else:
-                        actual_stat_value += int(all_stats[k][stat_key])
-            if actual_stat_value == stat_value:
-                log.info("{0} : {1}".format(stat_key, actual_stat_value))
-                verified = True
-                break
-            else:
-                if verbose:
-                    log.info("{0} : {1}".format(stat_key, actual_stat_value))
-                curr_stat_value = actual_stat_value
-
-                # values are changing so clear any timeout
-                if curr_stat_value != previous_stat_value:
-                    time_to_timeout = 0
-                else:
-                    if time_to_timeout == 0:
-                        time_to_timeout = time.time() + timeout_in_seconds
-                    if time_to_timeout < time.time():
-                        log.info("no change in {0} stat after {1} seconds (value = {2})".format(stat_key, timeout_in_seconds, curr_stat_value))
-                        break
-
-                previous_stat_value = curr_stat_value
+        return RebalanceHelper.wait_for_mc_stats_sum(master, bucket, {stat_key: stat_value},
+                                                     timeout_in_seconds, verbose)
 
-                if not verbose:
-                    time.sleep(0.1)
-                else:
-                    time.sleep(2)
-        return verified
+    @staticmethod
+    def wait_for_mc_stats_sum(master, bucket, expected, timeout_in_seconds=120, verbose=True):
+        """Waits until each stat_key -> stat_value of expected matches the sum of
+        that memcached stat over the active nodes, all of them at once.
+        Gives up when none of the sums changed for timeout_in_seconds, e.g.
+        while a node does not answer."""
+        rest = RestConnection(master)
+        nodes = ["{0}:{1}".format(node.ip, node.memcached) for node in rest.get_nodes()]
+
+        def stat_sum(snapshot, stat_key):
+            # the sum over the nodes that answered says nothing of the others
+            if len(snapshot) < len(nodes):
+                return -1
+            values = [int(stats[stat_key]) for stats in snapshot.itervalues() if stat_key in stats]
+            if not values:
+                return -1
+            return sum(values)
+
+        conditions = {}
+        for stat_key, stat_value in expected.iteritems():
+            conditions[stat_key] = lambda snapshot, stat_key=stat_key, stat_value=stat_value: \
+                stat_sum(snapshot, stat_key) == stat_value
+        waiter = StatsWaiter(rest, bucket)
+        try:
+            pending = waiter.wait(lambda: waiter.mc_stats(nodes), conditions, timeout=None,
+                                  progress=lambda snapshot: [stat_sum(snapshot, stat_key)
+                                                             for stat_key in sorted(expected)],
+                                  stall_timeout=timeout_in_seconds,
+                                  max_sleep=2 if verbose else 0.1, verbose=verbose)
+        finally:
+            waiter.close()
+        return not pending
 
     @staticmethod
     def wait_for_replication(servers, cluster_helper=None, timeout=600):
@@ -104,48 +87,17 @@ class RebalanceHelper():
     def wait_for_stats(master, bucket, stat_key, stat_value, timeout_in_seconds=120, verbose=True):
         log.info("waiting for bucket {0} stat : {1} to match {2} on {3}".format(bucket, stat_key, \
                                                                                 stat_value, master.ip))
-        time_to_timeout = 0
-        previous_stat_value = -1
-        curr_stat_value = -1
-        verified = False
-        while not verified:
-            rest = RestConnection(master)
-            try:
-                stats = rest.get_bucket_stats(bucket)
-                if stats and stat_key in stats and stats[stat_key] == stat_value:
-                    log.info("{0} : {1}".format(stat_key, stats[stat_key]))
-                    verified = True
-                    break
-                else:
-                    if stats and stat_key in stats:
-                        if verbose:
-                            log.info("{0} : {1}".format(stat_key, stats[stat_key]))
-                        curr_stat_value = stats[stat_key]
-
-                    # values are changing so clear any timeout
-                    if curr_stat_value != previous_stat_value:
-                        time_to_timeout = 0
-                    else:
-                        if time_to_timeout == 0:
-                            time_to_timeout = time.time() + timeout_in_seconds
-                        if time_to_timeout < time.time():
-                            log.info("no change in {0} stat after {1} seconds (value = {2})".format(stat_key, timeout_in_seconds, curr_stat_value))
-                            break
-
-                    previous_stat_value = curr_stat_value
-
-                    if not verbose:
-                        time.sleep(0.1)
-                    else:
-                        time.sleep(2)
-            except:
-                log.info("unable to collect stats from server {0}".format(master))
-                verified = True  #TODO: throw ex and assume caller catches
-                break
-            # wait for 5 seconds for the next check
-            time.sleep(5)
-
-        return verified
+        rest = RestConnection(master)
+        waiter = StatsWaiter(rest, bucket)
+        try:
+            pending = waiter.wait(waiter.bucket_stats,
+                                  {stat_key: lambda stats: stats and stats.get(stat_key) == stat_value},
+                                  timeout=None, progress=lambda stats: (stats or {}).get(stat_key, -1),
+                                  stall_timeout=timeout_in_seconds, verbose=verbose)
+        except Exception:
+            log.info("unable to collect stats from server {0}".format(master))
+            return True  #TODO: throw ex and assume caller catches
+        return not pending
 
     @staticmethod
     def wait_for_stats_no_timeout(master, bucket, stat_key, stat_value, timeout_in_seconds=-1, verbose=True):
@@ -292,17 +244,9 @@ class RebalanceHelper():
 
         if bucket_type == 'ephemeral':
             return True
-        verified = True
-        verified &= RebalanceHelper.wait_for_mc_stats_all_nodes(
-            master, bucket, "ep_queue_size", 0,
-            timeout_in_seconds=timeout)
-        verified &= RebalanceHelper.wait_for_mc_stats_all_nodes(
-            master, bucket, "ep_flusher_todo", 0,
+        return RebalanceHelper.wait_for_mc_stats_sum(
+            master, bucket, {"ep_queue_size": 0, "ep_flusher_todo": 0, "ep_uncommitted_items": 0},
             timeout_in_seconds=timeout)
-        verified &= RebalanceHelper.wait_for_mc_stats_all_nodes(
-            master, bucket, "ep_uncommitted_items", 0,
-            timeout_in_seconds=timeout)
-        return verified
 
     @staticmethod
     #TODO: add password and port
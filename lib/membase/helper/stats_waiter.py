@@ -0,0 +1,133 @@
+import socket
+import time
+import logger
+from mc_bin_client import MemcachedClient, MemcachedError
+from membase.api.rest_client import Bucket
+
+
+class Backoff(object):
+    """Sleep durations growing geometrically from min_sleep up to max_sleep,
+    dropping back to min_sleep on reset()"""
+
+    def __init__(self, min_sleep=0.1, max_sleep=5, factor=1.5):
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.factor = factor
+        self.current = min_sleep
+
+    def reset(self):
+        self.current = self.min_sleep
+
+    def sleep(self, deadline=None):
+        delay = self.current
+        if deadline is not None:
+            delay = max(0, min(delay, deadline - time.time()))
+        time.sleep(delay)
+        self.current = min(self.current * self.factor, self.max_sleep)
+
+
+class StatsWaiter(object):
+    """Waits until a set of conditions holds on bucket stats.
+
+    Each tick fetches one snapshot, e.g. a memcached stats group from every
+    node over connections kept open for the life of the waiter, or the REST
+    bucket stats, and evaluates all the conditions against it. Call close()
+    once done to release the memcached connections.
+    """
+
+    def __init__(self, rest, bucket, admin_user='cbadminbucket', admin_pass='password',
+                 timeout=30):
+        self.rest = rest
+        self.bucket = bucket.name if isinstance(bucket, Bucket) else bucket
+        self.admin_user = admin_user
+        self.admin_pass = admin_pass
+        self.timeout = timeout
+        self.clients = {}
+        self.pre_spock = None
+        self.log = logger.Logger.get_logger()
+
+    def _connect(self, ip_port):
+        ip, port = ip_port.rsplit(":", 1)
+        client = MemcachedClient(ip, int(port), timeout=self.timeout)
+        try:
+            if self.pre_spock is None:
+                cluster_compatibility = self.rest.check_cluster_compatibility("5.0")
+                self.pre_spock = cluster_compatibility is None or not cluster_compatibility
+            if self.pre_spock:
+                bucket_info = self.rest.get_bucket(self.bucket)
+                client.sasl_auth_plain(bucket_info.name.encode('ascii'),
+                                       bucket_info.saslPassword.encode('ascii'))
+            else:
+                client.sasl_auth_plain(self.admin_user, self.admin_pass)
+                client.bucket_select(self.bucket.encode('ascii'))
+        except:
+            client.close()
+            raise
+        return client
+
+    def _disconnect(self, ip_port):
+        client = self.clients.pop(ip_port, None)
+        if client is not None:
+            client.close()
+
+    def mc_stats(self, nodes, group=''):
+        """Returns {ip:port: stats} with one stats group of every node that
+        answered, nodes that did not are reconnected on the next call"""
+        snapshot = {}
+        for ip_port in nodes:
+            try:
+                client = self.clients.get(ip_port)
+                if client is None:
+                    client = self.clients[ip_port] = self._connect(ip_port)
+                snapshot[ip_port] = client.stats(group)
+            except (MemcachedError, EOFError, socket.error), e:
+                self.log.info("unable to get {0} stats of bucket {1} from {2}: {3}"
+                              .format(group or "default", self.bucket, ip_port, e))
+                self._disconnect(ip_port)
+        return snapshot
+
+    def bucket_stats(self):
+        return self.rest.get_bucket_stats(self.bucket)
+
+    def wait(self, fetch, conditions, timeout=120, progress=None, stall_timeout=None,
+             min_sleep=0.1, max_sleep=5, verbose=True):
+        """Calls fetch() once per tick and evaluates conditions, a dict of
+        name -> predicate(snapshot), against its result until all of them hold.
+
+        progress(snapshot) returns the values the conditions are waiting on:
+        the sleep between ticks grows while they stay the same and drops back
+        whenever they change, and with stall_timeout the wait gives up once
+        they have not changed for that long. timeout=None waits until a stall.
+        Returns the names of the conditions that did not hold, empty on success.
+        """
+        backoff = Backoff(min_sleep, max_sleep)
+        deadline = None if timeout is None else time.time() + timeout
+        last_value = None
+        last_change = time.time()
+        first = True
+        while True:
+            snapshot = fetch()
+            pending = [name for name in sorted(conditions) if not conditions[name](snapshot)]
+            value = None if progress is None else progress(snapshot)
+            changed = first or value != last_value
+            first = False
+            if verbose and progress is not None and changed:
+                self.log.info("{0} : {1}".format(", ".join(sorted(conditions)), value))
+            if not pending:
+                return pending
+            now = time.time()
+            if changed:
+                last_value = value
+                last_change = now
+                backoff.reset()
+            elif stall_timeout is not None and now - last_change >= stall_timeout:
+                self.log.info("no change in {0} after {1} seconds (value = {2})"
+                              .format(", ".join(pending), stall_timeout, last_value))
+                return pending
+            if deadline is not None and now >= deadline:
+                return pending
+            backoff.sleep(deadline)
+
+    def close(self):
+        for ip_port in self.clients.keys():
+            self._disconnect(ip_port)
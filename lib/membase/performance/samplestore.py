@@ -0,0 +1,207 @@
+import json
+import math
+import struct
+import zlib
+from array import array
+from threading import Lock
+
+
+FRAME_HEADER = ">II"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+
+# column kinds: python ints, floats, ints that came in as strings
+# (memcached stats), and anything else as a json list
+INT, FLOAT, INT_STR, JSON = "i", "d", "s", "j"
+
+
+def _column_kind(values):
+    kind = None
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            return JSON
+        elif isinstance(value, (int, long)) and -2 ** 63 <= value < 2 ** 63:
+            value_kind = INT
+        elif isinstance(value, float):
+            value_kind = FLOAT
+        elif isinstance(value, basestring) and value.isdigit() and \
+                len(value) < 19 and str(int(value)) == value:
+            value_kind = INT_STR
+        else:
+            return JSON
+        if kind is None or kind == value_kind:
+            kind = value_kind
+        elif set([kind, value_kind]) == set([INT, FLOAT]):
+            kind = FLOAT
+        else:
+            return JSON
+    return kind or JSON
+
+
+class SampleStore(object):
+    """Append-only, columnar time-series file for stats snapshots.
+
+    Samples are flat dicts grouped in named series. Each series buffers up to
+    chunk_size samples, then writes them as one zlib compressed frame with a
+    typed array per key, so memory use does not grow with the length of the
+    run. Use SampleReader to read the file back.
+    """
+
+    def __init__(self, path, chunk_size=512):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.file = open(path, 'wb')
+        self.buffers = {}
+        self.lock = Lock()
+
+    def append(self, series, sample):
+        with self.lock:
+            buf = self.buffers.setdefault(series, [])
+            buf.append(sample)
+            if len(buf) >= self.chunk_size:
+                self._write_chunk(series, buf)
+                self.buffers[series] = []
+
+    def flush(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            for series, buf in self.buffers.iteritems():
+                if buf:
+                    self._write_chunk(series, buf)
+            self.buffers = {}
+            self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def _write_chunk(self, series, samples):
+        keys = []
+        seen = set()
+        for sample in samples:
+            for key in sample:
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+        columns = []
+        blobs = []
+        offset = 0
+        for key in keys:
+            values = [sample.get(key) for sample in samples]
+            present = bytearray(value is not None for value in values)
+            kind = _column_kind(values)
+            if kind == JSON:
+                data = json.dumps(values)
+            elif kind == FLOAT:
+                data = array('d', (0.0 if v is None else float(v)
+                                   for v in values)).tostring()
+            else:
+                data = struct.pack("<%dq" % len(values),
+                                   *(0 if v is None else int(v) for v in values))
+            mask = '' if all(present) else str(present)
+            columns.append({"key": key, "kind": kind, "offset": offset,
+                            "size": len(data), "mask": len(mask)})
+            blobs.append(data)
+            blobs.append(mask)
+            offset += len(data) + len(mask)
+        meta = zlib.compress(json.dumps({"series": series,
+                                         "rows": len(samples),
+                                         "columns": columns}))
+        blob = zlib.compress("".join(blobs))
+        self.file.write(struct.pack(FRAME_HEADER, len(meta), len(blob)))
+        self.file.write(meta)
+        self.file.write(blob)
+
+
+class SampleReader(object):
+    """Streams samples back out of a SampleStore file one chunk at a time"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _frames(self, series=None):
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(FRAME_HEADER_SIZE)
+                if len(header) < FRAME_HEADER_SIZE:
+                    return
+                meta_size, blob_size = struct.unpack(FRAME_HEADER, header)
+                meta = json.loads(zlib.decompress(f.read(meta_size)))
+                if series is not None and meta["series"] != series:
+                    f.seek(blob_size, 1)
+                    continue
+                yield meta, zlib.decompress(f.read(blob_size))
+
+    def _column(self, meta, blob, column):
+        data = blob[column["offset"]:column["offset"] + column["size"]]
+        if column["kind"] == JSON:
+            values = json.loads(data)
+        elif column["kind"] == FLOAT:
+            values = array('d')
+            values.fromstring(data)
+            values = values.tolist()
+        else:
+            values = struct.unpack("<%dq" % meta["rows"], data)
+            if column["kind"] == INT_STR:
+                values = [str(v) for v in values]
+        if column["mask"]:
+            start = column["offset"] + column["size"]
+            mask = bytearray(blob[start:start + column["mask"]])
+            values = [v if present else None for v, present in zip(values, mask)]
+        return values
+
+    def series(self):
+        names = []
+        for meta, _ in self._frames():
+            if meta["series"] not in names:
+                names.append(meta["series"])
+        return names
+
+    def samples(self, series):
+        """Yields the samples of a series as dicts, in insertion order"""
+        for meta, blob in self._frames(series):
+            keys = [column["key"] for column in meta["columns"]]
+            columns = [self._column(meta, blob, column) for column in meta["columns"]]
+            for row in xrange(meta["rows"]):
+                yield dict((key, values[row]) for key, values in zip(keys, columns)
+                           if values[row] is not None)
+
+    def values(self, series, key):
+        """Yields the numeric values of one key, skipping missing ones"""
+        for meta, blob in self._frames(series):
+            for column in meta["columns"]:
+                if column["key"] == key:
+                    for value in self._column(meta, blob, column):
+                        try:
+                            yield float(value)
+                        except (TypeError, ValueError):
+                            pass
+
+    def summary(self, series, key, percentiles=(0.5, 0.9, 0.95, 0.99), precision=3):
+        """count/min/max/mean and approximate percentiles of one key, using a
+        histogram with the given number of significant digits"""
+        count = 0
+        total = 0.0
+        low = high = None
+        histo = {}
+        for value in self.values(series, key):
+            count += 1
+            total += value
+            low = value if low is None else min(low, value)
+            high = value if high is None else max(high, value)
+            if value:
+                p = 10 ** (math.floor(math.log10(abs(value))) - (precision - 1))
+                value = round(value / p) * p
+            histo[value] = histo.get(value, 0) + 1
+        result = {"count": count, "min": low, "max": high,
+                  "mean": count and total / count or None}
+        running = 0
+        pending = sorted(percentiles)
+        for bucket in sorted(histo):
+            running += histo[bucket]
+            while pending and running >= pending[0] * count:
+                result["p%g" % (pending.pop(0) * 100)] = bucket
+        return result
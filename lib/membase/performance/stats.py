@@ -1,5 +1,7 @@
 import json
+import os
 import re
+import tempfile
 from threading import Thread
 import time
 import gzip
@@ -13,6 +15,7 @@ from lib.membase.api.exception import SetViewInfoNotFound, ServerUnavailableExce
 from lib.membase.api.rest_client import RestConnection
 from lib.memcached.helper.data_helper import MemcachedClientHelper, VBucketAwareMemcached
 from lib.remote.remote_util import RemoteMachineShellConnection, RemoteMachineHelper
+from lib.membase.performance.samplestore import SampleStore, SampleReader
 
 
 RETRIES = 10
@@ -45,6 +48,63 @@ def histo_percentile(histo, percentiles):
     return rv
 
 
+PROC_STAT_FIELDS = (
+    'pid', 'comm', 'state', 'ppid', 'pgrp', 'session', 'tty_nr',
+    'tpgid', 'flags', 'minflt', 'cminflt', 'majflt', 'cmajflt',
+    'utime', 'stime', 'cutime', 'cstime', 'priority ' 'nice',
+    'num_threads', 'itrealvalue', 'starttime', 'vsize', 'rss',
+    'rsslim', 'startcode', 'endcode', 'startstack', 'kstkesp',
+    'kstkeip', 'signal', 'blocked ', 'sigignore', 'sigcatch', 'wchan',
+    'nswap', 'cnswap', 'exit_signal', 'processor', 'rt_priority',
+    'policy', 'delayacct_blkio_ticks', 'guest_time', 'cguest_time')
+
+
+class ProcStatSampler(Thread):
+    """Samples /proc/<pid>/stat of the given processes on one node.
+
+    A single shell loop is started over the node's ssh session and prints
+    one line per process every interval seconds; this thread parses the
+    lines and passes (pname, pid, stat) to callback. That replaces an ssh
+    exec of ps and of cat per process per interval.
+    """
+
+    # process names are read from stdin so that pgrep -f does not match
+    # the sampler's own command line
+    SCRIPT = 'read -r names; while true; do ' \
+             'for p in $names; do ' \
+             'pid=$(pgrep -o -x "$p" || pgrep -o -f "$p"); ' \
+             '[ -n "$pid" ] && echo "$p $(cat /proc/$pid/stat)"; ' \
+             'done; sleep {0}; done'
+
+    def __init__(self, shell, pnames, interval, callback):
+        super(ProcStatSampler, self).__init__(name="proc_stat_" + shell.ip)
+        self.daemon = True
+        self.shell = shell
+        self.pnames = pnames
+        self.interval = interval
+        self.callback = callback
+        self.channel = None
+
+    def run(self):
+        try:
+            self.channel = self.shell._ssh_client.get_transport().open_session()
+            self.channel.exec_command(self.SCRIPT.format(self.interval))
+            self.channel.sendall(" ".join(self.pnames) + "\n")
+            for line in self.channel.makefile('r'):
+                pname, _, stat = line.strip().partition(' ')
+                if stat:
+                    value = dict(zip(PROC_STAT_FIELDS, stat.split(' ')))
+                    self.callback(pname, value.get('pid'), value)
+        except Exception, error:
+            log.error("proc stat sampling on {0} stopped: {1}"
+                      .format(self.shell.ip, error))
+
+    def stop(self):
+        if self.channel is not None:
+            self.channel.close()
+        self.join(self.interval + 5)
+
+
 class StatsCollector(object):
     _task = {}
     _verbosity = True
@@ -52,6 +112,8 @@ class StatsCollector(object):
     _reb_stats = {}
     _lat_avg_stats = {}     # aggregated top level latency stats
     _xdcr_stats = {}
+    STORED_SERIES = ("membasestats", "timings", "dispatcher", "systemstats",
+                     "iostats", "ns_server_stats", "ns_server_stats_system")
 
     def __init__(self, verbosity):
         self._verbosity = verbosity
@@ -65,6 +127,12 @@ class StatsCollector(object):
         self._task = {"state": "running", "threads": [], "name": name,
                       "time": time.time(), "ops": [], "totalops": [],
                       "ops-temp": [], "latency": {}, "data_size_stats": []}
+        # server side samples are streamed to a temporary file instead of
+        # kept in memory, export() removes it
+        fd, path = tempfile.mkstemp(prefix="{0}-".format(re.sub(r"[^\w.-]", "_", name)),
+                                    suffix=".samples")
+        os.close(fd)
+        self.store = SampleStore(path)
         rest = RestConnection(nodes[0])
         info = rest.get_nodes_self()
         self.data_path = info.storage[0].get_data_path()
@@ -124,6 +192,22 @@ class StatsCollector(object):
                 log.error("failed to join {0} thread".format(t.name))
 
         self._task["time"] = time.time() - self._task["time"]
+        self.store.close()
+
+    def samples(self, series):
+        """Streams the samples of one of the server stats series, e.g.
+        membasestats, systemstats, iostats or ns_server_stats"""
+        if series == "membasestats" and self._mb_stats["snapshots"]:
+            return iter(self._mb_stats["snapshots"])
+        if series in self.STORED_SERIES:
+            self.store.flush()
+            return SampleReader(self.store.path).samples(series)
+        return iter(self._task.get(series, []))
+
+    def summary(self, series, key, percentiles=(0.5, 0.9, 0.95, 0.99)):
+        """Aggregates and percentiles of one metric of a stored series"""
+        self.store.flush()
+        return SampleReader(self.store.path).summary(series, key, percentiles)
 
     def sample(self, cur):
         pass
@@ -187,22 +271,22 @@ class StatsCollector(object):
         obj = {
             "buildinfo": self._task.get("buildstats", {}),
             "machineinfo": self._task.get("machinestats", {}),
-            "membasestats": self._task.get("membasestats", []),
-            "systemstats": self._task.get("systemstats", []),
-            "iostats": self._task.get("iostats", []),
+            "membasestats": self.samples("membasestats"),
+            "systemstats": self.samples("systemstats"),
+            "iostats": self.samples("iostats"),
             "name": name,
             "totalops": self._task["totalops"],
             "ops": self._task["ops"],
             "time": self._task["time"],
             "info": test_params,
-            "ns_server_data": self._task.get("ns_server_stats", []),
-            "ns_server_data_system": self._task.get("ns_server_stats_system", []),
+            "ns_server_data": self.samples("ns_server_stats"),
+            "ns_server_data_system": self.samples("ns_server_stats_system"),
             "view_info": self._task.get("view_info", []),
             "indexer_info": self._task.get("indexer_info", []),
             "xdcr_lag": self._task.get("xdcr_lag", []),
             "rebalance_progress": self._task.get("rebalance_progress", []),
-            "timings": self._task.get("timings", []),
-            "dispatcher": self._task.get("dispatcher", []),
+            "timings": self.samples("timings"),
+            "dispatcher": self.samples("dispatcher"),
             "bucket-size": self._task.get("bucket_size", []),
             "data-size": self._task.get("data_size_stats", []),
             "latency-set-histogram": self._task["latency"].get("latency-set-histogram", []),
@@ -249,8 +333,30 @@ class StatsCollector(object):
             name = str(self.client_id) + phase
 
         file = gzip.open("{0}.json.gz".format(name), 'wb')
-        file.write(json.dumps(obj))
+        self._dump(obj, file)
         file.close()
+        self.discard()
+
+    def discard(self):
+        """Removes the stored samples once they are no longer needed"""
+        self.store.close()
+        if os.path.exists(self.store.path):
+            os.remove(self.store.path)
+
+    def _dump(self, obj, file):
+        """json.dump() that writes generators as lists one item at a time,
+        so stored series never have to fit in memory"""
+        file.write("{")
+        for i, (key, value) in enumerate(obj.iteritems()):
+            file.write("%s%s: " % (i and ", " or "", json.dumps(key)))
+            if hasattr(value, "next"):
+                file.write("[")
+                for j, item in enumerate(value):
+                    file.write("%s%s" % (j and ", " or "", json.dumps(item)))
+                file.write("]")
+            else:
+                file.write(json.dumps(value))
+        file.write("}")
 
     def get_bucket_size(self, interval=60):
         self._task["bucket_size"] = []
@@ -394,17 +500,7 @@ class StatsCollector(object):
 
     def _extract_proc_info(self, shell, pid):
         output, error = shell.execute_command("cat /proc/{0}/stat".format(pid))
-        fields = (
-            'pid', 'comm', 'state', 'ppid', 'pgrp', 'session', 'tty_nr',
-            'tpgid', 'flags', 'minflt', 'cminflt', 'majflt', 'cmajflt',
-            'utime', 'stime', 'cutime', 'cstime', 'priority ' 'nice',
-            'num_threads', 'itrealvalue', 'starttime', 'vsize', 'rss',
-            'rsslim', 'startcode', 'endcode', 'startstack', 'kstkesp',
-            'kstkeip', 'signal', 'blocked ', 'sigignore', 'sigcatch', 'wchan',
-            'nswap', 'cnswap', 'exit_signal', 'processor', 'rt_priority',
-            'policy', 'delayacct_blkio_ticks', 'guest_time', 'cguest_time')
-
-        return {} if error else dict(zip(fields, output[0].split(' ')))
+        return {} if error else dict(zip(PROC_STAT_FIELDS, output[0].split(' ')))
 
     def _extract_io_info(self, shell):
         """
@@ -434,35 +530,32 @@ class StatsCollector(object):
         return results.split(' ')
 
     def system_stats(self, pnames, interval=10):
-        shells = []
+        start_time = str(self._task["time"])
+        samplers = []
         for node in self.nodes:
             try:
-                shells.append(RemoteMachineShellConnection(node))
+                shell = RemoteMachineShellConnection(node)
             except Exception, error:
                 log.error(error)
-        d = {"snapshots": []}
-        #        "pname":"x","pid":"y","snapshots":[{"time":time,"value":value}]
+                continue
+            if shell.extract_remote_info().type.lower() == 'windows':
+                continue
 
-        start_time = str(self._task["time"])
+            def callback(pname, pid, value, ip=node.ip):
+                value["name"] = pname
+                value["id"] = pid
+                value["unique_id"] = ip + '-' + start_time
+                value["time"] = time.time()
+                value["ip"] = ip
+                self.store.append("systemstats", value)
+            samplers.append(ProcStatSampler(shell, pnames, interval, callback))
+
+        for sampler in samplers:
+            sampler.start()
         while not self._aborted():
-            time.sleep(interval)
-            current_time = time.time()
-            i = 0
-            for shell in shells:
-                node = self.nodes[i]
-                unique_id = node.ip + '-' + start_time
-                for pname in pnames:
-                    obj = RemoteMachineHelper(shell).is_process_running(pname)
-                    if obj and obj.pid:
-                        value = self._extract_proc_info(shell, obj.pid)
-                        value["name"] = pname
-                        value["id"] = obj.pid
-                        value["unique_id"] = unique_id
-                        value["time"] = current_time
-                        value["ip"] = node.ip
-                        d["snapshots"].append(value)
-                i += 1
-        self._task["systemstats"] = d["snapshots"]
+            time.sleep(1)
+        for sampler in samplers:
+            sampler.stop()
         log.info("finished system_stats")
 
     def iostats(self, interval=10):
@@ -473,8 +566,6 @@ class StatsCollector(object):
             except Exception, error:
                 log.error(error)
 
-        self._task["iostats"] = []
-
         log.info("started capturing io stats")
 
         while not self._aborted():
@@ -487,13 +578,13 @@ class StatsCollector(object):
                 except (ValueError, TypeError, IndexError):
                     continue
                 if kB_read and kB_wrtn:
-                    self._task["iostats"].append({"time": time.time(),
-                                                 "ip": shell.ip,
-                                                 "read": kB_read,
-                                                 "write": kB_wrtn,
-                                                 "util": util,
-                                                 "iowait": iowait,
-                                                 "idle": idle})
+                    self.store.append("iostats", {"time": time.time(),
+                                                  "ip": shell.ip,
+                                                  "read": kB_read,
+                                                  "write": kB_wrtn,
+                                                  "util": util,
+                                                  "iowait": iowait,
+                                                  "idle": idle})
         log.info("finished capturing io stats")
 
     def capture_mb_snapshot(self, node):
@@ -527,12 +618,7 @@ class StatsCollector(object):
                 mcs.append(mc)
             except Exception, error:
                 log.error(error)
-        self._task["membasestats"] = []
-        self._task["timings"] = []
-        self._task["dispatcher"] = []
-        data = dict()
-        for mc in mcs:
-            data[mc.host] = {"snapshots": [], "timings": [], "dispatcher": []}
+        latest_timings = {}
 
         while not self._aborted():
             time.sleep(interval)
@@ -549,53 +635,33 @@ class StatsCollector(object):
                         break
                 else:
                     stats = {}
-                data[mc.host]["snapshots"].append(stats)
+                self._append_mc_sample("membasestats", mc.host, stats)
 
                 for arg in ("timings", "dispatcher"):
                     try:
                         stats = mc.stats(arg)
-                        data[mc.host][arg].append(stats)
+                        self._append_mc_sample(arg, mc.host, stats)
+                        if arg == "timings":
+                            latest_timings[mc.host] = stats
                     except EOFError, e:
                         log.error("unable to get {0} stats {1}: {2}"
                                   .format(arg, mc.host, e))
 
-        for host in (mc.host for mc in mcs):
-            unique_id = host + '-' + str(self._task["time"])
-            current_time = time.time()
-
-            if self._mb_stats["snapshots"]:  # use manually captured stats
-                self._task["membasestats"] = self._mb_stats["snapshots"]
-            else:  # use periodically captured stats
-                for snapshot in data[host]["snapshots"]:
-                    snapshot["unique_id"] = unique_id
-                    snapshot["time"] = current_time
-                    snapshot["ip"] = host
-                    self._task["membasestats"].append(snapshot)
-
-            for timing in data[host]["timings"]:
-                timing["unique_id"] = unique_id
-                timing["time"] = current_time
-                timing["ip"] = host
-                self._task["timings"].append(timing)
-
-            for dispatcher in data[host]["dispatcher"]:
-                dispatcher["unique_id"] = unique_id
-                dispatcher["time"] = current_time
-                dispatcher["ip"] = host
-                self._task["dispatcher"].append(dispatcher)
-
-            if data[host]["timings"]:
-                log.info("dumping disk timing stats: {0}".format(host))
-                latests_timings = data[host]["timings"][-1]
-                for key, value in sorted(latests_timings.iteritems()):
-                    if key.startswith("disk"):
-                        print "{0:50s}: {1}".format(key, value)
+        for host, timings in latest_timings.iteritems():
+            log.info("dumping disk timing stats: {0}".format(host))
+            for key, value in sorted(timings.iteritems()):
+                if key.startswith("disk"):
+                    print "{0:50s}: {1}".format(key, value)
 
         log.info("finished membase_stats")
 
+    def _append_mc_sample(self, series, host, stats):
+        stats["unique_id"] = host + '-' + str(self._task["time"])
+        stats["time"] = time.time()
+        stats["ip"] = host
+        self.store.append(series, stats)
+
     def ns_server_stats(self, interval=60):
-        self._task["ns_server_stats"] = []
-        self._task["ns_server_stats_system"] = []
         nodes_iterator = (node for node in self.nodes)
         node = nodes_iterator.next()
         retries = 0
@@ -610,10 +676,10 @@ class StatsCollector(object):
                 ns_server_stats = rest.fetch_bucket_stats(bucket=self.bucket)
                 for key, value in ns_server_stats["op"]["samples"].iteritems():
                     ns_server_stats["op"]["samples"][key] = not_null(value)
-                self._task["ns_server_stats"].append(ns_server_stats)
+                self.store.append("ns_server_stats", ns_server_stats)
                 # System stats
                 ns_server_stats_system = rest.fetch_system_stats()
-                self._task["ns_server_stats_system"].append(ns_server_stats_system)
+                self.store.append("ns_server_stats_system", ns_server_stats_system)
             except ServerUnavailableException, e:
                 log.error(e)
             except (ValueError, TypeError), e:
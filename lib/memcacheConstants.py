@@ -21,8 +21,13 @@ CMD_GETQ = 9
 CMD_NOOP = 10
 CMD_VERSION = 11
 CMD_STAT = 0x10
+CMD_GETK = 0x0c
+CMD_GETKQ = 0x0d
 CMD_APPEND = 0x0e
 CMD_PREPEND = 0x0f
+CMD_ADDQ = 0x12
+CMD_REPLACEQ = 0x13
+CMD_DELETEQ = 0x14
 CMD_TOUCH = 0x1c
 CMD_GAT = 0x1d
 CMD_HELLO = 0x1f
@@ -745,6 +745,120 @@ class WorkerThread(threading.Thread):
         return self.aborted or len(self._rejected_keys) > self.ignore_how_many_errors
 
 
+class VBucketTopology(object):
+    """Vbucket map and kv node list of a bucket, built from the terse bucket
+    config (pools/default/b/<bucket>) and shared by every VBucketAwareMemcached
+    talking to the same cluster and bucket.
+
+    A refresh is a single REST call; the maps are only rebuilt when the
+    config revision (or the bucket uuid) changed, and configs received with
+    NOT_MY_VBUCKET errors are applied the same way without any REST call.
+    """
+
+    _topologies = {}
+    _topologies_lock = threading.Lock()
+
+    @staticmethod
+    def get(rest, bucket):
+        if isinstance(bucket, Bucket):
+            bucket = bucket.name
+        key = (rest.ip, rest.port, bucket)
+        with VBucketTopology._topologies_lock:
+            if key not in VBucketTopology._topologies:
+                VBucketTopology._topologies[key] = VBucketTopology(rest, bucket)
+            return VBucketTopology._topologies[key]
+
+    def __init__(self, rest, bucket):
+        self.log = logger.Logger.get_logger()
+        self.rest = rest
+        self.bucket = bucket
+        self.rev = None
+        self.uuid = None
+        self.vbucket_map = []
+        self.vbucket_map_replica = []
+        self.vbucket_map_forward = None
+        self.rest_ports = {}
+        self.lock = threading.Lock()
+
+    def refresh(self, config=None, timeout_in_seconds=60):
+        """Applies config, or the bucket config fetched from the cluster,
+        if it is newer than the current one. Returns True if the maps changed."""
+        if config is None:
+            config = self._fetch_config(timeout_in_seconds)
+        with self.lock:
+            if self.vbucket_map and config.get("uuid") == self.uuid and \
+                    config.get("rev") is not None and config.get("rev") <= self.rev:
+                return False
+            self._apply(config)
+            return True
+
+    def _fetch_config(self, timeout_in_seconds):
+        end_time = time.time() + timeout_in_seconds
+        while True:
+            config = self.rest.get_bucket_CCCP(self.bucket)
+            if config and config.get("vBucketServerMap", {}).get("vBucketMap"):
+                return config
+            if time.time() > end_time:
+                raise Exception("vbucket map is not ready for bucket {0}".format(self.bucket))
+            time.sleep(0.5)
+
+    def _host(self, hostname):
+        return hostname.replace("$HOST", str(self.rest.ip))
+
+    def _apply(self, config):
+        server_map = config["vBucketServerMap"]
+        servers = [self._host(server) for server in server_map["serverList"]]
+
+        def build(vbucket_map):
+            return [servers[chain[0]] if chain and chain[0] >= 0 else None for chain in vbucket_map], \
+                   [[servers[i] for i in chain[1:] if i != -1] for chain in vbucket_map]
+
+        self.vbucket_map, self.vbucket_map_replica = build(server_map["vBucketMap"])
+        self.vbucket_map_forward = None
+        if "vBucketMapForward" in server_map:
+            self.vbucket_map_forward = build(server_map["vBucketMapForward"])
+        rest_ports = dict(self.rest_ports)
+        for node in config.get("nodes", []):
+            if "ports" not in node or "direct" not in node["ports"]:
+                continue
+            host = self._host(str(node["hostname"]))
+            ip, port = host.rsplit(":", 1)
+            rest_ports["{0}:{1}".format(ip, node["ports"]["direct"])] = int(port)
+            if ip == "127.0.0.1":
+                rest_ports["{0}:{1}".format(self.rest.ip, node["ports"]["direct"])] = int(port)
+        self.rest_ports = rest_ports
+        self.rev = config.get("rev")
+        self.uuid = config.get("uuid")
+
+    def rest_port(self, server_str):
+        """Returns the REST port of the node serving kv at server_str"""
+        if server_str not in self.rest_ports:
+            self.refresh()
+        return self.rest_ports.get(server_str)
+
+    def servers(self):
+        servers = set(self.vbucket_map)
+        for replicas in self.vbucket_map_replica:
+            servers.update(replicas)
+        servers.discard(None)
+        return servers
+
+    def vbuckets(self, forward=False):
+        """Returns the map as a list of vBucket, the forward map during
+        rebalance if forward is set"""
+        masters, replicas = self.vbucket_map, self.vbucket_map_replica
+        if forward and self.vbucket_map_forward:
+            masters, replicas = self.vbucket_map_forward
+        vbuckets = []
+        for vb_id, master in enumerate(masters):
+            vbucket_info = vBucket()
+            vbucket_info.id = vb_id
+            vbucket_info.master = master
+            vbucket_info.replica = list(replicas[vb_id])
+            vbuckets.append(vbucket_info)
+        return vbuckets
+
+
 class VBucketAwareMemcached(object):
     def __init__(self, rest, bucket, info=None):
         self.log = logger.Logger.get_logger()
@@ -768,77 +882,53 @@ class VBucketAwareMemcached(object):
 
     def reset_vbuckets(self, rest, vbucketids_set, forward_map=None, admin_user='cbadminbucket',admin_pass='password'):
         if not forward_map:
-            forward_map = rest.get_bucket(self.bucket, num_attempt=2).forward_map
-            if not forward_map:
-                self.reset(rest)
-                forward_map = rest.get_vbuckets(self.bucket)
-        nodes = rest.get_nodes()
+            self.topology.refresh()
+            forward_map = self.topology.vbuckets(forward=True)
         for vBucket in forward_map:
             if vBucket.id in vbucketids_set:
                 self.vBucketMap[vBucket.id] = vBucket.master
-                masterIp = vBucket.master.rsplit(":", 1)[0]
-                masterPort = int(vBucket.master.rsplit(":", 1)[1])
-                if self.vBucketMap[vBucket.id] not in self.memcacheds:
-                    server = TestInputServer()
-                    server.rest_username = rest.username
-                    server.rest_password = rest.password
-                    for node in nodes:
-                        if node.ip == masterIp and node.memcached == masterPort:
-                            server.port = node.port
-                    server.ip = masterIp
+                if vBucket.master not in self.memcacheds:
                     self.log.info("Received forward map, reset vbucket map, new direct_client")
-                    self.memcacheds[vBucket.master] = MemcachedClientHelper.direct_client(server, self.bucket,
-                                                                    admin_user=admin_user,admin_pass=admin_pass)
-                # if no one is using that memcached connection anymore just close the connection
-                used_nodes = set([self.vBucketMap[vb_name] for vb_name in self.vBucketMap])
-                rm_clients = []
-                for memcache_con in self.memcacheds:
-                    if memcache_con not in used_nodes:
-                        rm_clients.append(memcache_con)
-                for rm_cl in rm_clients:
-                    self.memcacheds[rm_cl].close()
-                    del self.memcacheds[rm_cl]
+                    self.add_memcached(vBucket.master, self.memcacheds, rest, self.bucket,
+                                       admin_user=admin_user, admin_pass=admin_pass)
                 self.vBucketMapReplica[vBucket.id] = vBucket.replica
                 for replica in vBucket.replica:
                     self.add_memcached(replica, self.memcacheds, self.rest, self.bucket)
+        # if no one is using that memcached connection anymore just close the connection
+        used_nodes = set(self.vBucketMap.values())
+        for replicas in self.vBucketMapReplica.values():
+            used_nodes.update(replicas)
+        for rm_cl in [memcache_con for memcache_con in self.memcacheds if memcache_con not in used_nodes]:
+            self.memcacheds[rm_cl].close()
+            del self.memcacheds[rm_cl]
         return True
 
     def request_map(self, rest, bucket):
         memcacheds = {}
-        vBucketMap = {}
-        vBucketMapReplica = {}
-        vb_ready = RestHelper(rest).vbucket_map_ready(bucket, 60)
-        if not vb_ready:
-            raise Exception("vbucket map is not ready for bucket {0}".format(bucket))
-        vBuckets = rest.get_vbuckets(bucket)
-        for vBucket in vBuckets:
-            vBucketMap[vBucket.id] = vBucket.master
-            self.add_memcached(vBucket.master, memcacheds, rest, bucket)
-
-            vBucketMapReplica[vBucket.id] = vBucket.replica
-            for replica in vBucket.replica:
-                self.add_memcached(replica, memcacheds, rest, bucket)
+        self.topology = VBucketTopology.get(rest, bucket)
+        self.topology.refresh()
+        vBucketMap = dict(enumerate(self.topology.vbucket_map))
+        vBucketMapReplica = dict((vb_id, list(replicas))
+                                 for vb_id, replicas in enumerate(self.topology.vbucket_map_replica))
+        for server_str in self.topology.servers():
+            self.add_memcached(server_str, memcacheds, rest, bucket)
         return memcacheds, vBucketMap, vBucketMapReplica
 
     def add_memcached(self, server_str, memcacheds, rest, bucket, admin_user='cbadminbucket', admin_pass='password'):
         if not server_str in memcacheds:
             serverIp = server_str.rsplit(":", 1)[0]
-            serverPort = int(server_str.rsplit(":", 1)[1])
-            nodes = rest.get_nodes()
+            rest_port = self.topology.rest_port(server_str)
+            if rest_port is None:
+                return
             server = TestInputServer()
             server.ip = serverIp
-            server.port = rest.port
+            server.port = rest_port
             server.rest_username = rest.username
             server.rest_password = rest.password
             try:
-                for node in nodes:
-                    if node.ip == serverIp and node.memcached == serverPort:
-                        if server_str not in memcacheds:
-                            server.port = node.port
-                            memcacheds[server_str] = \
-                                MemcachedClientHelper.direct_client(server, bucket, admin_user=admin_user,
-                                                                    admin_pass=admin_pass)
-                        break
+                memcacheds[server_str] = \
+                    MemcachedClientHelper.direct_client(server, bucket, admin_user=admin_user,
+                                                        admin_pass=admin_pass)
             except Exception as ex:
                 msg = "unable to establish connection to {0}. cleanup open connections"
                 self.log.warn(msg.format(serverIp))
@@ -1348,6 +1438,10 @@ class VBucketAwareMemcached(object):
         except:
             self.log.error("Error while getting CCCP from not_my_vbucket...\n %s" % error_msg)
             return None
+        try:
+            self.topology.refresh(error_json)
+        except (KeyError, TypeError, IndexError):
+            self.log.error("Could not apply CCCP from not_my_vbucket to the vbucket topology")
         if 'vBucketMapForward' in error_json['vBucketServerMap']:
             vBucketMap = error_json['vBucketServerMap']['vBucketMapForward']
         else:
@@ -3,6 +3,8 @@ import random
 import zlib
 import time
 import copy
+import array
+import heapq
 
 class KVStore(object):
     def __init__(self, num_locks=16):
@@ -74,6 +76,34 @@ class KVStore(object):
             self.cache[itr]["lock"].release()
         return valid_keys, deleted_keys
 
+    def valid_items(self):
+        """
+        yields (key, value, flag) for every valid key, taking each partition
+        lock only while that partition is read
+        """
+        for itr in range(self.num_locks):
+            self.cache[itr]["lock"].acquire()
+            try:
+                partition = self.cache[itr]["partition"]
+                items = [(key, partition.get_valid(key), partition.get_flag(key))
+                         for key in partition.valid_key_set()]
+            finally:
+                self.cache[itr]["lock"].release()
+            for item in items:
+                yield item
+
+    def snapshot(self):
+        """
+        returns a KVStoreSnapshot of the valid and deleted keys, taking each
+        partition lock only while that partition is captured
+        """
+        partition_snapshots = []
+        for itr in range(self.num_locks):
+            self.cache[itr]["lock"].acquire()
+            partition_snapshots.append(self.cache[itr]["partition"].snapshot())
+            self.cache[itr]["lock"].release()
+        return KVStoreSnapshot(partition_snapshots)
+
     def get_partitions(self):
         partitions = []
         for itr in range(self.num_locks):
@@ -101,6 +131,69 @@ class KVStore(object):
             # release
             self.cache[itr]["lock"].release()
 
+    def merge_keys(self, kv_store, key_filter=None, lww=False):
+        """
+        merges the valid and deleted keys of another KVStore into self, the
+        way XDCR replicates them, one partition at a time
+
+        each pair of partitions is merged under one lock each using set
+        algebra, instead of locking both partitions for every key
+
+        arguments:
+            kv_store -- source KVStore
+            key_filter -- optional callable, valid keys for which it returns
+                          False are not merged
+            lww -- if True keys are only merged when their source timestamp is
+                   not older than the destination one
+
+        returns (number of keys set, number of keys deleted)
+        """
+        if kv_store is self:
+            return 0, 0
+        if kv_store.num_locks != self.num_locks:
+            raise Exception("Cannot merge a KVStore with {0} partitions into one with {1}"
+                            .format(kv_store.num_locks, self.num_locks))
+        num_set = num_deleted = 0
+        # lock the two stores in a fixed order so that concurrent merges in
+        # both directions cannot deadlock
+        first, second = sorted([self, kv_store], key=id)
+        for itr in range(self.num_locks):
+            first.cache[itr]["lock"].acquire()
+            second.cache[itr]["lock"].acquire()
+            try:
+                merged = self._merge_partition(kv_store.cache[itr]["partition"],
+                                               self.cache[itr]["partition"],
+                                               key_filter, lww)
+            finally:
+                second.cache[itr]["lock"].release()
+                first.cache[itr]["lock"].release()
+            num_set += merged[0]
+            num_deleted += merged[1]
+        return num_set, num_deleted
+
+    @staticmethod
+    def _merge_partition(src, dest, key_filter, lww):
+        dest_deleted = set(dest.deleted_key_set())
+        valid_keys = set(src.valid_key_set()) - dest_deleted
+        deleted_keys = set(src.deleted_key_set()) - dest_deleted
+        if key_filter:
+            valid_keys = set(filter(key_filter, valid_keys))
+        if lww:
+            valid_keys = KVStore._newer_keys(src, dest, valid_keys)
+            deleted_keys = KVStore._newer_keys(src, dest, deleted_keys)
+        for key in valid_keys:
+            dest.set_item(key, src.get_key(key))
+        for key in deleted_keys:
+            dest.delete(key)
+        return len(valid_keys), len(deleted_keys)
+
+    @staticmethod
+    def _newer_keys(src, dest, keys):
+        keys = list(keys)
+        return [key for key, src_ts, dest_ts in
+                zip(keys, src.get_timestamps(keys), dest.get_timestamps(keys))
+                if src_ts >= dest_ts]
+
     def __len__(self):
         return sum([len(self.cache[itr]["partition"]) for itr in range(self.num_locks)])
 
@@ -133,9 +226,27 @@ class Partition(object):
             self.__timestamp[key] = time.time()
             del self.__valid[key]
 
+    def set_item(self, key, item):
+        """
+        sets a key from the result of get_key() on another partition,
+        keeping its absolute expiry time
+        """
+        if key in self.__deleted:
+            del self.__deleted[key]
+            if key in self.__expired_keys:
+                self.__expired_keys.remove(key)
+        self.__valid[key] = {"value": item["value"],
+                             "expires": item["expires"],
+                             "flag": item["flag"]}
+        self.__timestamp[key] = time.time()
+
     def get_timestamp(self, key):
         return self.__timestamp.get(key, 0)
 
+    def get_timestamps(self, keys):
+        timestamp = self.__timestamp
+        return [timestamp.get(key, 0) for key in keys]
+
     def get_key(self, key):
         return self.__valid.get(key)
 
@@ -188,11 +299,13 @@ class Partition(object):
         merges a partition with self
 
         arguments:
-            partition -- type Partition
+            partition -- type Partition or CompactPartition
         """
 
-        # update valid keys
-        valid_items = partition.__valid
+        # update valid keys, through the accessors both partition types have
+        valid_items = {}
+        for key in partition.valid_key_set():
+            valid_items[key] = partition.get_key(key)
         self.__valid.update(valid_items)
 
         # make sure key no longer marked as deleted
@@ -206,7 +319,10 @@ class Partition(object):
             self.__expired_keys.remove(key)
 
         # update timestamps
-        self.__timestamp.update(partition.__timestamp)
+        keys = valid_items.keys() + list(partition.deleted_key_set())
+        for key, timestamp in zip(keys, partition.get_timestamps(keys)):
+            if timestamp:
+                self.__timestamp[key] = timestamp
 
     def has_valid_keys(self):
         return len(self.__valid) > 0
@@ -238,3 +354,316 @@ class Partition(object):
 
     def __hash__(self):
         return self.part_id.__hash__()
+
+    def snapshot(self):
+        return _ListSnapshot(self.valid_key_set(), self.deleted_key_set())
+
+
+class KVStoreSnapshot(object):
+    """
+    point in time view of the valid and deleted keys of a KVStore
+
+    keys are streamed partition by partition, so iterating does not hold
+    any partition lock
+    """
+
+    def __init__(self, partition_snapshots):
+        self.partition_snapshots = partition_snapshots
+        self.num_valid_keys = sum([snap.num_valid_keys for snap in partition_snapshots])
+        self.num_deleted_keys = sum([snap.num_deleted_keys for snap in partition_snapshots])
+
+    def valid_keys(self):
+        for snap in self.partition_snapshots:
+            for key in snap.valid_keys():
+                yield key
+
+    def deleted_keys(self):
+        for snap in self.partition_snapshots:
+            for key in snap.deleted_keys():
+                yield key
+
+
+class _ListSnapshot(object):
+    def __init__(self, valid_keys, deleted_keys):
+        self._valid_keys = valid_keys
+        self._deleted_keys = deleted_keys
+        self.num_valid_keys = len(valid_keys)
+        self.num_deleted_keys = len(deleted_keys)
+
+    def valid_keys(self):
+        return iter(self._valid_keys)
+
+    def deleted_keys(self):
+        return iter(self._deleted_keys)
+
+
+class _StateSnapshot(object):
+    def __init__(self, keys, states, num_valid_keys, num_deleted_keys):
+        self._keys = keys
+        self._states = states
+        self.num_valid_keys = num_valid_keys
+        self.num_deleted_keys = num_deleted_keys
+
+    def _keys_in_state(self, *states):
+        keys = self._keys
+        for key_id, state in enumerate(self._states):
+            if state in states:
+                yield keys[key_id]
+
+    def valid_keys(self):
+        return self._keys_in_state(CompactPartition.VALID)
+
+    def deleted_keys(self):
+        return self._keys_in_state(CompactPartition.DELETED, CompactPartition.EXPIRED)
+
+
+class CompactKVStore(KVStore):
+    """
+    KVStore keeping its partitions as CompactPartition columns
+
+    meant for buckets tracking tens of millions of keys, enabled for the
+    buckets of a test run with compact_kvstore=True
+    """
+
+    def reset(self):
+        self.cache = {}
+        for itr in range(self.num_locks):
+            self.cache[itr] = {"lock": threading.Lock(),
+                               "partition": CompactPartition(itr)}
+
+
+class CompactPartition(object):
+    """
+    drop-in replacement for Partition storing each key once
+
+    keys are interned to ids which index array columns for flag, expiry and
+    timestamp and a bytearray of key states. values that are crc32 hashes
+    (the default with only_store_hash) are kept in an int column, any other
+    value in a dict keyed by id. keys with a ttl are tracked in a heap of
+    expiry times, so expiring keys never requires scanning the partition
+    """
+
+    ABSENT = 0
+    VALID = 1
+    DELETED = 2
+    EXPIRED = 3
+
+    def __init__(self, part_id):
+        self.part_id = part_id
+        self._ids = {}
+        self._keys = []
+        self._states = bytearray()
+        self._hashes = array.array('i')
+        self._values = {}
+        self._flags = array.array('I')
+        self._expires = array.array('d')
+        self._timestamps = array.array('d')
+        self._expiry_heap = []
+        self._num_valid = 0
+        self._num_deleted = 0
+
+    def _intern(self, key):
+        key_id = self._ids.get(key)
+        if key_id is None:
+            key_id = len(self._keys)
+            self._ids[key] = key_id
+            self._keys.append(key)
+            self._states.append(self.ABSENT)
+            self._hashes.append(-1)
+            self._flags.append(0)
+            self._expires.append(0)
+            self._timestamps.append(0)
+        return key_id
+
+    def _set_state(self, key_id, state):
+        old_state = self._states[key_id]
+        if old_state == self.VALID:
+            self._num_valid -= 1
+        elif old_state != self.ABSENT:
+            self._num_deleted -= 1
+        if state == self.VALID:
+            self._num_valid += 1
+        elif state != self.ABSENT:
+            self._num_deleted += 1
+        self._states[key_id] = state
+
+    def _store(self, key_id, value, expires, flag):
+        if isinstance(value, str) and 0 < len(value) <= 5 and value.isdigit() \
+                and (value[0] != '0' or value == '0'):
+            self._hashes[key_id] = int(value)
+            self._values.pop(key_id, None)
+        else:
+            self._hashes[key_id] = -1
+            self._values[key_id] = value
+        self._flags[key_id] = flag
+        self._expires[key_id] = expires
+        if expires != 0:
+            heapq.heappush(self._expiry_heap, (expires, key_id))
+        self._set_state(key_id, self.VALID)
+
+    def _value(self, key_id):
+        value_hash = self._hashes[key_id]
+        if value_hash >= 0:
+            return str(value_hash)
+        return self._values.get(key_id)
+
+    def _expire_id(self, key_id, now):
+        if self._states[key_id] == self.VALID and self._expires[key_id] != 0 \
+                and self._expires[key_id] < now:
+            self._set_state(key_id, self.EXPIRED)
+
+    def _expire_key(self, key):
+        key_id = self._ids.get(key)
+        if key_id is not None:
+            self._expire_id(key_id, time.time())
+        return key_id
+
+    def _expire_due(self):
+        now = time.time()
+        heap = self._expiry_heap
+        while heap and heap[0][0] < now:
+            expires, key_id = heapq.heappop(heap)
+            if self._expires[key_id] == expires:
+                self._expire_id(key_id, now)
+
+    def set(self, key, value, exp=0, flag=0):
+        key_id = self._intern(key)
+        if exp != 0:
+            exp = (time.time() + exp)
+        self._store(key_id, value, exp, flag)
+        self._timestamps[key_id] = time.time()
+
+    def delete(self, key):
+        key_id = self._ids.get(key)
+        if key_id is not None and self._states[key_id] == self.VALID:
+            self._set_state(key_id, self.DELETED)
+            self._timestamps[key_id] = time.time()
+
+    def set_item(self, key, item):
+        """
+        sets a key from the result of get_key() on another partition,
+        keeping its absolute expiry time
+        """
+        key_id = self._intern(key)
+        self._store(key_id, item["value"], item["expires"], item["flag"])
+        self._timestamps[key_id] = time.time()
+
+    def get_timestamp(self, key):
+        key_id = self._ids.get(key)
+        if key_id is None:
+            return 0
+        return self._timestamps[key_id]
+
+    def get_timestamps(self, keys):
+        ids = self._ids
+        timestamps = self._timestamps
+        return [timestamps[ids[key]] if key in ids else 0 for key in keys]
+
+    def get_key(self, key):
+        key_id = self._ids.get(key)
+        if key_id is None or self._states[key_id] != self.VALID:
+            return None
+        return {"value": self._value(key_id),
+                "expires": self._expires[key_id],
+                "flag": self._flags[key_id]}
+
+    def get_valid(self, key):
+        key_id = self._expire_key(key)
+        if key_id is not None and self._states[key_id] == self.VALID:
+            return self._value(key_id)
+        return None
+
+    def get_deleted(self, key):
+        key_id = self._expire_key(key)
+        if key_id is not None and self._states[key_id] in (self.DELETED, self.EXPIRED):
+            return self._value(key_id)
+        return None
+
+    def _random_key(self, states, count):
+        if not count:
+            return None
+        for _ in range(32):
+            key_id = random.randrange(len(self._keys))
+            if self._states[key_id] in states:
+                return self._keys[key_id]
+        ids = [key_id for key_id, state in enumerate(self._states) if state in states]
+        return self._keys[random.choice(ids)]
+
+    def get_random_valid_key(self):
+        self._expire_due()
+        return self._random_key((self.VALID,), self._num_valid)
+
+    def get_random_deleted_key(self):
+        return self._random_key((self.DELETED, self.EXPIRED), self._num_deleted)
+
+    def get_flag(self, key):
+        key_id = self._expire_key(key)
+        if key_id is not None and self._states[key_id] == self.VALID:
+            return self._flags[key_id]
+        return None
+
+    def _key_set(self, *states):
+        self._expire_due()
+        keys = self._keys
+        return [keys[key_id] for key_id, state in enumerate(self._states) if state in states]
+
+    def valid_key_set(self):
+        return self._key_set(self.VALID)
+
+    def deleted_key_set(self):
+        return self._key_set(self.DELETED, self.EXPIRED)
+
+    def expired_key_set(self):
+        return self._key_set(self.EXPIRED)
+
+    def snapshot(self):
+        self._expire_due()
+        return _StateSnapshot(self._keys, bytearray(self._states), self._num_valid, self._num_deleted)
+
+    def merge(self, partition):
+        """
+        merges a partition with self
+
+        arguments:
+            partition -- type CompactPartition or Partition
+        """
+        if isinstance(partition, CompactPartition):
+            for key_id, key in enumerate(partition._keys):
+                own_id = self._intern(key)
+                if partition._states[key_id] == self.VALID:
+                    self._store(own_id, partition._value(key_id),
+                                partition._expires[key_id], partition._flags[key_id])
+                if partition._timestamps[key_id]:
+                    self._timestamps[own_id] = partition._timestamps[key_id]
+        else:
+            for key in partition.valid_key_set():
+                item = partition.get_key(key)
+                own_id = self._intern(key)
+                self._store(own_id, item["value"], item["expires"], item["flag"])
+                self._timestamps[own_id] = partition.get_timestamp(key)
+            for key in partition.deleted_key_set():
+                self._timestamps[self._intern(key)] = partition.get_timestamp(key)
+
+    def has_valid_keys(self):
+        return self._num_valid > 0
+
+    def has_deleted_keys(self):
+        return self._num_deleted > 0
+
+    def expired(self, key):
+        key_id = self._expire_key(key)
+        if key_id is None or self._states[key_id] == self.ABSENT:
+            raise Exception("Key: %s is not a valid key" % key)
+        return self._states[key_id] == self.EXPIRED
+
+    def __len__(self):
+        self._expire_due()
+        return self._num_valid
+
+    def __eq__(self, other):
+        if isinstance(other, CompactPartition):
+            return self.part_id == other.part_id
+        return False
+
+    def __hash__(self):
+        return self.part_id.__hash__()
@@ -0,0 +1,694 @@
+"""
+Mock Couchbase Cluster
+
+Runs the kv and REST sides of a small cluster in-process, so that
+RestConnection, VBucketAwareMemcached and the load tasks can be driven
+without any Couchbase server. Every node is a FastMemcachedServer serving
+one VBucketBackend per bucket, plus a REST listener with the part of the
+ns_server API those clients use: pools, nodes/self, nodeStatuses, bucket
+details and the terse bucket config with the vbucket map, bucket stats,
+tasks and rebalance progress, bucket create/delete/flush, addNode,
+failOver and rebalance.
+
+usage:
+
+    cluster = MockCluster(num_nodes=4, active_nodes=3)
+    cluster.start()
+    servers = cluster.servers()         # TestInputServer list
+    rest = RestConnection(servers[0])
+    ...
+    cluster.rebalance([0, 1, 2, 3])     # or rest.add_node + rest.rebalance
+    cluster.failover(1)
+    cluster.stop()
+
+or standalone, printing a testrunner ini pointing at the nodes:
+
+    python lib/mock_cluster.py --nodes=4 --active=3 --buckets=default,other
+
+A rebalance moves the vbuckets whose chain changes one at a time (with an
+optional delay between moves) while the map being moved to is published
+as vBucketMapForward. A node answers NOT_MY_VBUCKET, with the current
+bucket config in the body like the real server, for every vbucket it does
+not own, so clients follow the moves the way they do against a cluster.
+A failover promotes the first replica of the vbuckets of the failed node.
+
+The items of a vbucket only exist once: replicas share them with the
+active copy, moves and promotions hand the same VBucket over, so topology
+changes never copy data.
+"""
+
+import BaseHTTPServer
+import getopt
+import json
+import re
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+import uuid
+
+import memcacheConstants
+from mc_bin_server import FastMemcachedServer, VBucket, VBucketBackend
+
+
+VERSION = "5.5.0-0000-enterprise"
+CLUSTER_COMPATIBILITY = 5 * 65536 + 5
+MEMORY_TOTAL = 16 * 1024 ** 3
+MEMORY_QUOTA_MB = 4096
+BUCKET_RAM_QUOTA_MB = 256
+REST_USERNAME = "Administrator"
+REST_PASSWORD = "password"
+NOT_FOUND = "Requested resource not found.\r\n"
+
+
+class MockClusterError(Exception):
+    def __init__(self, status, msg):
+        Exception.__init__(self, msg)
+        self.status = status
+
+
+def vbucket_chains(nodes, num_vbuckets, replicas):
+    """vbucket -> [active node, replica nodes...], vbuckets spread round
+    robin over nodes and -1 for the copies there are not enough nodes for"""
+    chains = []
+    for vbucket in xrange(num_vbuckets):
+        chains.append([nodes[(vbucket + copy) % len(nodes)] if copy < len(nodes) else -1
+                       for copy in xrange(replicas + 1)])
+    return chains
+
+
+class MockBucket(object):
+    def __init__(self, name, num_vbuckets, replicas, ram_quota_mb):
+        self.name = name
+        self.uuid = uuid.uuid4().hex
+        self.num_vbuckets = num_vbuckets
+        self.replicas = replicas
+        self.ram_quota_mb = ram_quota_mb
+        # chains of node indexes, the map being moved to during rebalance
+        self.vbucket_map = []
+        self.vbucket_map_forward = None
+        self.last_stats = {}
+
+
+class MockNode(object):
+    """One node of a MockCluster: a kv listener serving a backend per bucket
+    and a REST listener"""
+
+    def __init__(self, cluster, index, host, kv_port=0, rest_port=0):
+        self.cluster = cluster
+        self.index = index
+        self.host = host
+        self.otp_node = "n_{0}@{1}".format(index, host)
+        self.backends = {}
+        # connections that did not select a bucket see no vbucket at all
+        self.kv = FastMemcachedServer(VBucketBackend(cluster.num_vbuckets, vbuckets=[]),
+                                      port=kv_port, host=host, buckets=self.backends)
+        self.rest = MockRestServer(self, (host, rest_port))
+        self.kv_port = self.kv.port
+        self.rest_port = self.rest.server_address[1]
+        self.threads = []
+
+    @property
+    def hostname(self):
+        return "{0}:{1}".format(self.host, self.rest_port)
+
+    @property
+    def kv_hostname(self):
+        return "{0}:{1}".format(self.host, self.kv_port)
+
+    def start(self):
+        for target in [self.kv.serve_forever, self.rest.serve_forever]:
+            thread = threading.Thread(target=target, name="mock-{0}".format(self.otp_node))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.kv.shutdown()
+        self.rest.shutdown()
+        for thread in self.threads:
+            thread.join()
+        self.rest.server_close()
+        self.threads = []
+
+
+class MockRestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, node, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockRestHandler)
+        self.node = node
+
+
+class MockRestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.getheader("content-length") or 0)
+        if length:
+            params.update(urlparse.parse_qsl(self.rfile.read(length)))
+        node = self.server.node
+        try:
+            status, body = node.cluster.handle_rest(node, method, url.path.strip("/"), params)
+        except MockClusterError, e:
+            status, body = e.status, {"errors": [str(e)]}
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class MockCluster(object):
+    """A cluster of num_nodes MockNode, the first active_nodes of them (all
+    by default) forming the cluster with the given buckets, the others
+    standing by to be added.
+
+    Topology changes are scripted with add_node, rebalance and failover, or
+    made by the tests through the usual REST calls.
+    """
+
+    def __init__(self, num_nodes=4, active_nodes=None, buckets=("default",),
+                 num_vbuckets=1024, replicas=1, host="127.0.0.1", base_port=0):
+        """base_port -- REST port of the first node, the kv port of node i
+                        being base_port + 1000 + i, ephemeral ports when 0"""
+        self.num_vbuckets = num_vbuckets
+        self.host = host
+        self.lock = threading.RLock()
+        self.nodes = []
+        for i in xrange(num_nodes):
+            if base_port:
+                node = MockNode(self, i, host, base_port + 1000 + i, base_port + i)
+            else:
+                node = MockNode(self, i, host)
+            self.nodes.append(node)
+        if active_nodes is None:
+            active_nodes = num_nodes
+        self.members = range(active_nodes)
+        self.added = []
+        self.failed = set()
+        self.buckets = {}
+        self.rev = 1
+        self.started = time.time()
+        self.rebalance_progress = None
+        self.rebalance_thread = None
+        self.routes = [
+            ("GET", "pools", self.rest_pools),
+            ("GET", "pools/default", self.rest_pool),
+            ("GET", "nodes/self", self.rest_node_self),
+            ("GET", "nodeStatuses", self.rest_node_statuses),
+            ("GET", "pools/default/buckets", self.rest_buckets),
+            ("POST", "pools/default/buckets", self.rest_create_bucket),
+            ("GET", "pools/default/buckets/([^/]+)", self.rest_bucket),
+            ("DELETE", "pools/default/buckets/([^/]+)", self.rest_delete_bucket),
+            ("POST", "pools/default/buckets/([^/]+)/controller/doFlush", self.rest_flush_bucket),
+            ("GET", "pools/default/b/([^/]+)", self.rest_terse_bucket),
+            ("GET", "pools/default/buckets/([^/]+)/stats", self.rest_bucket_stats),
+            ("GET", "pools/default/buckets/([^/]+)/nodes/([^/]+)/stats", self.rest_bucket_stats),
+            ("GET", "pools/default/tasks", self.rest_tasks),
+            ("GET", "pools/default/rebalanceProgress", self.rest_rebalance_progress),
+            ("POST", "controller/addNode", self.rest_add_node),
+            ("POST", "controller/failOver", self.rest_failover),
+            ("POST", "controller/rebalance", self.rest_rebalance),
+        ]
+        self.routes = [(method, re.compile(pattern + "$"), handler)
+                       for method, pattern, handler in self.routes]
+        for name in buckets:
+            self.create_bucket(name, replicas)
+
+    def start(self):
+        for node in self.nodes:
+            node.start()
+
+    def stop(self):
+        if self.rebalance_thread is not None:
+            self.rebalance_thread.join()
+        for node in self.nodes:
+            node.stop()
+
+    def servers(self, nodes=None):
+        """TestInputServer list of nodes (indexes), all of them by default"""
+        from TestInput import TestInputServer
+        servers = []
+        for i in range(len(self.nodes)) if nodes is None else nodes:
+            server = TestInputServer()
+            server.ip = self.host
+            server.port = str(self.nodes[i].rest_port)
+            server.rest_username = REST_USERNAME
+            server.rest_password = REST_PASSWORD
+            server.services = "kv"
+            servers.append(server)
+        return servers
+
+    def ini(self):
+        """A testrunner ini file with every node"""
+        lines = ["[global]", "port:8091", "",
+                 "[membase]", "rest_username:" + REST_USERNAME,
+                 "rest_password:" + REST_PASSWORD, "",
+                 "[servers]"]
+        lines.extend("{0}:_{0}".format(i + 1) for i in range(len(self.nodes)))
+        for i, node in enumerate(self.nodes):
+            lines.extend(["", "[_{0}]".format(i + 1), "ip:" + self.host,
+                          "port:{0}".format(node.rest_port), "services:kv"])
+        return "\n".join(lines) + "\n"
+
+    # topology
+
+    def kv_nodes(self):
+        """Indexes of the nodes in the vbucket maps"""
+        return [i for i in self.members if i not in self.failed]
+
+    def _config_changed(self):
+        self.rev += 1
+        for bucket in self.buckets.itervalues():
+            config = json.dumps(self.terse_bucket_json(bucket))
+            for node in self.nodes:
+                node.backends[bucket.name].cluster_config = config
+
+    def _place(self, bucket, vbucket, old, new):
+        """Hands vbucket over from the nodes of chain old to those of chain
+        new, the new active copy first so that it is never missing"""
+        backends = [node.backends[bucket.name] for node in self.nodes]
+        source = None
+        if old and old[0] >= 0:
+            source = backends[old[0]].vbuckets[vbucket]
+        if source is None:
+            source = VBucket(memcacheConstants.VB_STATE_ACTIVE)
+        source.state = memcacheConstants.VB_STATE_ACTIVE
+        if new[0] >= 0:
+            backends[new[0]].vbuckets[vbucket] = source
+        for i in new[1:]:
+            if i >= 0:
+                backends[i].vbuckets[vbucket] = VBucket(memcacheConstants.VB_STATE_REPLICA, source)
+        for i in old:
+            if i >= 0 and i not in new:
+                backends[i].vbuckets[vbucket] = None
+
+    def create_bucket(self, name, replicas=1, ram_quota_mb=BUCKET_RAM_QUOTA_MB):
+        with self.lock:
+            if name in self.buckets:
+                raise MockClusterError(400, "Bucket with given name already exists")
+            bucket = MockBucket(name, self.num_vbuckets, replicas, ram_quota_mb)
+            for node in self.nodes:
+                node.backends[name] = VBucketBackend(self.num_vbuckets, vbuckets=[])
+            bucket.vbucket_map = vbucket_chains(self.kv_nodes(), self.num_vbuckets, replicas)
+            for vbucket, chain in enumerate(bucket.vbucket_map):
+                self._place(bucket, vbucket, [], chain)
+            self.buckets[name] = bucket
+            self._config_changed()
+            return bucket
+
+    def delete_bucket(self, name):
+        with self.lock:
+            self._bucket(name)
+            del self.buckets[name]
+            for node in self.nodes:
+                backend = node.backends.pop(name)
+                # connections still using the bucket see no vbucket anymore
+                backend.cluster_config = None
+                backend.vbuckets = [None] * self.num_vbuckets
+            self._config_changed()
+
+    def flush_bucket(self, name):
+        with self.lock:
+            self._bucket(name)
+            for node in self.nodes:
+                node.backends[name].handle_flush(0, '', '', '', 0)
+
+    def _bucket(self, name):
+        if name not in self.buckets:
+            raise MockClusterError(404, NOT_FOUND)
+        return self.buckets[name]
+
+    def _node(self, name):
+        """The node with an otp name (n_0@127.0.0.1) or hostname (ip:port)"""
+        for node in self.nodes:
+            if name in (node.otp_node, node.hostname):
+                return node
+        raise MockClusterError(400, "Unknown node {0}".format(name))
+
+    def add_node(self, index):
+        """Adds a standby node, it gets vbuckets on the next rebalance"""
+        with self.lock:
+            if index in self.members or index in self.added:
+                raise MockClusterError(400, "Node is already part of cluster.")
+            self.added.append(index)
+
+    def failover(self, index):
+        """Hard failover of a node: the first replica of each of its active
+        vbuckets takes over and its copies are dropped from the maps"""
+        with self.lock:
+            if index not in self.kv_nodes():
+                raise MockClusterError(400, "Unknown server given.")
+            if self.rebalance_progress is not None:
+                raise MockClusterError(400, "Rebalance running.")
+            self.failed.add(index)
+            for bucket in self.buckets.itervalues():
+                for vbucket, chain in enumerate(bucket.vbucket_map):
+                    if index in chain:
+                        new = [i for i in chain if i != index] + [-1]
+                        self._place(bucket, vbucket, chain, new)
+                        bucket.vbucket_map[vbucket] = new
+            self._config_changed()
+
+    def rebalance(self, nodes=None, delay=0, wait=True):
+        """Moves the buckets to nodes (indexes), by default the current and
+        added nodes that did not fail over. The other nodes leave the
+        cluster once it is done. delay is the time each vbucket move takes,
+        wait=False returns right away with the rebalance running."""
+        with self.lock:
+            if self.rebalance_progress is not None:
+                raise MockClusterError(400, "Rebalance running.")
+            if nodes is None:
+                nodes = [i for i in self.members + self.added if i not in self.failed]
+            nodes = sorted(nodes)
+            if not nodes:
+                raise MockClusterError(400, "No active nodes left.")
+            self.members = sorted(set(self.members) | set(nodes))
+            self.added = []
+            self.failed -= set(nodes)
+            self.rebalance_progress = 0.0
+            for bucket in self.buckets.itervalues():
+                bucket.vbucket_map_forward = vbucket_chains(nodes, self.num_vbuckets,
+                                                            bucket.replicas)
+            self._config_changed()
+            self.rebalance_thread = threading.Thread(target=self._rebalance,
+                                                     args=(nodes, delay), name="mock-rebalance")
+            self.rebalance_thread.daemon = True
+            self.rebalance_thread.start()
+        if wait:
+            self.rebalance_thread.join()
+
+    def _rebalance(self, nodes, delay):
+        moves = []
+        for bucket in self.buckets.values():
+            moves.extend((bucket, vbucket) for vbucket, chain in enumerate(bucket.vbucket_map)
+                         if chain != bucket.vbucket_map_forward[vbucket])
+        for done, (bucket, vbucket) in enumerate(moves):
+            with self.lock:
+                if bucket.name in self.buckets:
+                    new = bucket.vbucket_map_forward[vbucket]
+                    self._place(bucket, vbucket, bucket.vbucket_map[vbucket], new)
+                    bucket.vbucket_map[vbucket] = new
+                    self._config_changed()
+                self.rebalance_progress = float(done + 1) / len(moves)
+            if delay:
+                time.sleep(delay)
+        with self.lock:
+            for i in self.members:
+                if i not in nodes:
+                    for backend in self.nodes[i].backends.itervalues():
+                        backend.vbuckets = [None] * self.num_vbuckets
+            self.members = nodes
+            self.failed = set()
+            for bucket in self.buckets.itervalues():
+                bucket.vbucket_map_forward = None
+            self.rebalance_progress = None
+            self._config_changed()
+
+    def wait_for_rebalance(self):
+        if self.rebalance_thread is not None:
+            self.rebalance_thread.join()
+
+    # REST
+
+    def handle_rest(self, node, method, path, params):
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if match and method == route_method:
+                with self.lock:
+                    return handler(node, params, *match.groups())
+        return 404, NOT_FOUND
+
+    def node_json(self, node, bucket=None):
+        if node.index in self.failed:
+            membership = "inactiveFailed"
+        elif node.index in self.members:
+            membership = "active"
+        elif node.index in self.added:
+            membership = "inactiveAdded"
+        else:
+            membership = "inactive"
+        mem_quota = MEMORY_QUOTA_MB * 1024 * 1024
+        info = {"hostname": node.hostname,
+                "otpNode": node.otp_node,
+                "clusterMembership": membership,
+                "status": "healthy",
+                "recoveryType": "none",
+                "thisNode": False,
+                "clusterCompatibility": CLUSTER_COMPATIBILITY,
+                "version": VERSION,
+                "os": sys.platform,
+                "uptime": str(int(time.time() - self.started)),
+                "memoryTotal": MEMORY_TOTAL,
+                "memoryFree": MEMORY_TOTAL - mem_quota,
+                "mcdMemoryAllocated": MEMORY_TOTAL / 1024 / 1024,
+                "mcdMemoryReserved": MEMORY_TOTAL / 1024 / 1024,
+                "memoryQuota": MEMORY_QUOTA_MB,
+                "couchApiBase": "http://{0}/".format(node.hostname),
+                "ports": {"direct": node.kv_port, "proxy": node.kv_port},
+                "services": ["kv"]}
+        buckets = self.buckets.values() if bucket is None else [bucket]
+        stats = self._stats(buckets, [node.index])
+        info["interestingStats"] = dict((name, stats.get(name, 0)) for name in
+                                        ["curr_items", "curr_items_tot", "vb_replica_curr_items",
+                                         "cmd_get", "get_hits", "ops", "mem_used"])
+        return info
+
+    def server_map_json(self, bucket, servers):
+        position = dict((i, pos) for pos, i in enumerate(servers))
+        position[-1] = -1
+
+        def chains(vbucket_map):
+            return [[position.get(i, -1) for i in chain] for chain in vbucket_map]
+        server_map = {"hashAlgorithm": "CRC",
+                      "numReplicas": bucket.replicas,
+                      "serverList": [self.nodes[i].kv_hostname for i in servers],
+                      "vBucketMap": chains(bucket.vbucket_map)}
+        if bucket.vbucket_map_forward is not None:
+            server_map["vBucketMapForward"] = chains(bucket.vbucket_map_forward)
+        return server_map
+
+    def terse_bucket_json(self, bucket):
+        servers = self.kv_nodes()
+        return {"rev": self.rev,
+                "name": bucket.name,
+                "uuid": bucket.uuid,
+                "bucketType": "membase",
+                "nodeLocator": "vbucket",
+                "ddocs": {"uri": "/pools/default/buckets/{0}/ddocs".format(bucket.name)},
+                "bucketCapabilities": ["cbhello", "touch", "cccp", "nodesExt", "xattr"],
+                "nodes": [{"hostname": self.nodes[i].hostname,
+                           "ports": {"direct": self.nodes[i].kv_port}} for i in servers],
+                "vBucketServerMap": self.server_map_json(bucket, servers)}
+
+    def bucket_json(self, bucket):
+        servers = self.kv_nodes()
+        stats = self._stats([bucket], servers)
+        info = self.terse_bucket_json(bucket)
+        info.update({"uri": "/pools/default/buckets/{0}?bucket_uuid={1}".format(bucket.name,
+                                                                                 bucket.uuid),
+                     "authType": "sasl",
+                     "saslPassword": "",
+                     "proxyPort": 0,
+                     "replicaNumber": bucket.replicas,
+                     "evictionPolicy": "valueOnly",
+                     "controllers": {"flush": "/pools/default/buckets/{0}/controller/doFlush"
+                                              .format(bucket.name)},
+                     "stats": {"uri": "/pools/default/buckets/{0}/stats".format(bucket.name)},
+                     "quota": {"ram": bucket.ram_quota_mb * 1024 * 1024 * len(servers),
+                               "rawRAM": bucket.ram_quota_mb * 1024 * 1024},
+                     "basicStats": {"quotaPercentUsed": 0.0,
+                                    "opsPerSec": stats.get("ops", 0),
+                                    "diskFetches": 0,
+                                    "itemCount": stats.get("curr_items", 0),
+                                    "diskUsed": 0,
+                                    "dataUsed": 0,
+                                    "memUsed": stats.get("mem_used", 0)},
+                     "nodes": [self.node_json(self.nodes[i], bucket) for i in servers]})
+        return info
+
+    def _stats(self, buckets, nodes):
+        """Numeric memcached stats of buckets summed over nodes"""
+        totals = {}
+        for bucket in buckets:
+            for i in nodes:
+                for name, value in self.nodes[i].backends[bucket.name].stats().iteritems():
+                    if value.isdigit() and name != "time":
+                        totals[name] = totals.get(name, 0) + int(value)
+        totals.setdefault("mem_used", 0)
+        totals["ops"] = sum(totals.get(name, 0) for name in
+                            ["cmd_get", "cmd_set", "delete_hits", "delete_misses"])
+        return totals
+
+    def rest_pools(self, node, params):
+        return 200, {"isAdminCreds": True,
+                     "isEnterprise": True,
+                     "implementationVersion": VERSION,
+                     "componentsVersion": {"ns_server": VERSION},
+                     "pools": [{"name": "default", "uri": "/pools/default"}]}
+
+    def rest_pool(self, node, params):
+        nodes = self.members + self.added
+        ram_quota = sum(bucket.ram_quota_mb for bucket in self.buckets.itervalues())
+        return 200, {"name": "default",
+                     "nodes": [self.node_json(self.nodes[i]) for i in nodes],
+                     "buckets": {"uri": "/pools/default/buckets"},
+                     "rebalanceStatus": "none" if self.rebalance_progress is None else "running",
+                     "balanced": self.rebalance_progress is None and not self.added
+                                 and not self.failed,
+                     "memoryQuota": MEMORY_QUOTA_MB,
+                     "storageTotals": {"ram": {"total": MEMORY_TOTAL * len(nodes),
+                                               "quotaTotal": MEMORY_QUOTA_MB * 1024 * 1024 * len(nodes),
+                                               "quotaUsed": ram_quota * 1024 * 1024 * len(nodes),
+                                               "used": 0},
+                                       "hdd": {"total": 0, "quotaTotal": 0, "used": 0,
+                                               "usedByData": 0, "free": 0}}}
+
+    def rest_node_self(self, node, params):
+        info = self.node_json(node)
+        info["thisNode"] = True
+        return 200, info
+
+    def rest_node_statuses(self, node, params):
+        statuses = {}
+        for i in self.members + self.added:
+            statuses[self.nodes[i].hostname] = {"status": "healthy",
+                                                "otpNode": self.nodes[i].otp_node,
+                                                "gracefulFailoverPossible": False,
+                                                "replication": 1.0,
+                                                "dataless": False}
+        return 200, statuses
+
+    def rest_buckets(self, node, params):
+        return 200, [self.bucket_json(bucket) for _, bucket in sorted(self.buckets.items())]
+
+    def rest_bucket(self, node, params, name):
+        return 200, self.bucket_json(self._bucket(name))
+
+    def rest_terse_bucket(self, node, params, name):
+        return 200, self.terse_bucket_json(self._bucket(name))
+
+    def rest_create_bucket(self, node, params):
+        if not params.get("name"):
+            raise MockClusterError(400, "Bucket name cannot be empty")
+        self.create_bucket(params["name"], int(params.get("replicaNumber", 1)),
+                           int(params.get("ramQuotaMB", BUCKET_RAM_QUOTA_MB)))
+        return 202, ""
+
+    def rest_delete_bucket(self, node, params, name):
+        self.delete_bucket(name)
+        return 200, ""
+
+    def rest_flush_bucket(self, node, params, name):
+        self.flush_bucket(name)
+        return 200, ""
+
+    def rest_bucket_stats(self, node, params, name, hostname=None):
+        """The last two samples of each stat, the previous ones being those
+        returned by the last request for the same bucket and node"""
+        bucket = self._bucket(name)
+        nodes = self.kv_nodes() if hostname is None else [self._node(hostname).index]
+        now = time.time()
+        stats = self._stats([bucket], nodes)
+        total_ops = stats["ops"]
+        last_time, last_ops, last_stats = bucket.last_stats.get(hostname, (now, total_ops, None))
+        stats["ops"] = (total_ops - last_ops) / max(now - last_time, 0.001)
+        if last_stats is None:
+            last_stats = stats
+        bucket.last_stats[hostname] = now, total_ops, stats
+        samples = dict((name, [last_stats.get(name, value), value])
+                       for name, value in stats.iteritems())
+        samples["timestamp"] = [int(last_time * 1000), int(now * 1000)]
+        return 200, {"op": {"samples": samples,
+                            "samplesCount": 2,
+                            "isPersistent": True,
+                            "lastTStamp": int(now * 1000),
+                            "interval": 1000},
+                     "hot_keys": []}
+
+    def _rebalance_task(self):
+        if self.rebalance_progress is None:
+            return {"type": "rebalance", "status": "notRunning", "statusIsStale": False}
+        progress = self.rebalance_progress * 100
+        return {"type": "rebalance", "subtype": "rebalance", "status": "running",
+                "recommendedRefreshPeriod": 0.25, "progress": progress,
+                "perNode": dict((self.nodes[i].otp_node, {"progress": progress})
+                                for i in self.members)}
+
+    def rest_tasks(self, node, params):
+        return 200, [self._rebalance_task()]
+
+    def rest_rebalance_progress(self, node, params):
+        if self.rebalance_progress is None:
+            return 200, {"status": "none"}
+        progress = {"status": "running"}
+        for i in self.members:
+            progress[self.nodes[i].otp_node] = {"progress": self.rebalance_progress}
+        return 200, progress
+
+    def rest_add_node(self, node, params):
+        hostname = params.get("hostname", "")
+        if "://" in hostname:
+            hostname = hostname.split("://", 1)[1]
+        added = self._node(hostname)
+        self.add_node(added.index)
+        return 200, {"otpNode": added.otp_node}
+
+    def rest_failover(self, node, params):
+        self.failover(self._node(params.get("otpNode", "")).index)
+        return 200, ""
+
+    def rest_rebalance(self, node, params):
+        known = [self._node(name).index
+                 for name in params.get("knownNodes", "").split(",") if name]
+        ejected = [self._node(name).index
+                   for name in params.get("ejectedNodes", "").split(",") if name]
+        nodes = [i for i in known or self.members + self.added
+                 if i not in ejected and i not in self.failed]
+        self.rebalance(nodes, wait=False)
+        return 200, ""
+
+
+if __name__ == "__main__":
+    opts, args = getopt.getopt(sys.argv[1:], '', ['nodes=', 'active=', 'buckets=', 'vbuckets=',
+                                                  'replicas=', 'host=', 'port='])
+    opts = dict(opts)
+    num_nodes = int(opts.get('--nodes', 4))
+    cluster = MockCluster(num_nodes=num_nodes,
+                          active_nodes=int(opts.get('--active', num_nodes)),
+                          buckets=[name for name in opts.get('--buckets', 'default').split(',')
+                                   if name],
+                          num_vbuckets=int(opts.get('--vbuckets', 1024)),
+                          replicas=int(opts.get('--replicas', 1)),
+                          host=opts.get('--host', '127.0.0.1'),
+                          base_port=int(opts.get('--port', 9000)))
+    cluster.start()
+    print cluster.ini()
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        cluster.stop()
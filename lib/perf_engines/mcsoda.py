@@ -12,7 +12,7 @@ import multiprocessing
 import Queue
 import logging
 import logging.config
-from collections import deque
+from collections import deque, OrderedDict
 from hashlib import md5
 import json
 import inspect
@@ -31,6 +31,7 @@ from lib.memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE, \
 from lib.perf_engines.libobserve.obs_mcsoda import McsodaObserver
 from lib.perf_engines.libobserve.obs import Observable
 from lib.perf_engines.libobserve.obs_helper import UnblockingJoinableQueue
+from lib.perf_engines.pacing import LatencyHistogram, Pacer
 
 logging.config.fileConfig("mcsoda.logging.conf")
 log = logging.getLogger()
@@ -41,6 +42,7 @@ INT_TYPE = type(123)
 FLOAT_TYPE = type(0.1)
 DICT_TYPE = type({})
 RETRIES = 5
+DOC_CACHE_BYTES = 64 * 1024 * 1024
 
 
 class Stack(object):
@@ -102,6 +104,9 @@ def dict_to_s_inner(d, level, res, suffix, ljust):
     complex = []
 
     for key in d.keys():
+        if isinstance(d[key], LatencyHistogram):
+            d = dict(d)
+            d[key] = d[key].to_dict()
         if type(d[key]) == dtype:
             complex.append(key)
         else:
@@ -147,11 +152,13 @@ def dict_to_s_inner(d, level, res, suffix, ljust):
 
     return res
 
-# The histo dict is returned by add_timing_sample().
+# The histo is returned by add_timing_sample(), or a {latency: count} dict.
 # The percentiles must be sorted, ascending, like [0.90, 0.99].
 
 
 def histo_percentile(histo, percentiles):
+    if isinstance(histo, LatencyHistogram):
+        return histo.percentiles(percentiles)
     v_sum = 0
     bins = histo.keys()
     bins.sort()
@@ -305,11 +312,16 @@ def cor_worker(stats_queue, ctl, cfg, cur, store):
     log.info("cor_worker stopped")
 
 
+def concurrent_fg_workers(cfg):
+    """Number of workers sharing max-ops-per-sec"""
+    if cfg.get('active_fg_workers') is not None:
+        return max(cfg.get('active_fg_workers').value, 1)
+    return 1
+
+
 def run_worker(ctl, cfg, cur, store, prefix, heartbeat=0, why=""):
     i = 0
-    t_last_flush = time.time()
     t_last_cycle = time.time()
-    o_last_flush = store.num_ops(cur)
     t_last = time.time()
     o_last = store.num_ops(cur)
     xfer_sent_last = 0
@@ -352,6 +364,12 @@ def run_worker(ctl, cfg, cur, store, prefix, heartbeat=0, why=""):
         cor_process.daemon = True
         cor_process.start()
 
+    # Open loop speed limitation: every batch is sent when it is due on a
+    # fixed schedule, however long the previous ones took, and its latency
+    # sample is measured from then (see Store.pace()).
+    if max_ops_per_sec:
+        store.pacer = Pacer(max_ops_per_sec / concurrent_fg_workers(cfg))
+
     while ctl.get('run_ok', True):
         num_ops = cur.get('cur-gets', 0) + cur.get('cur-sets', 0)
 
@@ -474,44 +492,16 @@ def run_worker(ctl, cfg, cur, store, prefix, heartbeat=0, why=""):
             xfer_recv_last = xfer_recv_curr
 
         if flushed:
-            # Code below is responsible for speed limitation.
-            # Stream looks like ^_^_^_^_^_^_^
-            #
-            # delta1 = flush time + previous sleep time (^_)
-            # delta2 = flush time (^)
-            #
-            # TODO: dynamic correction factor.
-            # We have to measure actual average throughput - let's say - every
-            # minute. Thus we can adjust request rate. For now it's empiric,
-            # because we always oversleep.
-            CORRECTION_FACTOR = 0.975
-
             delta1 = time.time() - t_last_cycle
-            delta2 = time.time() - t_last_flush
             t_last_cycle += delta1
 
-            ops_done = float(store.num_ops(cur) - o_last_flush)
-            o_last_flush += ops_done
-
-            if max_ops_per_sec:
+            if store.pacer is not None:
                 # Taking into account global throughtput
-                if cfg.get('active_fg_workers') is not None:
-                    concurrent_workers = cfg.get('active_fg_workers').value
-                else:
-                    concurrent_workers = 1
-                local_max_ops_per_sec = max_ops_per_sec / concurrent_workers
-                # Actual throughput
-                ops_per_sec = ops_done / delta2
-                # Sleep if too fast. It must be too fast.
-                if ops_per_sec > local_max_ops_per_sec:
-                    sleep_time = CORRECTION_FACTOR * ops_done / local_max_ops_per_sec - delta2
-                    time.sleep(max(sleep_time, 0))
+                store.pacer.set_rate(max_ops_per_sec / concurrent_fg_workers(cfg))
 
             if hot_shift > 0:
                 cur['cur-base'] = cur.get('cur-base', 0) + (hot_shift * delta1)
 
-            t_last_flush = time.time()
-
     store.flush()
 
 
@@ -700,6 +690,8 @@ class Store(object):
 
     def __init__(self):
         self.errors = dict()
+        self.pacer = None
+        self.intended_start = None
 
     def connect(self, target, user, pswd, cfg, cur, bucket="default", backups=None):
         self.target = target
@@ -781,27 +773,27 @@ class Store(object):
             buf += data
         return buf[:nbytes], buf[nbytes:]
 
-    def add_timing_sample(self, cmd, delta, prefix="latency-"):
-        base = prefix + cmd
-        for suffix in self.cfg.get("timing-suffixes", ["", "-recent"]):
-            key = base + suffix
-            histo = self.cur.get(key, None)
-            if histo is None:
-                histo = {}
-                self.cur[key] = histo
-            try:
-                bucket = round(self.histo_bucket(delta), 6)
-                histo[bucket] = histo.get(bucket, 0) + 1
-            except TypeError, error:
-                self.save_error(error)
-                log.error(error)
+    def pace(self):
+        """Waits until the queued batch is due when a pacer limits the speed,
+        the latency sample of the batch is then measured from that time"""
+        if self.pacer is not None:
+            self.intended_start = self.pacer.acquire(len(self.queue))
 
-    def histo_bucket(self, samp):
-        hp = self.cfg.get("histo-precision", 2)
-        if samp > 0:
-            p = 10 ** (math.floor(math.log10(samp)) - (hp - 1))
-            r = round(samp / p)
-            return r * p
+    def add_timing_sample(self, cmd, delta, prefix="latency-"):
+        """Records delta seconds in the LatencyHistogram of cmd, the
+        "-recent" timing suffix being reported by save_stats() as the
+        interval snapshots of the same histogram"""
+        key = prefix + cmd
+        histo = self.cur.get(key, None)
+        if histo is None:
+            histo = LatencyHistogram(significant_figures=self.cfg.get("histo-precision", 2))
+            self.cur[key] = histo
+        try:
+            histo.record(delta)
+        except TypeError, error:
+            self.save_error(error)
+            log.error(error)
+        return histo
 
     def drange(self, start, stop, step):
         r = start
@@ -917,6 +909,7 @@ class StoreMemcachedBinary(Store):
         if len(self.queue) <= self.flush_level():
             return False
 
+        self.pace()
         try:
             self.flush()
             return True
@@ -1037,8 +1030,11 @@ class StoreMemcachedBinary(Store):
             self.xfer_sent += self.inflight_send(next_msg)
 
         if latency_cmd:
+            if self.intended_start is not None:
+                latency_start = self.intended_start
             delta = latency_end - latency_start
             self.add_timing_sample(latency_cmd, delta)
+        self.intended_start = None
 
         if self.sc:
             if self.ops - self.previous_ops > self.stats_ops:
@@ -1047,13 +1043,15 @@ class StoreMemcachedBinary(Store):
                 log.debug("%s save_stats : %s" % (self.why, latency_cmd))
 
     def save_stats(self, cur_time=0):
-        for key in self.cur:
+        recent = "-recent" in self.cfg.get("timing-suffixes", ["", "-recent"])
+        for key in self.cur.keys():
             if key.startswith('latency-'):
                 histo = self.cur.get(key, None)
                 if histo:
-                    self.sc.latency_stats(key, histo, cur_time)
-                    if key.endswith('-recent'):
-                        self.cur[key] = {}
+                    self.sc.latency_stats(key, histo.to_dict(), cur_time)
+                    interval = histo.interval()
+                    if recent and interval:
+                        self.sc.latency_stats(key + '-recent', interval.to_dict(), cur_time)
         self.sc.sample(self.cur)
 
     def cmd_append(self, cmd, key_num, key_str, data, expiration, grp):
@@ -1304,6 +1302,7 @@ class StoreMemcachedAscii(Store):
         self.queue.append(c)
         if len(self.queue) > (self.cur.get('batch') or
                               self.cfg.get('batch', 100)):
+            self.pace()
             self.flush()
             return True
         return False
@@ -1411,45 +1410,150 @@ def key_to_achievements(key_str):
             achievements.append(next)
     return achievements
 
-doc_cache = {}
+class DocCache(object):
+    """
+    Size-aware LRU cache of generated doc bodies, keyed by key_num.
+
+    Once the cached docs take more than max_bytes the least recently used
+    ones are evicted, so long runs keep a flat memory footprint.
+    """
+    # rough per entry cost of the str object and the OrderedDict node
+    ENTRY_OVERHEAD = 160
+
+    def __init__(self, max_bytes=DOC_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        self.docs = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key_num):
+        with self.lock:
+            d = self.docs.pop(key_num, None)
+            if d is None:
+                self.misses += 1
+                return None
+            self.docs[key_num] = d
+            self.hits += 1
+            return d
+
+    def put(self, key_num, d):
+        with self.lock:
+            old = self.docs.pop(key_num, None)
+            if old is not None:
+                self.bytes -= len(old) + self.ENTRY_OVERHEAD
+            self.docs[key_num] = d
+            self.bytes += len(d) + self.ENTRY_OVERHEAD
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.docs:
+            _, d = self.docs.popitem(last=False)
+            self.bytes -= len(d) + self.ENTRY_OVERHEAD
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"items": len(self.docs),
+                    "bytes": self.bytes,
+                    "max-bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit-ratio": lookups and float(self.hits) / lookups}
+
+doc_cache = DocCache()
+
+
+class DocTemplate(object):
+    """
+    Builds the same doc body as the key_to_* helpers, but from lookup
+    tables computed once, with a single join over the template pieces.
+    """
+    HEX = dict((c, int(c, 16)) for c in "0123456789abcdefABCDEF")
+    CATEGORY = dict((c, str(v % 3)) for c, v in HEX.iteritems())
+    COINS = None
+    FIELDS = ("key_num", "name", "email", "city", "country", "realm",
+              "coins", "category", "achievements")
+
+    templates = {}
+
+    @classmethod
+    def get(cls, key_name="key", whitespace=True):
+        template = cls.templates.get((key_name, whitespace))
+        if template is None:
+            template = cls(key_name, whitespace)
+            cls.templates[(key_name, whitespace)] = template
+        return template
+
+    def __init__(self, key_name="key", whitespace=True):
+        if DocTemplate.COINS is None:
+            DocTemplate.COINS = [str(i / 100.0) for i in xrange(0x10000)]
+        sep = whitespace and "\n " or ""
+        quoted = set(["name", "email", "city", "country", "realm"])
+        pieces = ['"%s":"' % key_name]
+        close = '"'
+        for field in self.FIELDS:
+            pieces.append('%s,%s"%s":%s' % (close, sep, field,
+                                            field in quoted and '"' or ''))
+            close = field in quoted and '"' or ''
+        pieces.append(",")
+        self.pieces = pieces
+
+    def achievements(self, k):
+        next = 300
+        achievements = []
+        hex = self.HEX
+        for i in xrange(16):
+            next = (next + hex[k[i]] * i) % 500
+            if next < 256:
+                achievements.append(str(next))
+        return "[" + ", ".join(achievements) + "]"
+
+    def render(self, key_num, key_str):
+        k = key_str[-16:]
+        p = self.pieces
+        return "".join((p[0], key_str,
+                        p[1], str(key_num),
+                        p[2], k[0:4], " ", k[12:15],
+                        p[3], k[0:4], "@", k[3:5], ".com",
+                        p[4], k[4:7],
+                        p[5], k[7:9],
+                        p[6], k[9:11],
+                        p[7], self.COINS[int(k[0:4], 16)],
+                        p[8], self.CATEGORY[k[4]],
+                        p[9], self.achievements(k),
+                        p[10]))
 
 
 def gen_doc_string(key_num, key_str, min_value_size, suffix, json,
                    cache=None, key_name="key", suffix_ex="", whitespace=True):
-    global doc_cache
-
     c = "{"
     if not json:
         c = "*"
 
     d = None
     if cache:
-        d = doc_cache.get(key_num, None)
+        d = doc_cache.get(key_num)
 
     if d is None:
-        d = """"%s":"%s",
- "key_num":%s,
- "name":"%s",
- "email":"%s",
- "city":"%s",
- "country":"%s",
- "realm":"%s",
- "coins":%s,
- "category":%s,
- "achievements":%s,""" % (key_name, key_str,
-                          key_num,
-                          key_to_name(key_str),
-                          key_to_email(key_str),
-                          key_to_city(key_str),
-                          key_to_country(key_str),
-                          key_to_realm(key_str),
-                          key_to_coins(key_str),
-                          key_to_category(key_str),
-                          key_to_achievements(key_str))
-        if not whitespace:
-            d = d.replace("\n ", "")
+        d = DocTemplate.get(key_name, whitespace).render(key_num, key_str)
         if cache:
-            doc_cache[key_num] = d
+            doc_cache.put(key_num, d)
 
     return "%s%s%s%s" % (c, d, suffix_ex, suffix)
 
@@ -1470,6 +1574,8 @@ def final_report(cur, store, total_time):
     else:
         total_cmds = cur.get('cur-gets', 0) + cur.get('cur-sets', 0)
     log.info("ops/sec: %s" % (total_cmds / float(total_time)))
+    if len(doc_cache):
+        log.info("doc cache: %s" % dict_to_s(doc_cache.stats()))
     if store.errors:
         log.warn("errors:\n%s", json.dumps(store.errors, indent=4))
 
@@ -1516,6 +1622,8 @@ def run(cfg, cur, protocol, host_port, user, pswd, stats_collector=None,
 
     store.show_some_keys()
 
+    doc_cache.resize(cfg.get("doc-cache-bytes", DOC_CACHE_BYTES))
+
     if cfg.get("doc-cache", 0) > 0 and cfg.get("doc-gen", 0) > 0:
         min_value_size = cfg['min-value-size'][0]
         json = cfg.get('json', 1) > 0
@@ -1607,10 +1715,11 @@ def main(argv, cfg_defaults=None, cur_defaults=None, protocol=None, stores=None,
         "time":               (0,     "Stop after this many seconds if > 0."),
         "max-ops-per-sec":    (0,     "When >0, max ops/second target performance."),
         "report":             (40000, "Emit performance output after this many requests."),
-        "histo-precision":    (1,     "Precision of histogram bins."),
+        "histo-precision":    (2,     "Significant figures of latency histograms."),
         "vbuckets":           (0,     "When >0, vbucket hash in memcached-binary protocol."),
-        "doc-cache":          (1,     "When 1, cache docs; faster, but uses O(N) memory."),
+        "doc-cache":          (1,     "When 1, cache docs; faster, bounded by doc-cache-bytes."),
         "doc-gen":            (1,     "When 1 and doc-cache, pre-generate docs at start."),
+        "doc-cache-bytes":    (DOC_CACHE_BYTES, "Max memory used by doc-cache, LRU docs are evicted beyond it."),
         "backoff-factor":     (2.0,   "Exponential backoff factor on ETMPFAIL errors."),
         "hot-shift":          (0,     "# of keys/sec that hot item subset should shift."),
         "random":             (0,     "When 1, use random keys for gets and updates."),
@@ -68,7 +68,7 @@ class StoreMongo(mcsoda.Store):
 
         histo = self.add_timing_sample(cmd, cmd_end - cmd_start)
         if self.sc:
-            p = self.histo_percentile(histo, [0.90, 0.95, 0.99])
+            p = mcsoda.histo_percentile(histo, [0.90, 0.95, 0.99])
             self.sc.latency_stats(cmd, p)
 
 
@@ -0,0 +1,229 @@
+"""
+Open loop pacing and latency histograms for load generators.
+
+A Pacer schedules operations at a fixed rate on a timeline that does not
+depend on how long the operations take, and a LatencyHistogram records the
+latency of each operation measured from its intended start on that
+timeline. A server stall then shows up as the latency of every operation
+that should have been sent during it, instead of as a single slow sample
+(coordinated omission).
+
+usage:
+
+    pacer = Pacer(1000)
+    histo = LatencyHistogram()
+    while running:
+        intended = pacer.acquire()
+        do_operation()
+        histo.record(time.time() - intended)
+    histo.percentiles([0.99, 0.999])
+"""
+
+import math
+import time
+
+
+class Pacer(object):
+    """Token bucket refilled at rate tokens per second, with the tokens of
+    the operations running late never capped.
+
+    Operation i is intended to start at start + i / rate. acquire() sleeps
+    until the intended start of the next operations and returns it, or
+    returns right away when they are late, so that the load catches up
+    with the schedule instead of the schedule slipping behind the load.
+    """
+
+    def __init__(self, rate, start=None):
+        self.interval = 1.0 / rate
+        self.next = time.time() if start is None else start
+
+    def set_rate(self, rate):
+        """Changes the rate of the operations not acquired yet"""
+        self.interval = 1.0 / rate
+
+    def reset(self, start=None):
+        """Restarts the schedule, e.g. after a pause that should not be
+        caught up with"""
+        self.next = time.time() if start is None else start
+
+    def lag(self):
+        """How late the next operation is, in seconds"""
+        return max(0, time.time() - self.next)
+
+    def acquire(self, count=1):
+        """Takes the tokens of count operations sent together, e.g. a batch,
+        and returns the intended start of the first one once it is due"""
+        intended = self.next
+        self.next += count * self.interval
+        delay = intended - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return intended
+
+
+class LatencyHistogram(object):
+    """HDR style log-linear histogram of latencies.
+
+    Values are recorded as integer multiples of unit seconds. Below
+    2 ** sub_bucket_bits units every value has its own bucket, above that
+    the buckets of each power of two range split it in the same number of
+    linear sub buckets, so that a value and its bucket bounds are within
+    10 ** -significant_figures of each other whatever the magnitude.
+
+    Counts live in a sparse {bucket index: count} dict, histograms with the
+    same layout are merged by adding them up, e.g. one per thread or the
+    ones sent back by worker processes (they pickle like any object).
+    Readers in other threads work on a copy of the counts, so they only
+    need the recording thread to keep running.
+    """
+
+    def __init__(self, unit=1e-6, significant_figures=2):
+        self.unit = unit
+        self.significant_figures = significant_figures
+        self.sub_bucket_bits = int(math.ceil(math.log(2 * 10 ** significant_figures, 2)))
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count >> 1
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+        self.last_counts = {}
+
+    def __len__(self):
+        return self.total
+
+    def __str__(self):
+        if not self.total:
+            return "empty"
+        return "count: {0} min: {1:.6f} mean: {2:.6f} p50: {3:.6f} p99: {4:.6f} " \
+               "p99.9: {5:.6f} max: {6:.6f}".format(self.total, self.min * self.unit,
+                                                    self.mean(), self.percentile(0.5),
+                                                    self.percentile(0.99),
+                                                    self.percentile(0.999),
+                                                    self.max * self.unit)
+
+    def index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self.sub_bucket_half + \
+            (value >> shift) - self.sub_bucket_half
+
+    def bounds(self, index):
+        """Lowest and highest value (in units) of a bucket"""
+        if index < self.sub_bucket_count:
+            return index, index
+        shift, sub_bucket = divmod(index - self.sub_bucket_count, self.sub_bucket_half)
+        shift += 1
+        sub_bucket += self.sub_bucket_half
+        return sub_bucket << shift, ((sub_bucket + 1) << shift) - 1
+
+    def record(self, latency, count=1):
+        """Records count samples of latency seconds"""
+        self.record_value(max(0, int(latency / self.unit + 0.5)), count)
+
+    def record_value(self, value, count=1):
+        """Records count samples of value units"""
+        index = self.index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total += count
+        self.sum += value * count
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def _check_layout(self, other):
+        if (other.unit, other.sub_bucket_bits) != (self.unit, self.sub_bucket_bits):
+            raise ValueError("cannot merge histograms of {0}s with {1} sub bucket bits and "
+                             "{2}s with {3} sub bucket bits"
+                             .format(self.unit, self.sub_bucket_bits,
+                                     other.unit, other.sub_bucket_bits))
+
+    def merge(self, other):
+        """Adds the samples of other to this histogram"""
+        self._check_layout(other)
+        for index, count in other.counts.copy().iteritems():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        return self
+
+    __iadd__ = merge
+
+    def _from_counts(self, counts):
+        """A histogram with the layout of this one holding counts, min, max
+        and sum being those of the bucket bounds"""
+        histo = LatencyHistogram(self.unit, self.significant_figures)
+        for index, count in counts.iteritems():
+            if count:
+                low, high = self.bounds(index)
+                histo.counts[index] = count
+                histo.total += count
+                histo.sum += (low + high) / 2 * count
+                histo.max = max(histo.max, high)
+                if histo.min is None or low < histo.min:
+                    histo.min = low
+        return histo
+
+    def copy(self):
+        histo = LatencyHistogram(self.unit, self.significant_figures)
+        histo.merge(self)
+        return histo
+
+    def interval(self):
+        """Histogram of the samples recorded since the previous call, since
+        the creation of this one the first time"""
+        counts = self.counts.copy()
+        last_counts = self.last_counts
+        self.last_counts = counts
+        return self._from_counts(dict((index, count - last_counts.get(index, 0))
+                                      for index, count in counts.iteritems()))
+
+    def reset(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+        self.last_counts = {}
+
+    def mean(self):
+        """Mean latency in seconds"""
+        if not self.total:
+            return 0.0
+        return float(self.sum) / self.total * self.unit
+
+    def percentiles(self, percentiles):
+        """[(percentile, latency in seconds)] for sorted percentiles like
+        [0.90, 0.99], the latency being the highest value of the bucket
+        holding the percentile (capped by the max), like histo_percentile"""
+        counts = self.counts.copy()
+        total = sum(counts.itervalues())
+        rv = []
+        if not total:
+            return rv
+        percentiles = list(percentiles)
+        cumulated = 0
+        for index in sorted(counts):
+            cumulated += counts[index]
+            while percentiles and cumulated >= percentiles[0] * total:
+                rv.append((percentiles[0], min(self.bounds(index)[1], self.max) * self.unit))
+                percentiles.pop(0)
+            if not percentiles:
+                break
+        return rv
+
+    def percentile(self, percentile):
+        rv = self.percentiles([percentile])
+        return rv[0][1] if rv else 0.0
+
+    def to_dict(self):
+        """{latency in seconds: count} of the non empty buckets, the format
+        of the histograms of mcsoda and StatsCollector"""
+        return dict((round(self.bounds(index)[1] * self.unit, 6), count)
+                    for index, count in self.counts.copy().iteritems() if count)
@@ -8,6 +8,7 @@ import time
 import logging
 import stat
 import json
+import threading
 import TestInput
 from subprocess import Popen, PIPE
 
@@ -171,6 +172,70 @@ class RemoteMachineHelper(object):
             return None
 
 
+class SSHSessionManager(object):
+    """Keeps one authenticated ssh client per (host, user, key) for the life
+    of the process. paramiko multiplexes channels over a single transport,
+    so every RemoteMachineShellConnection to the same host shares it instead
+    of doing its own handshake. RemoteMachineInfo is cached per host too."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._key_locks = {}
+        self._infos = {}
+
+    def key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, key):
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                return None
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():
+                return client
+            del self._clients[key]
+        log.info("ssh session to {0} is no longer active".format(key[0]))
+        client.close()
+        return None
+
+    def add(self, key, client):
+        with self._lock:
+            self._clients[key] = client
+
+    def is_shared(self, client):
+        with self._lock:
+            return client in self._clients.values()
+
+    def get_info(self, ip):
+        with self._lock:
+            return self._infos.get(ip)
+
+    def set_info(self, ip, info):
+        with self._lock:
+            self._infos[ip] = info
+
+    def close(self, ip=None):
+        """Closes the sessions to ip, or every session if ip is None"""
+        with self._lock:
+            keys = [key for key in self._clients if ip is None or key[0] == ip]
+            clients = [self._clients.pop(key) for key in keys]
+            if ip is None:
+                self._infos.clear()
+            else:
+                self._infos.pop(ip, None)
+        for client in clients:
+            client.close()
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._clients), 'infos': len(self._infos)}
+
+SSH_SESSIONS = SSHSessionManager()
+
+
 class RemoteMachineShellConnection:
     _ssh_client = None
 
@@ -222,14 +287,37 @@ class RemoteMachineShellConnection:
         elif self.username != "Administrator":
             self.use_sudo = False
             self.nonroot = True
-        self._ssh_client = paramiko.SSHClient()
         self.ip = serverInfo.ip
         self.remote = (self.ip != "localhost" and self.ip != "127.0.0.1")
         self.port = serverInfo.port
+        self.reuse_ssh = self.input.param("reuse_ssh", True)
+        if self.remote and self.reuse_ssh:
+            key = (self.ip, serverInfo.ssh_username, serverInfo.ssh_key)
+            with SSH_SESSIONS.key_lock(key):
+                self._ssh_client = SSH_SESSIONS.get(key)
+                if self._ssh_client is None:
+                    self._connect(serverInfo.ssh_username)
+                    SSH_SESSIONS.add(key, self._ssh_client)
+        else:
+            self._connect(serverInfo.ssh_username)
+        log.info("Connected to {0}".format(serverInfo.ip))
+        """ self.info.distribution_type.lower() == "ubuntu" """
+        self.cmd_ext = ""
+        self.bin_path = LINUX_COUCHBASE_BIN_PATH
+        self.msi = False
+        if self.nonroot:
+            self.bin_path = self.nr_home_path + self.bin_path
+        self.extract_remote_info()
+        os_type = self.info.type.lower()
+        if os_type == "windows":
+            self.cmd_ext = ".exe"
+            self.bin_path = WIN_COUCHBASE_BIN_PATH
+
+    def _connect(self, username):
+        self._ssh_client = paramiko.SSHClient()
         self._ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         msg = 'connecting to {0} with username:{1} password:{2} ssh_key:{3}'
-        log.info(msg.format(serverInfo.ip, serverInfo.ssh_username,
-                            serverInfo.ssh_password, serverInfo.ssh_key))
+        log.info(msg.format(self.ip, username, self.password, self.ssh_key))
         # added attempts for connection because of PID check failed.
         # RNG must be re-initialized after fork() error
         # That's a paramiko bug
@@ -237,14 +325,14 @@ class RemoteMachineShellConnection:
         attempt = 0
         while True:
             try:
-                if self.remote and serverInfo.ssh_key == '':
-                    self._ssh_client.connect(hostname=serverInfo.ip.replace('[', '').replace(']',''),
-                                             username=serverInfo.ssh_username,
-                                             password=serverInfo.ssh_password)
+                if self.remote and self.ssh_key == '':
+                    self._ssh_client.connect(hostname=self.ip.replace('[', '').replace(']',''),
+                                             username=username,
+                                             password=self.password)
                 elif self.remote:
-                    self._ssh_client.connect(hostname=serverInfo.ip.replace('[', '').replace(']',''),
-                                             username=serverInfo.ssh_username,
-                                             key_filename=serverInfo.ssh_key)
+                    self._ssh_client.connect(hostname=self.ip.replace('[', '').replace(']',''),
+                                             username=username,
+                                             key_filename=self.ssh_key)
                 break
             except paramiko.AuthenticationException:
                 log.error("Authentication failed")
@@ -263,18 +351,6 @@ class RemoteMachineShellConnection:
                     log.error("Can't establish SSH session to node {1} :\
                                                    {0}".format(e, self.ip))
                     exit(1)
-        log.info("Connected to {0}".format(serverInfo.ip))
-        """ self.info.distribution_type.lower() == "ubuntu" """
-        self.cmd_ext = ""
-        self.bin_path = LINUX_COUCHBASE_BIN_PATH
-        self.msi = False
-        if self.nonroot:
-            self.bin_path = self.nr_home_path + self.bin_path
-        self.extract_remote_info()
-        os_type = self.info.type.lower()
-        if os_type == "windows":
-            self.cmd_ext = ".exe"
-            self.bin_path = WIN_COUCHBASE_BIN_PATH
 
     """
         In case of non root user, we need to switch to root to
@@ -284,33 +360,19 @@ class RemoteMachineShellConnection:
         if self.info.distribution_type.lower() == "mac":
             log.info("This is Mac Server.  Skip re-connect to it as %s" % user)
             return
-        max_attempts_connect = 2
-        attempt = 0
-        while True:
-            try:
-                log.info("Connect to node: %s as user: %s" % (self.ip, user))
-                if self.remote and self.ssh_key == '':
-                    self._ssh_client.connect(hostname=self.ip.replace('[', '').replace(']',''),
-                                             username=user,
-                                             password=self.password)
-                break
-            except paramiko.AuthenticationException:
-                log.error("Authentication for root failed")
-                exit(1)
-            except paramiko.BadHostKeyException:
-                log.error("Invalid Host key")
-                exit(1)
-            except Exception as e:
-                if str(e).find('PID check failed. RNG must be re-initialized') != -1 and\
-                        attempt != max_attempts_connect:
-                    log.error("Can't establish SSH session to node {1} as root:\
-                              {0}. Will try again in 1 sec".format(e, self.ip))
-                    attempt += 1
-                    time.sleep(1)
-                else:
-                    log.error("Can't establish SSH session to node {1} :\
-                                                   {0}".format(e, self.ip))
-                    exit(1)
+        if not (self.remote and self.ssh_key == ''):
+            return
+        log.info("Connect to node: %s as user: %s" % (self.ip, user))
+        if self.reuse_ssh:
+            key = (self.ip, user, self.ssh_key)
+            with SSH_SESSIONS.key_lock(key):
+                self._ssh_client = SSH_SESSIONS.get(key)
+                if self._ssh_client is None:
+                    self._connect(user)
+                    SSH_SESSIONS.add(key, self._ssh_client)
+        else:
+            self._ssh_client.close()
+            self._connect(user)
         log.info("Connected to {0} as {1}".format(self.ip, user))
 
     def sleep(self, timeout=1, message=""):
@@ -3095,7 +3157,10 @@ class RemoteMachineShellConnection:
                 self.log_command_output(o, r)
 
     def disconnect(self):
-        self._ssh_client.close()
+        # shared sessions stay open for the next connection to this host,
+        # use SSH_SESSIONS.close() to drop them
+        if not SSH_SESSIONS.is_shared(self._ssh_client):
+            self._ssh_client.close()
 
     def extract_remote_info(self):
         # initialize params
@@ -3110,6 +3175,10 @@ class RemoteMachineShellConnection:
         # use sftp to if certain types exists or not
         if getattr(self, "info", None) is not None and isinstance(self.info, RemoteMachineInfo):
             return self.info
+        info = SSH_SESSIONS.get_info(self.ip)
+        if info is not None:
+            self.info = info
+            return info
         mac_check_cmd = "sw_vers | grep ProductVersion | awk '{ print $2 }'"
         if self.remote:
             stdin, stdout, stderro = self._ssh_client.exec_command(mac_check_cmd)
@@ -3256,6 +3325,7 @@ class RemoteMachineShellConnection:
             info.hostname = self.get_hostname(win_info)
             info.domain = self.get_domain(win_info)
             self.info = info
+            SSH_SESSIONS.set_info(self.ip, info)
             return info
         else:
             # now run uname -m to get the architechtre type
@@ -3295,6 +3365,7 @@ class RemoteMachineShellConnection:
             info.hostname = self.get_hostname()
             info.domain = self.get_domain()
             self.info = info
+            SSH_SESSIONS.set_info(self.ip, info)
             return info
 
     def get_extended_windows_info(self):
@@ -3769,7 +3840,10 @@ class RemoteMachineShellConnection:
         self.log_command_output(output, error)
 
     def get_data_map_using_cbtransfer(self, buckets, data_path=None, userId="Administrator",
-                                      password="password", getReplica=False, mode="memory"):
+                                      password="password", getReplica=False, mode="memory",
+                                      loader=None):
+        """ Returns the csv header and {bucket: rows}. If given, loader(bucket, header, file)
+        consumes each csv file as it is read and bucketMap holds its return value instead """
         self.extract_remote_info()
         temp_path = "/tmp/"
         if self.info.type.lower() == 'windows':
@@ -3816,7 +3890,10 @@ class RemoteMachineShellConnection:
                 headerInfo = ""
                 with open(dest_path) as f:
                     headerInfo = f.readline()
-                    content = f.readlines()
+                    if loader is None:
+                        content = f.readlines()
+                    else:
+                        content = loader(bucket.name, headerInfo, f)
                 bucketMap[bucket.name] = content
                 os.remove(dest_path)
         return headerInfo, bucketMap
@@ -4508,6 +4585,44 @@ class RemoteMachineShellConnection:
 
 class RemoteUtilHelper(object):
 
+    @staticmethod
+    def execute_on_all(servers, command, use_channel=False, debug=True,
+                       max_workers=16):
+        """Runs command on every server in parallel, returns a dict of
+        server.ip -> (output, error). A failure on one server is returned
+        as ([], [str(exception)]) rather than raised"""
+        results = {}
+        lock = threading.Lock()
+        pending = list(servers)
+        pending.reverse()
+
+        def run():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    server = pending.pop()
+                try:
+                    shell = RemoteMachineShellConnection(server)
+                    try:
+                        result = shell.execute_command(command, debug=debug,
+                                                       use_channel=use_channel)
+                    finally:
+                        shell.disconnect()
+                except (Exception, SystemExit), e:
+                    log.error("{0} failed on {1}: {2}".format(command, server.ip, e))
+                    result = ([], [str(e)])
+                with lock:
+                    results[server.ip] = result
+
+        workers = [threading.Thread(target=run, name="execute_on_all_{0}".format(i))
+                   for i in range(min(max_workers, len(pending)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
     @staticmethod
     def enable_firewall(server, bidirectional=False, xdcr=False):
         """ Check if user is root or non root in unix """
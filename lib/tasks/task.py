@@ -5,16 +5,18 @@ import random
 import socket
 import string
 import copy
+import itertools
 import json
 import re
 import math
 import crc32
 import traceback
 import testconstants
+import Queue
 from httplib import IncompleteRead
-from threading import Thread
-from memcacheConstants import ERR_NOT_FOUND,NotFoundError
-from membase.api.rest_client import RestConnection, Bucket, RestHelper
+from threading import Thread, Lock
+from memcacheConstants import ERR_NOT_FOUND,NotFoundError,ERR_NOT_MY_VBUCKET
+from membase.api.rest_client import RestConnection, Bucket, RestHelper, HTTP_POOL
 from membase.api.exception import BucketCreationException
 from membase.helper.bucket_helper import BucketOperationHelper
 from memcached.helper.data_helper import KVStoreAwareSmartClient, MemcachedClientHelper
@@ -28,9 +30,10 @@ from membase.api.exception import N1QLQueryException, DropIndexException, Create
                                     ServerUnavailableException, BucketFlushFailed, CBRecoveryFailedException, BucketCompactionException, AutoFailoverException
 from remote.remote_util import RemoteMachineShellConnection, RemoteUtilHelper
 from couchbase_helper.documentgenerator import BatchedDocumentGenerator
+from couchbase_helper.emitted_row_index import emitted_row_index
 from TestInput import TestInputServer, TestInputSingleton
 from testconstants import MIN_KV_QUOTA, INDEX_QUOTA, FTS_QUOTA, COUCHBASE_FROM_4DOT6, THROUGHPUT_CONCURRENCY, ALLOW_HTP, CBAS_QUOTA, COUCHBASE_FROM_VERSION_4
-from multiprocessing import Process, Manager, Semaphore
+from multiprocessing import Process, Manager, Semaphore, Event
 
 try:
     CHECK_FLAG = False
@@ -65,6 +68,10 @@ class Task(Future):
         self.cancelled = False
         self.retries = 0
         self.res = None
+        # scheduler counters, maintained by TaskManager
+        self.steps = 0
+        self.queue_wait_time = 0.0
+        self.step_time = 0.0
 
     def step(self, task_manager):
         if not self.done():
@@ -937,9 +944,11 @@ class GenericLoadingTask(Thread, Task):
             self.kv_store.release_lock(part)
 
     def _populate_kvstore_partition(self, partition, keys, key_val):
+        if self.only_store_hash:
+            hashes = crc32.crc32_hash_batch([key_val[key] for key in keys])
+            for key, value_hash in zip(keys, hashes):
+                key_val[key] = str(value_hash)
         for key in keys:
-            if self.only_store_hash:
-                key_val[key] = str(crc32.crc32_hash(key_val[key]))
             partition.set(key, key_val[key], self.exp, self.flag)
 
 
@@ -1174,44 +1183,17 @@ class LoadDocumentsGeneratorsTask(LoadDocumentsTask):
                 self.exp,
                 self.flag)
 
-class ESLoadGeneratorTask(Task):
-    """
-        Class to load/update/delete documents into/from Elastic Search
-    """
-
-    def __init__(self, es_instance, index_name, generator, op_type="create"):
-        Task.__init__(self, "ES_loader_task")
-        self.es_instance = es_instance
-        self.index_name = index_name
-        self.generator = generator
-        self.iterator = 0
-        self.log.info("Starting to load data into Elastic Search ...")
-
-    def check(self, task_manager):
-        self.state = FINISHED
-        self.set_result(True)
-
-    def execute(self, task_manager):
-        for key, doc in self.generator:
-            doc = json.loads(doc)
-            self.es_instance.load_data(self.index_name,
-                                       json.dumps(doc, encoding='utf-8'),
-                                       doc['type'],
-                                       key)
-            self.iterator += 1
-            if math.fmod(self.iterator, 500) == 0.0:
-                self.log.info("{0} documents loaded into ES".
-                              format(self.iterator))
-        self.state = FINISHED
-        self.set_result(True)
-
 class ESBulkLoadGeneratorTask(Task):
     """
         Class to load/update/delete documents into/from Elastic Search
+
+        Batches are built as NDJSON bodies in memory and up to concurrency
+        _bulk requests are kept in flight; the index is refreshed once at the
+        end. Actions ES rejected are logged per batch and kept in errors.
     """
 
     def __init__(self, es_instance, index_name, generator, op_type="create",
-                 batch=1000):
+                 batch=1000, concurrency=4):
         Task.__init__(self, "ES_loader_task")
         self.es_instance = es_instance
         self.index_name = index_name
@@ -1219,48 +1201,92 @@ class ESBulkLoadGeneratorTask(Task):
         self.iterator = 0
         self.op_type = op_type
         self.batch_size = batch
+        self.concurrency = concurrency
+        self.errors = []
         self.log.info("Starting operation '%s' on Elastic Search ..." % op_type)
 
     def check(self, task_manager):
         self.state = FINISHED
         self.set_result(True)
 
-    def execute(self, task_manager):
-        es_filename = "/tmp/es_bulk.txt"
-        es_bulk_docs = []
-        loaded = 0
-        batched = 0
-        for key, doc in self.generator:
-            doc = json.loads(doc)
-            es_doc = {
-                self.op_type: {
-                    "_index": self.index_name,
-                    "_type": doc['type'],
-                    "_id": key,
-                }
+    def _bulk_lines(self, key, doc):
+        doc = json.loads(doc)
+        es_doc = {
+            self.op_type: {
+                "_index": self.index_name,
+                "_type": doc['type'],
+                "_id": key,
             }
-            es_bulk_docs.append(json.dumps(es_doc))
-            if self.op_type == "create":
-                es_bulk_docs.append(json.dumps(doc))
-            elif self.op_type == "update":
-                doc['mutated'] += 1
-                es_bulk_docs.append(json.dumps({"doc": doc}))
-            batched += 1
-            if batched == self.batch_size or not self.generator.has_next():
-                es_file = open(es_filename, "wb")
-                for line in es_bulk_docs:
-                    es_file.write("%s\n" %line)
-                es_file.close()
-                self.es_instance.load_bulk_data(es_filename)
-                loaded += batched
-                self.log.info("{0} documents bulk loaded into ES".format(loaded))
-                self.es_instance.update_index(self.index_name)
-                batched = 0
+        }
+        lines = [json.dumps(es_doc)]
+        if self.op_type in ("create", "index"):
+            lines.append(json.dumps(doc))
+        elif self.op_type == "update":
+            doc['mutated'] += 1
+            lines.append(json.dumps({"doc": doc}))
+        return lines
+
+    def _send_batches(self, batches, lock):
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            batch_num, body, batched = batch
+            try:
+                errors = self.es_instance.load_bulk_body(body)
+            except Exception, e:
+                errors = [str(e)]
+            with lock:
+                self.iterator += batched
+                if errors:
+                    self.errors.extend(errors)
+                    self.log.error("ES bulk batch {0}: {1} of {2} actions failed, first error: {3}"
+                                   .format(batch_num, len(errors), batched, errors[0]))
+                self.log.info("{0} documents bulk loaded into ES".format(self.iterator))
+
+    def execute(self, task_manager):
+        batches = Queue.Queue(maxsize=self.concurrency)
+        lock = Lock()
+        senders = [Thread(target=self._send_batches, args=(batches, lock))
+                   for _ in range(self.concurrency)]
+        for sender in senders:
+            sender.start()
+        try:
+            es_bulk_docs = []
+            batched = 0
+            batch_num = 0
+            for key, doc in self.generator:
+                es_bulk_docs.extend(self._bulk_lines(key, doc))
+                batched += 1
+                if batched == self.batch_size:
+                    batches.put((batch_num, "\n".join(es_bulk_docs) + "\n", batched))
+                    batch_num += 1
+                    es_bulk_docs = []
+                    batched = 0
+            if batched:
+                batches.put((batch_num, "\n".join(es_bulk_docs) + "\n", batched))
+        finally:
+            for sender in senders:
+                batches.put(None)
+            for sender in senders:
+                sender.join()
+        self.es_instance.update_index(self.index_name)
         indexed = self.es_instance.get_index_count(self.index_name)
         self.log.info("ES index count for '{0}': {1}".
                               format(self.index_name, indexed))
         self.state = FINISHED
-        self.set_result(True)
+        self.set_result(not self.errors)
+
+
+class ESLoadGeneratorTask(ESBulkLoadGeneratorTask):
+    """
+        Class to load documents into Elastic Search, as index actions sent
+        through the bulk pipeline
+    """
+
+    def __init__(self, es_instance, index_name, generator, op_type="create"):
+        ESBulkLoadGeneratorTask.__init__(self, es_instance, index_name, generator,
+                                         op_type="index", batch=500)
 
 
 class ESRunQueryCompare(Task):
@@ -1488,9 +1514,11 @@ class BatchedLoadDocumentsTask(GenericLoadingTask):
             self.kv_store.release_lock(part)
 
     def _populate_kvstore_partition(self, partition, keys, key_val):
+        if self.only_store_hash:
+            hashes = crc32.crc32_hash_batch([key_val[key] for key in keys])
+            for key, value_hash in zip(keys, hashes):
+                key_val[key] = str(value_hash)
         for key in keys:
-            if self.only_store_hash:
-                key_val[key] = str(crc32.crc32_hash(key_val[key]))
             partition.set(key, key_val[key], self.exp, self.flag)
 
 
@@ -1583,9 +1611,10 @@ class WorkloadTask(GenericLoadingTask):
 class ValidateDataTask(GenericLoadingTask):
     def __init__(self, server, bucket, kv_store, max_verify=None, only_store_hash=True, replica_to_read=None):
         GenericLoadingTask.__init__(self, server, bucket, kv_store)
-        self.valid_keys, self.deleted_keys = kv_store.key_set()
-        self.num_valid_keys = len(self.valid_keys)
-        self.num_deleted_keys = len(self.deleted_keys)
+        snapshot = kv_store.snapshot()
+        self.valid_keys, self.deleted_keys = snapshot.valid_keys(), snapshot.deleted_keys()
+        self.num_valid_keys = snapshot.num_valid_keys
+        self.num_deleted_keys = snapshot.num_deleted_keys
         self.itr = 0
         self.max_verify = self.num_valid_keys + self.num_deleted_keys
         self.only_store_hash = only_store_hash
@@ -1608,9 +1637,9 @@ class ValidateDataTask(GenericLoadingTask):
 
     def next(self):
         if self.itr < self.num_valid_keys:
-            self._check_valid_key(self.valid_keys[self.itr])
+            self._check_valid_key(next(self.valid_keys))
         else:
-            self._check_deleted_key(self.deleted_keys[self.itr - self.num_valid_keys])
+            self._check_deleted_key(next(self.deleted_keys))
         self.itr += 1
 
     def _check_valid_key(self, key):
@@ -1672,12 +1701,214 @@ class ValidateDataTask(GenericLoadingTask):
                 self.set_exception(error)
         self.kv_store.release_partition(key)
 
+class ShardedValidateDataTask(GenericLoadingTask):
+    """
+        Validates a kv_store against the bucket from num_shards processes.
+
+        Keys are sharded by vbucket; each worker process opens its own
+        connections and pipelines gets for batches of its keys, comparing the
+        values against the stored fingerprints. Mismatches and per shard
+        throughput are streamed back to the parent, which stops the workers
+        once max_errors mismatches were reported.
+    """
+
+    def __init__(self, server, bucket, kv_store, max_verify=None, only_store_hash=True,
+                 batch_size=1000, num_shards=None, max_errors=100):
+        GenericLoadingTask.__init__(self, server, bucket, kv_store)
+        self.max_verify = max_verify
+        self.only_store_hash = only_store_hash
+        self.batch_size = max(1, batch_size)
+        self.num_shards = num_shards or self.process_concurrency
+        self.max_errors = max_errors
+        self.errors = []
+        self.shards = []
+        self.stop_event = None
+
+    def run(self):
+        try:
+            self._run_shards()
+        except Exception as e:
+            self.state = FINISHED
+            self.set_exception(e)
+            return
+        self.state = FINISHED
+        if self.errors:
+            self.set_exception(Exception("{0} validation errors on bucket {1}, first ones: {2}"
+                                         .format(len(self.errors), self.bucket, self.errors[:10])))
+        else:
+            self.set_result(True)
+
+    def _shard_keys(self):
+        """Splits the keys to verify by vbucket into one (valid, deleted)
+        pair of lists per shard, sorted by vbucket"""
+        self.shards = [([], []) for _ in range(self.num_shards)]
+        count = 0
+        for key, value, flag in self.kv_store.valid_items():
+            if self.max_verify is not None and count >= self.max_verify:
+                break
+            if value is None:
+                continue
+            vbucket = self.client._get_vBucket_id(key)
+            self.shards[vbucket % self.num_shards][0].append((vbucket, key, value, flag))
+            count += 1
+        for key in self.kv_store.snapshot().deleted_keys():
+            if self.max_verify is not None and count >= self.max_verify:
+                break
+            vbucket = self.client._get_vBucket_id(key)
+            self.shards[vbucket % self.num_shards][1].append((vbucket, key))
+            count += 1
+        for valid, deleted in self.shards:
+            valid.sort()
+            deleted.sort()
+        return count
+
+    def _run_shards(self):
+        start_time = time.time()
+        count = self._shard_keys()
+        self.log.info("%s items will be verified on %s bucket by %s processes"
+                      % (count, self.bucket, self.num_shards))
+        self.stop_event = Event()
+        processes = []
+        try:
+            for shard in range(self.num_shards):
+                # only start processing when there resources available
+                CONCURRENCY_LOCK.acquire()
+                process = Process(target=self.run_shard, args=(shard,))
+                process.start()
+                processes.append(process)
+            # every child has its own copy of the shards
+            self.shards = []
+            verified = self._collect_results(processes)
+        finally:
+            self.stop_event.set()
+            for process in processes:
+                process.join()
+        elapsed = max(time.time() - start_time, 0.001)
+        self.log.info("{0} items were verified in {1:.1f} sec, {2:.0f} per second"
+                      .format(verified, elapsed, verified / elapsed))
+
+    def _collect_results(self, processes):
+        verified = 0
+        running = set(range(len(processes)))
+        while running:
+            try:
+                rv = self.shared_kvstore_queue.get(timeout=5)
+            except Queue.Empty:
+                if not any([process.is_alive() for process in processes]) and \
+                        self.shared_kvstore_queue.empty():
+                    raise Exception("validation processes of shards {0} exited without results"
+                                    .format(sorted(running)))
+                continue
+            if rv.get("mismatches"):
+                self.errors.extend(rv["mismatches"])
+            if rv.get("err"):
+                self.errors.append("shard {0}: {1}".format(rv["shard"], rv["err"]))
+            if len(self.errors) >= self.max_errors:
+                self.stop_event.set()
+            if "verified" in rv:
+                elapsed = max(rv["elapsed"], 0.001)
+                self.log.info("shard {0}: {1} items were verified in {2:.1f} sec, {3:.0f} per second"
+                              .format(rv["shard"], rv["verified"], elapsed, rv["verified"] / elapsed))
+            if rv.get("done"):
+                running.discard(rv["shard"])
+                verified += rv["verified"]
+        return verified
+
+    def run_shard(self, shard):
+        valid, deleted = self.shards[shard]
+        rv = {"shard": shard, "done": True, "verified": 0, "err": None}
+        start_time = time.time()
+        # never reuse the REST connections inherited from the parent process
+        HTTP_POOL.clear()
+        try:
+            client = VBucketAwareMemcached(RestConnection(self.server), self.bucket)
+            pipelines = {}
+            for items, check in [(valid, self._check_valid_batch),
+                                 (deleted, self._check_deleted_batch)]:
+                for itr in range(0, len(items), self.batch_size):
+                    if self.stop_event.is_set():
+                        break
+                    batch = items[itr:itr + self.batch_size]
+                    mismatches = check(client, pipelines, batch)
+                    if mismatches:
+                        self.shared_kvstore_queue.put({"shard": shard, "mismatches": mismatches})
+                    rv["verified"] += len(batch)
+                    # report progress of the shard every 100k items
+                    if rv["verified"] // 100000 != (rv["verified"] - len(batch)) // 100000:
+                        self.shared_kvstore_queue.put({"shard": shard, "verified": rv["verified"],
+                                                       "elapsed": time.time() - start_time})
+            client.done()
+        except Exception as ex:
+            rv["err"] = str(ex)
+        finally:
+            rv["elapsed"] = time.time() - start_time
+            self.shared_kvstore_queue.put(rv)
+            # release concurrency lock
+            CONCURRENCY_LOCK.release()
+
+    def _submit(self, client, pipelines, batch, op):
+        """Pipelines op for every key of batch to the node owning its
+        vbucket and returns the futures once all responses are in"""
+        futures = []
+        used = set()
+        for item in batch:
+            vbucket, key = item[0], item[1]
+            mc = client.memcached_for_vbucket(vbucket)
+            if mc not in pipelines:
+                pipelines[mc] = mc.pipeline()
+            used.add(pipelines[mc])
+            futures.append(getattr(pipelines[mc], op)(key, vbucket=vbucket))
+        for pipeline in used:
+            pipeline.wait_all()
+        return futures
+
+    def _op_result(self, client, future, vbucket, key, op):
+        try:
+            return future.result()
+        except MemcachedError as error:
+            if error.status != ERR_NOT_MY_VBUCKET:
+                raise
+            client.reset_vbuckets(client.rest, set([vbucket]))
+            return getattr(client, op)(key)
+
+    def _check_valid_batch(self, client, pipelines, batch):
+        mismatches = []
+        futures = self._submit(client, pipelines, batch, "get")
+        for (vbucket, key, value, flag), future in zip(batch, futures):
+            try:
+                o, c, d = self._op_result(client, future, vbucket, key, "get")
+            except MemcachedError as error:
+                mismatches.append("Key: %s, %s" % (key, error))
+                continue
+            if self.only_store_hash:
+                if crc32.crc32_hash(d) != int(value):
+                    mismatches.append('Key: %s, Bad hash result: %d != %d' % (key, crc32.crc32_hash(d), int(value)))
+                    continue
+            elif json.loads(d) != json.loads(value):
+                mismatches.append('Key: %s, Bad result: %s != %s' % (key, json.dumps(d), value))
+                continue
+            if CHECK_FLAG and o != flag:
+                mismatches.append('Key: %s, Bad result for flag value: %s != the value we set: %s' % (key, o, flag))
+        return mismatches
+
+    def _check_deleted_batch(self, client, pipelines, batch):
+        mismatches = []
+        futures = self._submit(client, pipelines, batch, "delete")
+        for (vbucket, key), future in zip(batch, futures):
+            try:
+                self._op_result(client, future, vbucket, key, "delete")
+            except MemcachedError as error:
+                if error.status != ERR_NOT_FOUND:
+                    mismatches.append("Key: %s, %s" % (key, error))
+        return mismatches
+
 class ValidateDataWithActiveAndReplicaTask(GenericLoadingTask):
     def __init__(self, server, bucket, kv_store, max_verify=None):
         GenericLoadingTask.__init__(self, server, bucket, kv_store)
-        self.valid_keys, self.deleted_keys = kv_store.key_set()
-        self.num_valid_keys = len(self.valid_keys)
-        self.num_deleted_keys = len(self.deleted_keys)
+        snapshot = kv_store.snapshot()
+        self.valid_keys, self.deleted_keys = snapshot.valid_keys(), snapshot.deleted_keys()
+        self.num_valid_keys = snapshot.num_valid_keys
+        self.num_deleted_keys = snapshot.num_deleted_keys
         self.itr = 0
         self.max_verify = self.num_valid_keys + self.num_deleted_keys
         if max_verify is not None:
@@ -1698,9 +1929,9 @@ class ValidateDataWithActiveAndReplicaTask(GenericLoadingTask):
 
     def next(self):
         if self.itr < self.num_valid_keys:
-            self._check_valid_key(self.valid_keys[self.itr])
+            self._check_valid_key(next(self.valid_keys))
         else:
-            self._check_deleted_key(self.deleted_keys[self.itr - self.num_valid_keys])
+            self._check_deleted_key(next(self.deleted_keys))
         self.itr += 1
 
     def _check_valid_key(self, key):
@@ -1750,9 +1981,10 @@ class ValidateDataWithActiveAndReplicaTask(GenericLoadingTask):
 class BatchedValidateDataTask(GenericLoadingTask):
     def __init__(self, server, bucket, kv_store, max_verify=None, only_store_hash=True, batch_size=100, timeout_sec=5):
         GenericLoadingTask.__init__(self, server, bucket, kv_store)
-        self.valid_keys, self.deleted_keys = kv_store.key_set()
-        self.num_valid_keys = len(self.valid_keys)
-        self.num_deleted_keys = len(self.deleted_keys)
+        snapshot = kv_store.snapshot()
+        self.valid_keys, self.deleted_keys = snapshot.valid_keys(), snapshot.deleted_keys()
+        self.num_valid_keys = snapshot.num_valid_keys
+        self.num_deleted_keys = snapshot.num_deleted_keys
         self.itr = 0
         self.max_verify = self.num_valid_keys + self.num_deleted_keys
         self.timeout_sec = timeout_sec
@@ -1777,11 +2009,11 @@ class BatchedValidateDataTask(GenericLoadingTask):
 
     def next(self):
         if self.itr < self.num_valid_keys:
-            keys_batch = self.valid_keys[self.itr:self.itr + self.batch_size]
+            keys_batch = list(itertools.islice(self.valid_keys, self.batch_size))
             self.itr += len(keys_batch)
             self._check_valid_keys(keys_batch)
         else:
-            self._check_deleted_key(self.deleted_keys[self.itr - self.num_valid_keys])
+            self._check_deleted_key(next(self.deleted_keys))
             self.itr += 1
 
     def _check_valid_keys(self, keys):
@@ -1852,13 +2084,22 @@ class BatchedValidateDataTask(GenericLoadingTask):
 
 
 class VerifyRevIdTask(GenericLoadingTask):
-    def __init__(self, src_server, dest_server, bucket, src_kv_store, dest_kv_store, max_err_count=200000, max_verify=None):
-        GenericLoadingTask.__init__(self, src_server, bucket, src_kv_store)
+    """Compares the metadata of every kv_store key on source and destination.
+
+    Keys are verified batch_size at a time: getMeta for the whole batch is
+    pipelined to the source and destination nodes owning each vbucket
+    before any response is read.
+    """
+    def __init__(self, src_server, dest_server, bucket, src_kv_store, dest_kv_store, max_err_count=200000, max_verify=None,
+                 batch_size=1000):
+        GenericLoadingTask.__init__(self, src_server, bucket, src_kv_store, batch_size=batch_size)
         from memcached.helper.data_helper import VBucketAwareMemcached as SmartClient
         self.client_src = SmartClient(RestConnection(src_server), bucket)
         self.client_dest = SmartClient(RestConnection(dest_server), bucket)
         self.src_valid_keys, self.src_deleted_keys = src_kv_store.key_set()
         self.dest_valid_keys, self.dest_del_keys = dest_kv_store.key_set()
+        self.src_deleted_key_set = None
+        self.dest_key_set = None
         self.num_valid_keys = len(self.src_valid_keys)
         self.num_deleted_keys = len(self.src_deleted_keys)
         self.keys_not_found = {self.client.rest.ip: [], self.client_dest.rest.ip: []}
@@ -1900,18 +2141,78 @@ class VerifyRevIdTask(GenericLoadingTask):
         return False
 
     def next(self):
+        end = min(self.itr + self.batch_size, self.num_valid_keys + self.num_deleted_keys)
+        if self.max_verify:
+            end = min(end, self.max_verify)
         if self.itr < self.num_valid_keys:
-            self._check_key_revId(self.src_valid_keys[self.itr])
-        elif self.itr < (self.num_valid_keys + self.num_deleted_keys):
+            keys = self.src_valid_keys[self.itr:min(end, self.num_valid_keys)]
+            ignore_meta_data = []
+        else:
             # verify deleted/expired keys
-            self._check_key_revId(self.src_deleted_keys[self.itr - self.num_valid_keys],
-                                  ignore_meta_data=['expiration','cas'])
-        self.itr += 1
+            keys = self.src_deleted_keys[self.itr - self.num_valid_keys:end - self.num_valid_keys]
+            ignore_meta_data = ['expiration', 'cas']
+        if not keys:
+            self.itr = end
+            return
+        pipelines = []
+        src_futures = self.__submit_get_meta(self.client_src, keys, pipelines)
+        dest_futures = self.__submit_get_meta(self.client_dest, keys, pipelines)
+        # the connections are only free for the synchronous retries once
+        # every pipelined response has been read
+        try:
+            for pipeline in pipelines:
+                pipeline.wait_all()
+        except Exception as e:
+            self.state = FINISHED
+            self.set_unexpected_exception(e)
+            return
+        for key, src_future, dest_future in zip(keys, src_futures, dest_futures):
+            if self.done():
+                break
+            src_meta_data = self.__meta_data_result(self.client_src, key, src_future)
+            dest_meta_data = self.__meta_data_result(self.client_dest, key, dest_future)
+            self._compare_meta_data(key, src_meta_data, dest_meta_data, ignore_meta_data)
 
         # show progress of verification for every 50k items
-        if math.fmod(self.itr, 50000) == 0.0:
-            self.log.info("{0} items have been verified".format(self.itr))
+        if (self.itr + len(keys)) // 50000 != self.itr // 50000:
+            self.log.info("{0} items have been verified".format(self.itr + len(keys)))
+        self.itr += len(keys)
+
+    def __submit_get_meta(self, client, keys, all_pipelines):
+        """Pipelines getMeta for keys to the nodes owning their vbuckets,
+        one vbucket after the other, returns a future per key"""
+        futures = [None] * len(keys)
+        pipelines = {}
+        by_vbucket = sorted(xrange(len(keys)), key=lambda i: client._get_vBucket_id(keys[i]))
+        try:
+            for i in by_vbucket:
+                vbucket = client._get_vBucket_id(keys[i])
+                mc = client.memcached_for_vbucket(vbucket)
+                if mc not in pipelines:
+                    pipelines[mc] = mc.pipeline()
+                futures[i] = pipelines[mc].getMeta(keys[i], vbucket=vbucket)
+            for pipeline in pipelines.values():
+                pipeline.flush()
+        except Exception as e:
+            self.state = FINISHED
+            self.set_unexpected_exception(e)
+        all_pipelines.extend(pipelines.values())
+        return futures
 
+    def __meta_data_result(self, client, key, future):
+        if future is None:
+            return None
+        try:
+            return dict(zip(['deleted', 'flags', 'expiration', 'seqno', 'cas'], future.result()))
+        except MemcachedError as error:
+            if error.status == ERR_NOT_MY_VBUCKET:
+                client.reset_vbuckets(client.rest, set([client._get_vBucket_id(key)]))
+                return self.__get_meta_data(client, key)
+            self.__meta_data_error(client, key, error)
+        # catch and set all unexpected exceptions
+        except Exception as e:
+            self.state = FINISHED
+            self.set_unexpected_exception(e)
 
     def __get_meta_data(self, client, key):
         try:
@@ -1919,25 +2220,35 @@ class VerifyRevIdTask(GenericLoadingTask):
             meta_data = eval("{'deleted': %s, 'flags': %s, 'expiration': %s, 'seqno': %s, 'cas': %s}" % (mc.getMeta(key)))
             return meta_data
         except MemcachedError as error:
-            if error.status == ERR_NOT_FOUND:
-                # if a filter was specified, the key will not be found in
-                # target kv store if key did not match filter expression
-                if key not in self.src_deleted_keys and key in (self.dest_valid_keys+self.dest_del_keys):
-                    self.err_count += 1
-                    self.keys_not_found[client.rest.ip].append(("key: %s" % key, "vbucket: %s" % client._get_vBucket_id(key)))
-                else:
-                    self.not_matching_filter_keys +=1
-            else:
-                self.state = FINISHED
-                self.set_exception(error)
+            self.__meta_data_error(client, key, error)
         # catch and set all unexpected exceptions
         except Exception as e:
             self.state = FINISHED
             self.set_unexpected_exception(e)
 
+    def __meta_data_error(self, client, key, error):
+        if error.status == ERR_NOT_FOUND:
+            if self.dest_key_set is None:
+                self.src_deleted_key_set = set(self.src_deleted_keys)
+                self.dest_key_set = set(self.dest_valid_keys)
+                self.dest_key_set.update(self.dest_del_keys)
+            # if a filter was specified, the key will not be found in
+            # target kv store if key did not match filter expression
+            if key not in self.src_deleted_key_set and key in self.dest_key_set:
+                self.err_count += 1
+                self.keys_not_found[client.rest.ip].append(("key: %s" % key, "vbucket: %s" % client._get_vBucket_id(key)))
+            else:
+                self.not_matching_filter_keys +=1
+        else:
+            self.state = FINISHED
+            self.set_exception(error)
+
     def _check_key_revId(self, key, ignore_meta_data=[]):
         src_meta_data = self.__get_meta_data(self.client_src, key)
         dest_meta_data = self.__get_meta_data(self.client_dest, key)
+        self._compare_meta_data(key, src_meta_data, dest_meta_data, ignore_meta_data)
+
+    def _compare_meta_data(self, key, src_meta_data, dest_meta_data, ignore_meta_data=[]):
         if not src_meta_data or not dest_meta_data:
             return
         prev_error_count = self.err_count
@@ -3398,14 +3709,16 @@ class GenerateExpectedViewResultsTask(Task):
 
     def execute(self, task_manager):
         try:
-            self.generate_emitted_rows()
-            self.filter_emitted_rows()
+            index = self.generate_emitted_rows()
+            with index.lock:
+                index.update(self.doc_generators)
+                self.filter_emitted_rows(index)
             self.log.info("Finished generating expected query results")
             self.state = CHECKING
             task_manager.schedule(self)
         except Exception, ex:
             self.state = FINISHED
-            self.set_unexpected_exception(e)
+            self.set_unexpected_exception(ex)
 
     def check(self, task_manager):
         self.state = FINISHED
@@ -3413,6 +3726,8 @@ class GenerateExpectedViewResultsTask(Task):
 
 
     def generate_emitted_rows(self):
+        """Returns the emitted row index of the view map function, shared by
+        all the queries of views with the same map function"""
         emit_key = re.sub(r',.*', '', re.sub(r'.*emit\([ +]?doc\.', '', self.view.map_func))
         emit_value = None
         if re.match(r'.*emit\([ +]?\[doc\.*', self.view.map_func):
@@ -3428,33 +3743,32 @@ class GenerateExpectedViewResultsTask(Task):
             emit_value = re.sub(r'\);.*', '', re.sub(r'.*emit\([ +]?\[*],[ +]?doc\.', '', self.view.map_func))
             if self.view.map_func.count("[") <= 1:
                 emit_value = re.sub(r'\);.*', '', re.sub(r'.*emit\([ +]?.*,[ +]?doc\.', '', self.view.map_func))
-        for doc_gen in self.doc_generators:
-
-            query_doc_gen = copy.deepcopy(doc_gen)
-            while query_doc_gen.has_next():
+        with_value = not (not self.is_reduced or self.view.red_func == "_count" or self.custom_red_fn)
+        type_filter = self.type_filter
 
-                _id, val = query_doc_gen.next()
-                val = json.loads(val)
+        def emit(_id, val):
+            val = json.loads(val)
 
-                if isinstance(emit_key, list):
-                    val_emit_key = []
-                    for ek in emit_key:
-                        val_emit_key.append(val[ek])
-                else:
-                    val_emit_key = val[emit_key]
-                if self.type_filter:
-                    filter_expr = r'\A{0}.*'.format(self.type_filter["filter_expr"])
-                    if re.match(filter_expr, val[self.type_filter["filter_what"]]) is None:
-                        continue
-                if isinstance(val_emit_key, unicode):
-                    val_emit_key = val_emit_key.encode('utf-8')
-                if not self.is_reduced or self.view.red_func == "_count" or self.custom_red_fn:
-                    self.emitted_rows.append({'id' : _id, 'key' : val_emit_key})
-                else:
-                    val_emit_value = val[emit_value]
-                    self.emitted_rows.append({'value' : val_emit_value, 'key' : val_emit_key, 'id' : _id, })
-
-    def filter_emitted_rows(self):
+            if isinstance(emit_key, list):
+                val_emit_key = []
+                for ek in emit_key:
+                    val_emit_key.append(val[ek])
+            else:
+                val_emit_key = val[emit_key]
+            if type_filter:
+                filter_expr = r'\A{0}.*'.format(type_filter["filter_expr"])
+                if re.match(filter_expr, val[type_filter["filter_what"]]) is None:
+                    return None
+            if isinstance(val_emit_key, unicode):
+                val_emit_key = val_emit_key.encode('utf-8')
+            if not with_value:
+                return {'id' : _id, 'key' : val_emit_key}
+            val_emit_value = val[emit_value]
+            return {'value' : val_emit_value, 'key' : val_emit_key, 'id' : _id, }
+
+        return emitted_row_index((self.view.map_func, with_value), emit)
+
+    def filter_emitted_rows(self, index):
 
         query = self.query
 
@@ -3465,11 +3779,12 @@ class GenerateExpectedViewResultsTask(Task):
         inclusive_end_false = 'inclusive_end' in query and query['inclusive_end'] == "false"
         key_set = 'key' in query
 
-
-        # sort expected results to match view results
-        expected_rows = sorted(self.emitted_rows,
-                               cmp=GenerateExpectedViewResultsTask.cmp_result_rows,
-                               reverse=descending_set)
+        # the index is sorted to match ascending view results, the filters
+        # below narrow the lo:hi slice of it
+        lo, hi = 0, len(index)
+        first_key, last_key = index.first_key(), index.last_key()
+        if descending_set:
+            first_key, last_key = last_key, first_key
 
         # filter rows according to query flags
         if startkey_set:
@@ -3480,7 +3795,7 @@ class GenerateExpectedViewResultsTask(Task):
                 start_key = start_key[1:-1].split(',')
                 start_key = map(lambda x:int(x) if x != 'null' else None, start_key)
         else:
-            start_key = expected_rows[0]['key']
+            start_key = first_key
             if isinstance(start_key, str) and start_key.find('"') == 0:
                 start_key = start_key[1:-1]
         if endkey_set:
@@ -3491,7 +3806,7 @@ class GenerateExpectedViewResultsTask(Task):
                 end_key = end_key[1:-1].split(',')
                 end_key = map(lambda x:int(x) if x != 'null' else None, end_key)
         else:
-            end_key = expected_rows[-1]['key']
+            end_key = last_key
             if isinstance(end_key, str) and end_key.find('"') == 0:
                 end_key = end_key[1:-1]
 
@@ -3503,7 +3818,7 @@ class GenerateExpectedViewResultsTask(Task):
                 start_key = start_key.strip("\"")
             if isinstance(end_key, str):
                 end_key = end_key.strip("\"")
-            expected_rows = [row for row in expected_rows if row['key'] >= start_key and row['key'] <= end_key]
+            lo, hi = index.key_range(start_key, end_key, lo, hi)
 
         if key_set:
             key_ = query['key']
@@ -3511,9 +3826,10 @@ class GenerateExpectedViewResultsTask(Task):
                 key_ = key_[1:-1].split(',')
                 key_ = map(lambda x:int(x) if x != 'null' else None, key_)
             start_key, end_key = key_, key_
-            expected_rows = [row for row in expected_rows if row['key'] == key_]
-
+            lo, hi = index.key_range(key_, key_, lo, hi)
 
+        # all the rows left have start_key <= key <= end_key, so the doc id
+        # filters only drop rows from either end of the slice
         if descending_set:
             startkey_docid_set, endkey_docid_set = endkey_docid_set, startkey_docid_set
 
@@ -3531,8 +3847,7 @@ class GenerateExpectedViewResultsTask(Task):
                     do_filter = True
 
                 if do_filter:
-                    expected_rows = \
-                        [row for row in expected_rows if row['id'] >= startkey_docid or row['key'] > start_key]
+                    lo = index.from_key_id(start_key, startkey_docid, lo)
 
         if endkey_docid_set:
             if not endkey_set:
@@ -3548,86 +3863,23 @@ class GenerateExpectedViewResultsTask(Task):
                     do_filter = True
 
                 if do_filter:
-                    expected_rows = \
-                        [row for row in expected_rows if row['id'] <= endkey_docid or row['key'] < end_key]
+                    hi = index.through_key_id(end_key, endkey_docid, hi)
 
 
         if inclusive_end_false:
             if endkey_set and endkey_docid_set:
                 # remove all keys that match endkey
-                expected_rows = [row for row in expected_rows if row['id'] < query['endkey_docid']  or row['key'] < end_key]
+                if lo < hi:
+                    hi = index.before_key_id(end_key, query['endkey_docid'], hi)
             elif endkey_set:
-                expected_rows = [row for row in expected_rows if row['key'] != end_key]
+                hi = index.before_key(end_key, hi)
+        hi = max(lo, hi)
 
         if self.is_reduced:
-            groups = {}
-            gr_level = None
-            if not 'group' in query and\
-               not 'group_level' in query:
-               if len(expected_rows) == 0:
-                   expected_rows = []
-                   self.emitted_rows = expected_rows
-                   return
-               if self.view.red_func == '_count':
-                   groups[None] = len(expected_rows)
-               elif self.view.red_func == '_sum':
-                   groups[None] = 0
-                   groups[None] = math.fsum([row['value']
-                                               for row in expected_rows])
-               elif self.view.red_func == '_stats':
-                   groups[None] = {}
-                   values = [row['value'] for row in expected_rows]
-                   groups[None]['count'] = len(expected_rows)
-                   groups[None]['sum'] = math.fsum(values)
-                   groups[None]['max'] = max(values)
-                   groups[None]['min'] = min(values)
-                   groups[None]['sumsqr'] = math.fsum(map(lambda x: x * x, values))
-               elif self.custom_red_fn:
-                   custom_action = re.sub(r'.*return[ +]', '', re.sub(r'.*return[ +]', '', self.view.red_func))
-                   if custom_action.find('String') != -1:
-                       groups[None] = str(len(expected_rows))
-                   elif custom_action.find('-') != -1:
-                       groups[None] = -len(expected_rows)
-            elif 'group' in query and query['group'] == 'true':
-                if not 'group_level' in query:
-                    gr_level = len(expected_rows) - 1
-            elif 'group_level' in query:
-                gr_level = int(query['group_level'])
-            if gr_level is not None:
-                for row in expected_rows:
-                    key = str(row['key'][:gr_level])
-                    if not key in groups:
-                        if self.view.red_func == '_count':
-                            groups[key] = 1
-                        elif self.view.red_func == '_sum':
-                            groups[key] = row['value']
-                        elif self.view.red_func == '_stats':
-                            groups[key] = {}
-                            groups[key]['count'] = 1
-                            groups[key]['sum'] = row['value']
-                            groups[key]['max'] = row['value']
-                            groups[key]['min'] = row['value']
-                            groups[key]['sumsqr'] = row['value'] ** 2
-                    else:
-                        if self.view.red_func == '_count':
-                           groups[key] += 1
-                        elif self.view.red_func == '_sum':
-                            groups[key] += row['value']
-                        elif self.view.red_func == '_stats':
-                            groups[key]['count'] += 1
-                            groups[key]['sum'] += row['value']
-                            groups[key]['max'] = max(row['value'], groups[key]['max'])
-                            groups[key]['min'] = min(row['value'], groups[key]['min'])
-                            groups[key]['sumsqr'] += row['value'] ** 2
-            expected_rows = []
-            for group, value in groups.iteritems():
-                if isinstance(group, str) and group.find("[") == 0:
-                    group = group[1:-1].split(",")
-                    group = [int(k) for k in group]
-                expected_rows.append({"key" : group, "value" : value})
-            expected_rows = sorted(expected_rows,
-                               cmp=GenerateExpectedViewResultsTask.cmp_result_rows,
-                               reverse=descending_set)
+            grouping = (self.view.red_func, query.get('group'), query.get('group_level'))
+            expected_rows = index.aggregate(grouping, lo, hi, descending_set, self.reduce_rows)
+        else:
+            expected_rows = index.rows(lo, hi, descending_set)
         if 'skip' in query:
             expected_rows = expected_rows[(int(query['skip'])):]
         if 'limit' in query:
@@ -3635,6 +3887,76 @@ class GenerateExpectedViewResultsTask(Task):
 
         self.emitted_rows = expected_rows
 
+    def reduce_rows(self, expected_rows):
+        query = self.query
+        descending_set = 'descending' in query and query['descending'] == "true"
+        groups = {}
+        gr_level = None
+        if not 'group' in query and\
+           not 'group_level' in query:
+           if len(expected_rows) == 0:
+               return []
+           if self.view.red_func == '_count':
+               groups[None] = len(expected_rows)
+           elif self.view.red_func == '_sum':
+               groups[None] = 0
+               groups[None] = math.fsum([row['value']
+                                           for row in expected_rows])
+           elif self.view.red_func == '_stats':
+               groups[None] = {}
+               values = [row['value'] for row in expected_rows]
+               groups[None]['count'] = len(expected_rows)
+               groups[None]['sum'] = math.fsum(values)
+               groups[None]['max'] = max(values)
+               groups[None]['min'] = min(values)
+               groups[None]['sumsqr'] = math.fsum(map(lambda x: x * x, values))
+           elif self.custom_red_fn:
+               custom_action = re.sub(r'.*return[ +]', '', re.sub(r'.*return[ +]', '', self.view.red_func))
+               if custom_action.find('String') != -1:
+                   groups[None] = str(len(expected_rows))
+               elif custom_action.find('-') != -1:
+                   groups[None] = -len(expected_rows)
+        elif 'group' in query and query['group'] == 'true':
+            if not 'group_level' in query:
+                gr_level = len(expected_rows) - 1
+        elif 'group_level' in query:
+            gr_level = int(query['group_level'])
+        if gr_level is not None:
+            for row in expected_rows:
+                key = str(row['key'][:gr_level])
+                if not key in groups:
+                    if self.view.red_func == '_count':
+                        groups[key] = 1
+                    elif self.view.red_func == '_sum':
+                        groups[key] = row['value']
+                    elif self.view.red_func == '_stats':
+                        groups[key] = {}
+                        groups[key]['count'] = 1
+                        groups[key]['sum'] = row['value']
+                        groups[key]['max'] = row['value']
+                        groups[key]['min'] = row['value']
+                        groups[key]['sumsqr'] = row['value'] ** 2
+                else:
+                    if self.view.red_func == '_count':
+                       groups[key] += 1
+                    elif self.view.red_func == '_sum':
+                        groups[key] += row['value']
+                    elif self.view.red_func == '_stats':
+                        groups[key]['count'] += 1
+                        groups[key]['sum'] += row['value']
+                        groups[key]['max'] = max(row['value'], groups[key]['max'])
+                        groups[key]['min'] = min(row['value'], groups[key]['min'])
+                        groups[key]['sumsqr'] += row['value'] ** 2
+        expected_rows = []
+        for group, value in groups.iteritems():
+            if isinstance(group, str) and group.find("[") == 0:
+                group = group[1:-1].split(",")
+                group = [int(k) for k in group]
+            expected_rows.append({"key" : group, "value" : value})
+        return sorted(expected_rows,
+                      cmp=GenerateExpectedViewResultsTask.cmp_result_rows,
+                      reverse=descending_set)
+
     @staticmethod
     def cmp_result_rows(x, y):
         rc = cmp(x['key'], y['key'])
@@ -3681,11 +4003,18 @@ class ViewQueryVerificationTask(Task):
                 self.query["stale"] = "false"
                 self.query["reduce"] = "false"
                 self.query["include_docs"] = "true"
-                self.results = rest.query_view(self.design_doc_name, self.view_name,
-                                               self.bucket, self.query, timeout=self.query_timeout)
+                # stream the rows, only keeping docs for the ones whose values get verified
+                rows = []
+                for row in rest.query_view_rows(self.design_doc_name, self.view_name,
+                                                self.bucket, self.query, timeout=self.query_timeout):
+                    if len(rows) >= self.num_verified_docs:
+                        row.pop('doc', None)
+                    rows.append(row)
+                self.results = {'rows': rows}
             except QueryViewException as e:
                 self.set_exception(e)
                 self.state = FINISHED
+                return
 
 
             msg = "Checking view query results: (%d keys expected) vs (%d keys returned)" % \
@@ -1,51 +1,119 @@
 import time
-import Queue
+import heapq
+import itertools
+import logger
 
-from threading import Thread
+from collections import deque
+from threading import Thread, Condition
 from tasks.task import Task
 
 class TaskManager(Thread):
-    def __init__(self, thread_name=None):
+    """Schedules tasks on a pool of worker threads.
+
+    Ready tasks are kept in a FIFO queue and sleeping tasks in a heap ordered
+    by wakeup time, so the scheduler blocks on a condition variable until the
+    next task is actually due instead of polling. The TaskManager thread
+    itself only moves due tasks onto the ready queue; step() is run by one of
+    num_workers worker threads.
+    """
+
+    def __init__(self, thread_name=None, num_workers=1):
         Thread.__init__(self)
-        self.readyq = Queue.Queue()
-        self.sleepq = Queue.Queue()
+        self.log = logger.Logger.get_logger()
+        self.readyq = deque()
+        self.sleepq = []
         self.running = True
+        self.num_workers = max(1, int(num_workers))
+        self.workers = []
+        self.task_stats = {}
+        self._cond = Condition()
+        self._seq = itertools.count()
+        self._active = 0
         if thread_name is not None:
             self.name = thread_name
 
     def schedule(self, task, sleep_time=0):
         if not isinstance(task, Task):
             raise TypeError("Tried to schedule somthing that's not a task")
-        if sleep_time <= 0:
-            self.readyq.put(task)
-        else:
-            wakeup_time = time.time() + sleep_time
-            self.sleepq.put({'task': task, 'time': wakeup_time})
+        now = time.time()
+        with self._cond:
+            if sleep_time <= 0:
+                self.readyq.append((now, task))
+            else:
+                heapq.heappush(self.sleepq, (now + sleep_time, self._seq.next(), task))
+            self._cond.notify_all()
+
+    def start(self):
+        Thread.start(self)
+        for i in range(self.num_workers):
+            worker = Thread(target=self._worker, name="{0}_worker_{1}".format(self.name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
 
     def run(self):
-        while (self.running == True or self.readyq.empty() != True or self.sleepq.empty() != True):
-            if self.readyq.empty():
-                time.sleep(1)
-            else:
-                task = self.readyq.get()
-                task.step(self)
-            for i in range(self.sleepq.qsize()):
-                s_task = self.sleepq.get()
-                if time.time() >= s_task['time']:
-                    self.readyq.put(s_task['task'])
+        with self._cond:
+            while self.running or self.readyq or self.sleepq or self._active:
+                now = time.time()
+                woken = False
+                while self.sleepq and self.sleepq[0][0] <= now:
+                    wakeup_time, _, task = heapq.heappop(self.sleepq)
+                    self.readyq.append((wakeup_time, task))
+                    woken = True
+                if woken:
+                    self._cond.notify_all()
+                if self.sleepq:
+                    self._cond.wait(self.sleepq[0][0] - now)
                 else:
-                    self.sleepq.put(s_task)
+                    self._cond.wait()
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self.readyq:
+                    if not (self.running or self.sleepq or self._active):
+                        return
+                    self._cond.wait()
+                enqueue_time, task = self.readyq.popleft()
+                self._active += 1
+            start = time.time()
+            try:
+                task.step(self)
+            except Exception, ex:
+                self.log.error("Task {0} raised an unhandled exception: {1}".format(task.name, ex))
+                if not task.done():
+                    task.set_exception(ex)
+            finally:
+                end = time.time()
+                with self._cond:
+                    self._active -= 1
+                    self._record(task, start - enqueue_time, end - start)
+                    self._cond.notify_all()
+
+    def _record(self, task, queue_wait, step_time):
+        task.steps += 1
+        task.queue_wait_time += queue_wait
+        task.step_time += step_time
+        stats = self.task_stats.setdefault(task.__class__.__name__,
+                                           {'steps': 0, 'queue_wait_time': 0.0, 'step_time': 0.0})
+        stats['steps'] += 1
+        stats['queue_wait_time'] += queue_wait
+        stats['step_time'] += step_time
+
+    def get_stats(self):
+        """Returns per task type totals of steps, time spent waiting on the
+        ready queue and time spent inside step()"""
+        with self._cond:
+            return dict((name, dict(stats)) for name, stats in self.task_stats.iteritems())
 
     def shutdown(self, force=False):
-        self.running = False
-        if force:
-            while not self.sleepq.empty():
-                task = self.sleepq.get()['task']
-                task.cancel()
-                self.readyq.put(task)
-            while not self.readyq.empty():
-                try:
-                    task = self.readyq.get()
+        with self._cond:
+            self.running = False
+            if force:
+                while self.sleepq:
+                    heapq.heappop(self.sleepq)[2].cancel()
+                while self.readyq:
+                    task = self.readyq.popleft()[1]
                     task.cancel()
-                except Exception, ex:
-                    raise ex
\ No newline at end of file
+            self._cond.notify_all()
@@ -219,6 +219,11 @@ WIN_UNZIP = "https://s3-us-west-1.amazonaws.com/qebucket/testrunner/win-cmd/unzi
 WIN_PSSUSPEND = "https://s3-us-west-1.amazonaws.com/qebucket/testrunner/win-cmd/pssuspend.exe"
 # the maximum number of processes to allow under high_throughput data loading
 THROUGHPUT_CONCURRENCY = 4
+# the number of worker threads TaskManager runs task steps on
+TASK_MANAGER_WORKERS = 4
+# parallelism and overall time limit (sec) for post-failure log collection
+COLLECT_MAX_WORKERS = 8
+COLLECT_TIME_BUDGET = 1800
 # determine wether or not to use high throughput
 ALLOW_HTP = True
 IS_CONTAINER = False
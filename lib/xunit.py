@@ -101,6 +101,30 @@ class XUnitTestResult(object):
             report_xml_file.write(self.to_xml(suite))
             report_xml_file.close()
 
+    def merge(self, report_file):
+        """Adds the tests of an xml report written by write() to this result,
+        returns the list of (name, status, time) merged"""
+        merged = []
+        doc = xml.dom.minidom.parse(report_file)
+        for testcase in doc.getElementsByTagName('testcase'):
+            full_name = testcase.getAttribute('name')
+            name, params = full_name, ''
+            if "," in full_name:
+                name = full_name[:full_name.find(",")]
+                params = full_name[full_name.find(","):]
+            test_time = float(testcase.getAttribute('time') or 0)
+            errors = testcase.getElementsByTagName('error')
+            if errors:
+                message = ''.join(node.data for node in errors[0].childNodes
+                                  if node.nodeType == node.TEXT_NODE).strip()
+                self.add_test(name, test_time, errors[0].getAttribute('type'),
+                              message, status='fail', params=params)
+                merged.append((name, 'fail', test_time))
+            else:
+                self.add_test(name, test_time, params=params)
+                merged.append((name, 'pass', test_time))
+        return merged
+
     def print_summary(self):
         for suite in self.suites:
             oks = []
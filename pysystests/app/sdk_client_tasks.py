@@ -24,6 +24,7 @@ from app.rest_client_tasks import create_rest
 import couchbase
 
 from cache import CacheHelper
+import keyspace
 from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
 
@@ -94,7 +95,7 @@ def mset(keys, template, bucket = "default", isupdate = False, password = "", ho
     rawTemplate = copy.deepcopy(template)
     decodeMajgicStrings(rawTemplate)
     msg = {}
-    for key in keys:
+    for key in keyspace.keys(keys):
        msg[key] = rawTemplate
 
     try:
@@ -115,7 +116,7 @@ def mget(keys, bucket = "default", password = "", hosts = None):
     cb = mget.couchbaseClient(bucket, password)
 
     try:
-        cb.get_multi(keys)
+        cb.get_multi(keyspace.keys(keys))
     except Exception:
         mget._conn = None
 
@@ -127,7 +128,7 @@ def mdelete(keys, bucket = "default", password = "", hosts = None):
     mdelete.set_hosts(hosts)
     cb = mdelete.couchbaseClient(bucket, password)
     try:
-        cb.delete_multi(keys)
+        cb.delete_multi(keyspace.keys(keys))
     except Exception:
         mdelete._conn = None
 
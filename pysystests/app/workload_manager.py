@@ -20,6 +20,7 @@ from celery.exceptions import TimeoutError
 from celery.signals import task_postrun
 from celery.utils.log import get_task_logger
 from membase.helper.cluster_helper import ClusterOperationHelper
+import keyspace
 
 logger = get_task_logger(__name__)
 
@@ -230,6 +231,7 @@ def task_postrun_handler(sender=None, task_id=None, task=None, args=None, kwargs
             if isupdate == False:
 
                 # allow multi set keys to be consumed
+                # keys is the key range that was set
                 keys = retval[0]
                 template = retval[1]
                 bucket = args[2]
@@ -237,8 +239,9 @@ def task_postrun_handler(sender=None, task_id=None, task=None, args=None, kwargs
                 indexed_keys = template['indexed_keys']
 
                 if len(indexed_keys) > 0:
-                   if keys is not None and len(keys) > 0:
-                       updateQueryBuilders.apply_async(args=[template, bucket, keys[0]])
+                   key = keyspace.first_key(keys)
+                   if key is not None:
+                       updateQueryBuilders.apply_async(args=[template, bucket, key])
 
                 # put created item into specified cc_queues (if specified)
                 # and item is not set to expire
@@ -246,7 +249,7 @@ def task_postrun_handler(sender=None, task_id=None, task=None, args=None, kwargs
                     for queue in template["cc_queues"]:
                         queue = str(queue)
                         rabbitHelper.declare(queue)
-                        if keys is not None and len(keys) > 0:
+                        if keyspace.size(keys) > 0:
                             rabbitHelper.putMsg(queue, json.dumps(keys))
         else:
             logger.error("Error during multi set")
@@ -489,111 +492,94 @@ def _random_string(length):
 
 def generate_set_tasks(template, count, bucket = "default", password = "", hosts = None, batch_size = 1000):
 
-
-    if batch_size > count:
-        batch_size = count
+    # doc keys are regenerated by the tasks from a new seed,
+    # only the key ranges are sent to the workers
+    seed = str(uuid.uuid4())
 
     tasks = []
-    batch_counter = 0
-    i = 0
-    while i < count:
-
-        key_batch = []
-        end_cursor = i + batch_size
-        if end_cursor > count:
-            batch_size = count - i
-
-        while batch_counter < batch_size:
-            # create doc keys
-            key = _random_string(12)
-            key_batch.append(key)
-            batch_counter = batch_counter + 1
-            i = i + 1
-
-        tasks.append(client.mset.s(key_batch, template.__dict__, bucket, False, password, hosts))
-        batch_counter = 0
+    for key_range in keyspace.key_ranges("", seed, 0, count, batch_size):
+        tasks.append(client.mset.s(key_range, template.__dict__, bucket, False, password, hosts))
 
     return tasks
 
-@celery.task(base = PersistedMQ, ignore_result = True)
-def generate_get_tasks(count, docs_queue, bucket="default", password = "", hosts = None):
-
-    rabbitHelper = generate_get_tasks.rabbitHelper
+def take_key_ranges(rabbitHelper, count, docs_queue, requeue = True, batch_size = 1000):
+    """ takes key ranges holding count keys from docs_queue in batches of batch_size.
+        with requeue ranges are only read and stay on the queue for the next cycles,
+        otherwise the keys not needed from the last range are put back for
+        other tasks to take """
 
-    tasks = []
+    ranges = []
     keys_retrieved = 0
 
     while keys_retrieved < count:
 
         if rabbitHelper.qsize(docs_queue) == 0:
-            msg = ("%s keys retrieved, Requested %s ") % (keys_retrieved, count)
-            logger.info(msg)
             break
 
-        keys = rabbitHelper.getJsonMsg(docs_queue, requeue = True)
-        keys_retrieved = keys_retrieved + len(keys)
+        msg = rabbitHelper.getJsonMsg(docs_queue, requeue = requeue)
+        if keyspace.size(msg) == 0:
+            break
 
-        if len(keys) > 0:
-            if keys_retrieved > count:
-                end_idx = keys_retrieved - count
-                keys = keys[:-end_idx]
-            tasks.append(client.mget.s(keys, bucket, password, hosts))
+        msg, rest = keyspace.split(msg, count - keys_retrieved)
+        if rest is not None and not requeue:
+            rabbitHelper.putMsg(docs_queue, json.dumps(rest))
 
-    return tasks
+        while keyspace.size(msg) > 0:
+            batch, msg = keyspace.split(msg, batch_size)
+            ranges.append(batch)
+            keys_retrieved = keys_retrieved + keyspace.size(batch)
 
+    return ranges, keys_retrieved
 
 @celery.task(base = PersistedMQ, ignore_result = True)
-def generate_update_tasks(template, count, docs_queue, bucket = "default", password = "", hosts = None):
-
-    rabbitHelper = generate_update_tasks.rabbitHelper
-    val = json.dumps(template.kv)
-
-    tasks = []
-    keys_updated = 0
+def generate_get_tasks(count, docs_queue, bucket="default", password = "", hosts = None):
 
-    while keys_updated < count:
-        if rabbitHelper.qsize(docs_queue) == 0:
-            msg = ("Error: %s keys updated, Requested %s ") % (keys_updated, count)
-            logger.info(msg)
-            break
+    rabbitHelper = generate_get_tasks.rabbitHelper
 
-        keys = rabbitHelper.getJsonMsg(docs_queue, requeue = True)
-        keys_updated = keys_updated + len(keys)
+    ranges, keys_retrieved = take_key_ranges(rabbitHelper, count, docs_queue)
+    if keys_retrieved < count:
+        msg = ("%s keys retrieved, Requested %s ") % (keys_retrieved, count)
+        logger.info(msg)
 
-        if len(keys) > 0:
-            if keys_updated > count:
-                end_idx = keys_updated - count
-                keys = keys[:-end_idx]
-            tasks.append(client.mset.s(keys, template.__dict__, bucket, True, password = "", hosts = hosts))
+    tasks = []
+    for key_range in ranges:
+        tasks.append(client.mget.s(key_range, bucket, password, hosts))
 
     return tasks
 
 
 @celery.task(base = PersistedMQ, ignore_result = True)
-def generate_delete_tasks(count, docs_queue, bucket = "default", password = "", hosts = None):
+def generate_update_tasks(template, count, docs_queue, bucket = "default", password = "", hosts = None):
 
+    rabbitHelper = generate_update_tasks.rabbitHelper
 
-    rabbitHelper = generate_delete_tasks.rabbitHelper
+    ranges, keys_updated = take_key_ranges(rabbitHelper, count, docs_queue)
+    if keys_updated < count:
+        msg = ("Error: %s keys updated, Requested %s ") % (keys_updated, count)
+        logger.info(msg)
 
     tasks = []
-    keys_deleted = 0
+    for key_range in ranges:
+        tasks.append(client.mset.s(key_range, template.__dict__, bucket, True, password = "", hosts = hosts))
+
+    return tasks
 
-    while keys_deleted < count:
 
-        if rabbitHelper.qsize(docs_queue) == 0:
-            msg = ("%s keys deleted, Requested %s ") % (keys_deleted, count)
-            logger.info(msg)
-            break
+@celery.task(base = PersistedMQ, ignore_result = True)
+def generate_delete_tasks(count, docs_queue, bucket = "default", password = "", hosts = None):
 
-        keys = rabbitHelper.getJsonMsg(docs_queue)
-        keys_deleted = keys_deleted + len(keys)
 
-        if len(keys) > 0:
-            if keys_deleted > count:
-                end_idx = keys_deleted - count
-                keys = keys[:-end_idx]
-            tasks.append(client.mdelete.s(keys, bucket, password, hosts = hosts))
+    rabbitHelper = generate_delete_tasks.rabbitHelper
+
+    # deleted keys are taken off the queue
+    ranges, keys_deleted = take_key_ranges(rabbitHelper, count, docs_queue, requeue = False)
+    if keys_deleted < count:
+        msg = ("%s keys deleted, Requested %s ") % (keys_deleted, count)
+        logger.info(msg)
 
+    tasks = []
+    for key_range in ranges:
+        tasks.append(client.mdelete.s(key_range, bucket, password, hosts = hosts))
 
     return tasks
 
@@ -637,8 +623,7 @@ def report_kv_latency(bucket = "default"):
             consume_queue = workload.consume_queue
             if consume_queue is not None:
                 keys = rabbitHelper.getJsonMsg(str(consume_queue), requeue = True)
-                if len(keys) > 0:
-                    get_key = str(keys['start'])
+                get_key = keyspace.first_key(keys) or get_key
 
             # collect op latency
             set_latency = client.mc_op_latency('set', key, value, ip, port, bucket, password)
@@ -18,6 +18,7 @@ import testcfg as cfg
 # rabbit
 from librabbitmq import Connection
 from rabbit_helper import RabbitHelper
+import keyspace
 
 
 # para
@@ -50,6 +51,7 @@ class SDKClient(threading.Thread):
     def __init__(self, name, task, e):
         threading.Thread.__init__(self)
         self.name = name
+        self.seed = task['id']
         self.i = 0
         self.op_factor = CLIENTSPERPROCESS * PROCSPERTASK
         self.ops_sec = task['ops_sec']
@@ -70,7 +72,7 @@ class SDKClient(threading.Thread):
         self.consume_queue = task['consume_queue']
         self.standalone = task['standalone']
         self.ccq = None
-        self.hotkey_batches = []
+        self.hotkey_ranges = []
 
         if self.consume_queue is not None:
             RabbitHelper().declare(self.consume_queue)
@@ -170,17 +172,15 @@ class SDKClient(threading.Thread):
                     pass
 
         # hot keys
-        if flush_hotkeys and (len(self.hotkey_batches) > 0):
+        if flush_hotkeys and (len(self.hotkey_ranges) > 0):
 
             # try to put onto remote queue
             queue = self.consume_queue or self.ccq
 
             if queue is not None:
-                key_map = {'start' : self.hotkey_batches[0][0],
-                           'end' : self.hotkey_batches[-1][-1]}
-                msg = json.dumps(key_map)
-                mq.putMsg(queue, msg)
-                self.hotkey_batches = []
+                for key_range in self.hotkey_ranges:
+                    mq.putMsg(queue, json.dumps(key_range))
+                self.hotkey_ranges = []
 
 
     def do_cycle(self):
@@ -213,29 +213,17 @@ class SDKClient(threading.Thread):
 
 
     def mset(self, template, count, ttl = 0):
-        msg = {}
-        keys = []
-        cursor = 0
-        j = 0
 
         template = resolveTemplate(template)
-        for j in xrange(count):
-            self.i = self.i+1
-            msg[self.name+str(self.i)] = template
-            keys.append(self.name+str(self.i))
-
-            if ((j+1) % self.batch_size) == 0:
-                batch = keys[cursor:j+1]
-                self._mset(msg, ttl)
-                self.memq.put_nowait({'start' : batch[0],
-                                      'end'  : batch[-1]})
-                msg = {}
-                cursor = j
-            elif j == (count -1):
-                batch = keys[cursor:]
-                self._mset(msg, ttl)
-                self.memq.put_nowait({'start' : batch[0],
-                                      'end'  : batch[-1]})
+        for key_range in keyspace.key_ranges(self.name, self.seed, self.i,
+                                             count, self.batch_size):
+            msg = {}
+            for key in keyspace.keys(key_range):
+                msg[key] = template
+            self._mset(msg, ttl)
+            self.memq.put_nowait(key_range)
+
+        self.i = self.i + count
 
 
     def _mset(self, msg, ttl = 0):
@@ -346,46 +334,43 @@ class SDKClient(threading.Thread):
         num_to_miss = int( ((self.miss_perc/float(100)) * count))
         miss_batches = self.getKeys(num_to_miss, force_stale = True)
 
-        if len(self.hotkey_batches) == 0:
+        if len(self.hotkey_ranges) == 0:
             # hotkeys are taken off queue and cannot be reused
             # until workload is flushed
             need = count - num_to_miss
-            self.hotkey_batches = self.getKeys(need, requeue = False)
+            self.hotkey_ranges = self.getKeyRanges(need, requeue = False)
 
 
-        batches = miss_batches + self.hotkey_batches
+        batches = miss_batches + [keyspace.keys(r) for r in self.hotkey_ranges]
         return batches
 
     def getKeys(self, count, requeue = True, force_stale = False):
+        return [keyspace.keys(key_range) for key_range in
+                self.getKeyRanges(count, requeue, force_stale = force_stale)]
+
+    def getKeyRanges(self, count, requeue = True, force_stale = False):
 
         keys_retrieved = 0
-        batches = []
+        ranges = []
 
         while keys_retrieved < count:
 
-            # get keys
-            keys = self.getKeysFromQueue(requeue, force_stale = force_stale)
+            # get a key range
+            key_range = self.getKeyRangeFromQueue(count - keys_retrieved, requeue,
+                                                  force_stale = force_stale)
 
-            if len(keys) == 0:
+            if keyspace.size(key_range) == 0:
                 break
 
-            # in case we got too many keys slice the batch
-            need = count - keys_retrieved
-            if(len(keys) > need):
-                keys = keys[:need]
-
-            keys_retrieved = keys_retrieved + len(keys)
-
-            # add to batch
-            batches.append(keys)
+            keys_retrieved = keys_retrieved + keyspace.size(key_range)
+            ranges.append(key_range)
 
 
-        return batches
+        return ranges
 
-    def getKeysFromQueue(self, requeue = True, force_stale = False):
+    def getKeyRangeFromQueue(self, count, requeue = True, force_stale = False):
 
-        # get key mapping and convert to keys
-        keys = []
+        # takes at most count keys off a queued key range
         key_map = None
 
         # priority to stale queue
@@ -393,26 +378,21 @@ class SDKClient(threading.Thread):
             key_map = self.getKeyMapFromRemoteQueue(requeue)
 
         # fall back to local qeueue
-        if key_map is None:
+        if not key_map:
             key_map = self.getKeyMapFromLocalQueue(requeue)
 
-        if key_map:
-            keys = self.keyMapToKeys(key_map)
-
-
-        return keys
+        if not key_map:
+            return None
 
-    def keyMapToKeys(self, key_map):
+        # in case we got too many keys split the range,
+        # unless the range stays queued the rest is left in
+        # the local queue to be used later or stolen by
+        # other consumers once flushed
+        key_map, rest = keyspace.split(key_map, count)
+        if rest is not None and not requeue:
+            self.memq.put_nowait(rest)
 
-        keys = []
-        # reconstruct key-space
-        prefix, start_idx = key_map['start'].split('_')
-        prefix, end_idx = key_map['end'].split('_')
-
-        for i in range(int(start_idx), int(end_idx) + 1):
-            keys.append(prefix+"_"+str(i))
-
-        return keys
+        return key_map
 
 
     def fillq(self):
@@ -0,0 +1,75 @@
+"""
+
+Seeded key ranges.
+
+A key range {'prefix', 'seed', 'start', 'count'} describes the keys
+key(prefix, seed, i) for start <= i < start + count. Keys are regenerated
+locally by whoever handles a range, so only these small descriptors go
+over the broker instead of key lists, and a range is split or partly
+taken (stolen) by moving its start and count.
+
+Key lists sent by older producers are still accepted everywhere a range is.
+
+"""
+
+import hashlib
+
+
+def key(prefix, seed, i):
+    return prefix + hashlib.md5("%s:%s" % (seed, i)).hexdigest()[:24].upper()
+
+def key_range(prefix, seed, start, count):
+    return {'prefix' : prefix,
+            'seed' : seed,
+            'start' : start,
+            'count' : count}
+
+def key_ranges(prefix, seed, start, count, batch_size):
+    """ consecutive ranges of at most batch_size keys covering count keys """
+    ranges = []
+    end = start + count
+    while start < end:
+        n = min(batch_size, end - start)
+        ranges.append(key_range(prefix, seed, start, n))
+        start = start + n
+    return ranges
+
+def is_key_range(msg):
+    return isinstance(msg, dict) and 'seed' in msg
+
+def size(msg):
+    if is_key_range(msg):
+        return msg['count']
+    if isinstance(msg, list):
+        return len(msg)
+    return 0
+
+def keys(msg):
+    if is_key_range(msg):
+        prefix, seed, start = str(msg['prefix']), msg['seed'], msg['start']
+        return [key(prefix, seed, i) for i in xrange(start, start + msg['count'])]
+    if isinstance(msg, list):
+        return [str(k) for k in msg]
+    return []
+
+def first_key(msg):
+    if is_key_range(msg):
+        if msg['count'] > 0:
+            return key(str(msg['prefix']), msg['seed'], msg['start'])
+    elif isinstance(msg, list) and len(msg) > 0:
+        return str(msg[0])
+    return None
+
+def split(msg, count):
+    """ splits off the first count keys of msg,
+        returns (head, rest) where rest is None when nothing is left """
+    if size(msg) <= count:
+        return msg, None
+
+    if is_key_range(msg):
+        head = key_range(msg['prefix'], msg['seed'], msg['start'], count)
+        rest = key_range(msg['prefix'], msg['seed'], msg['start'] + count,
+                         msg['count'] - count)
+        return head, rest
+
+    return msg[:count], msg[count:]
@@ -1617,7 +1617,8 @@ class BaseTestCase(unittest.TestCase):
     def get_data_set_all(self, servers, buckets, path=None, mode="disk"):
         """ Method to get all data set for buckets and from the servers """
         servers = self.get_kv_nodes(servers)
-        info, dataset = self.data_collector.collect_data(servers, buckets, data_path=path, perNode=False, mode=mode)
+        info, dataset = self.data_collector.collect_data(servers, buckets, data_path=path, perNode=False, mode=mode,
+                                                         fingerprints=True)
         return dataset
 
     def get_data_set_with_data_distribution_all(self, servers, buckets, path=None, mode="disk"):
@@ -1643,9 +1644,9 @@ class BaseTestCase(unittest.TestCase):
         """
         servers = self.get_kv_nodes(servers)
         info, disk_replica_dataset = self.data_collector.collect_data(servers, buckets, data_path=path, perNode=False,
-                                                                      getReplica=True, mode=mode)
+                                                                      getReplica=True, mode=mode, fingerprints=True)
         info, disk_active_dataset = self.data_collector.collect_data(servers, buckets, data_path=path, perNode=False,
-                                                                     getReplica=False, mode=mode)
+                                                                     getReplica=False, mode=mode, fingerprints=True)
         self.log.info(" Begin Verification for Active Vs Replica ")
         comparison_result = self.data_analyzer.compare_all_dataset(info, disk_replica_dataset, disk_active_dataset)
         logic, summary, output = self.result_analyzer.analyze_all_result(comparison_result, deletedItems=False,
@@ -1778,9 +1779,9 @@ class BaseTestCase(unittest.TestCase):
         """
         self.log.info(" Begin Verification for data comparison ")
         info, curr_data_set_replica = self.data_collector.collect_data(servers, buckets, data_path=path, perNode=False,
-                                                                       getReplica=True, mode=mode)
+                                                                       getReplica=True, mode=mode, fingerprints=True)
         info, curr_data_set_active = self.data_collector.collect_data(servers, buckets, data_path=path, perNode=False,
-                                                                      getReplica=False, mode=mode)
+                                                                      getReplica=False, mode=mode, fingerprints=True)
         self.log.info(" Comparing :: Prev vs Current :: Active and Replica ")
         comparison_result_replica = self.data_analyzer.compare_all_dataset(info, prev_data_set_replica,
                                                                            curr_data_set_replica)
@@ -1809,7 +1810,7 @@ class BaseTestCase(unittest.TestCase):
         self.log.info(" Begin Verification for data comparison ")
         servers = self.get_kv_nodes(servers)
         info, curr_data_set = self.data_collector.collect_data(servers, buckets, data_path=path, perNode=False,
-                                                               mode=mode)
+                                                               mode=mode, fingerprints=True)
         comparison_result = self.data_analyzer.compare_all_dataset(info, prev_data_set, curr_data_set)
         logic, summary, output = self.result_analyzer.analyze_all_result(comparison_result, deletedItems=deletedItems,
                                                                          addedItems=addedItems,
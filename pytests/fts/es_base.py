@@ -2,6 +2,7 @@ import httplib2
 import json
 from tasks.taskmanager import TaskManager
 from tasks.task import *
+from membase.api.rest_client import HTTP_POOL
 
 class BLEVE:
     STOPWORDS = ['i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves',
@@ -191,10 +192,11 @@ class ElasticSearchBase(object):
             headers = {'Content-Type': 'application/json',
                        'Accept': '*/*'}
         try:
-            response, content = httplib2.Http(timeout=timeout).request(api,
-                                                                       method,
-                                                                       params,
-                                                                       headers)
+            response, content = HTTP_POOL.request(api,
+                                                  method,
+                                                  params,
+                                                  headers,
+                                                  timeout=timeout)
             if response['status'] in ['200', '201', '202']:
                 return True, content, response
             else:
@@ -393,12 +395,14 @@ class ElasticSearchBase(object):
         self.task_manager.schedule(_task)
         return _task
 
-    def async_bulk_load_ES(self, index_name, gen, op_type='create', batch=5000):
+    def async_bulk_load_ES(self, index_name, gen, op_type='create', batch=5000,
+                           concurrency=4):
         _task = ESBulkLoadGeneratorTask(es_instance=self,
                                     index_name=index_name,
                                     generator=gen,
                                     op_type=op_type,
-                                    batch=batch)
+                                    batch=batch,
+                                    concurrency=concurrency)
         self.task_manager.schedule(_task)
         return _task
 
@@ -423,6 +427,30 @@ class ElasticSearchBase(object):
         except Exception as e:
             raise e
 
+    def load_bulk_body(self, data, timeout=120):
+        """
+        Bulk load to ES from an in-memory NDJSON body, in the same format
+        as the file of load_bulk_data
+        :return: list of the errors of the actions ES rejected
+        """
+        status, content, _ = self._http_request(self.__connection_url + "_bulk",
+                                                'POST',
+                                                data,
+                                                timeout=timeout)
+        if not status:
+            return [content]
+        content = json.loads(content)
+        errors = []
+        if content.get('errors'):
+            for item in content['items']:
+                for action, result in item.iteritems():
+                    if 'error' in result:
+                        errors.append({"action": action,
+                                       "_id": result.get('_id'),
+                                       "status": result.get('status'),
+                                       "error": result['error']})
+        return errors
+
     def load_data(self, index_name, document_json, doc_type, doc_id):
         """
         index_name : name of index into which the doc is loaded
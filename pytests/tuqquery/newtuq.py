@@ -8,6 +8,7 @@ import testconstants
 import time
 from couchbase_helper.tuq_generators import TuqGenerators
 from couchbase_helper.tuq_generators import JsonGenerator
+from couchbase_helper.result_comparator import check_missing_and_extra
 from remote.remote_util import RemoteMachineShellConnection
 from basetestcase import BaseTestCase
 from membase.api.exception import CBQError, ReadDocumentException
@@ -447,15 +448,7 @@ class QueryTests(BaseTestCase):
                                  expected_result[:100],expected_result[-100:]))
 
     def check_missing_and_extra(self, actual, expected):
-        missing = []
-        extra = []
-        for item in actual:
-            if not (item in expected):
-                 extra.append(item)
-        for item in expected:
-            if not (item in actual):
-                missing.append(item)
-        return missing, extra
+        return check_missing_and_extra(actual, expected)
 
     def sort_nested_list(self, result):
         actual_result = []
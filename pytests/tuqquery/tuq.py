@@ -19,6 +19,7 @@ from membase.api.rest_client import RestConnection
 from security.rbac_base import RbacBase
 # from sdk_client import SDKClient
 from couchbase_helper.tuq_generators import TuqGenerators
+from couchbase_helper.result_comparator import check_missing_and_extra
 #from xdcr.upgradeXDCR import UpgradeTests
 from couchbase_helper.documentgenerator import JSONNonDocGenerator
 
@@ -925,14 +926,7 @@ class QueryTests(BaseTestCase):
         self.assertTrue(actual_result == expected_result, msg)
 
     def check_missing_and_extra(self, actual, expected):
-        missing, extra = [], []
-        for item in actual:
-            if not (item in expected):
-                 extra.append(item)
-        for item in expected:
-            if not (item in actual):
-                missing.append(item)
-        return missing, extra
+        return check_missing_and_extra(actual, expected)
 
     def sort_nested_list(self, result, key=None):
         actual_result = []
@@ -3250,48 +3250,19 @@ class XDCRNewBaseTest(unittest.TestCase):
         self.log.info("dest kvstore has %s valid and %s deleted keys"
                       % (len(valid_keys_dest), len(deleted_keys_dest)))
 
+        key_filter = None
         if filter_exp:
-            filtered_src_keys = filter(
-                lambda key: re.search(str(filter_exp), key) is not None,
-                valid_keys_src
-            )
-            valid_keys_src = filtered_src_keys
+            filter_re = re.compile(str(filter_exp))
+            key_filter = lambda key: filter_re.search(key) is not None
             self.log.info(
                 "{0} keys matched the filter expression {1}".format(
-                    len(valid_keys_src),
+                    len(filter(key_filter, valid_keys_src)),
                     filter_exp))
 
-        for key in valid_keys_src:
-            # replace/add the values for each key in src kvs
-            if key not in deleted_keys_dest:
-                partition1 = kv_src_bucket[kvs_num].acquire_partition(key)
-                partition2 = kv_dest_bucket[kvs_num].acquire_partition(key)
-                # In case of lww, if source's key timestamp is lower than
-                # destination than no need to set.
-                if self.__lww and partition1.get_timestamp(
-                        key) < partition2.get_timestamp(key):
-                    continue
-                key_add = partition1.get_key(key)
-                partition2.set(
-                    key,
-                    key_add["value"],
-                    key_add["expires"],
-                    key_add["flag"])
-                kv_src_bucket[kvs_num].release_partition(key)
-                kv_dest_bucket[kvs_num].release_partition(key)
-
-        for key in deleted_keys_src:
-            if key not in deleted_keys_dest:
-                partition1 = kv_src_bucket[kvs_num].acquire_partition(key)
-                partition2 = kv_dest_bucket[kvs_num].acquire_partition(key)
-                # In case of lww, if source's key timestamp is lower than
-                # destination than no need to delete.
-                if self.__lww and partition1.get_timestamp(
-                        key) < partition2.get_timestamp(key):
-                    continue
-                partition2.delete(key)
-                kv_src_bucket[kvs_num].release_partition(key)
-                kv_dest_bucket[kvs_num].release_partition(key)
+        num_set, num_deleted = kv_dest_bucket[kvs_num].merge_keys(
+            kv_src_bucket[kvs_num], key_filter=key_filter, lww=self.__lww)
+        self.log.info("Merged {0} valid and {1} deleted keys into destination"
+                      " kv_store".format(num_set, num_deleted))
 
         valid_keys_dest, deleted_keys_dest = kv_dest_bucket[
             kvs_num].key_set()
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
 import base64
+import ConfigParser
+import glob
 import gzip
+import json
 from httplib import BadStatusLine
 import os
+import subprocess
 import urllib2
 import sys
 import threading
@@ -23,6 +27,7 @@ import logging.config
 from threading import Thread, Event
 from xunit import XUnitTestResult
 from TestInput import TestInputParser, TestInputSingleton
+from testconstants import COLLECT_MAX_WORKERS, COLLECT_TIME_BUDGET
 from optparse import OptionParser, OptionGroup
 from scripts.collect_server_info import cbcollectRunner, couch_dbinfo_Runner
 from scripts.measure_sched_delays import SchedDelays
@@ -64,6 +69,11 @@ def parse_args(argv):
                       help="NO-OP - emit test names, but don't actually run them e.g -n true")
     parser.add_option("-l", "--log-level",
                       dest="loglevel", default="INFO", help="e.g -l info,warning,error")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="Run tests in N worker processes, each on its own slice of the"
+                           " [servers] in the .ini file e.g -j 4")
+    parser.add_option("--log-dir", dest="log_dir", default=None,
+                      help="Directory to store logs in, used by -j workers")
     options, args = parser.parse_args()
 
     tests = []
@@ -79,6 +89,9 @@ def parse_args(argv):
 
     test_params['cluster_name'] = splitext(os.path.basename(options.ini))[0]
 
+    if options.jobs < 1:
+        parser.error("-j must be at least 1")
+
     if not options.testcase and not options.conf:
         parser.error("please specify a configuration file (-c) or a test case (-t)")
         parser.print_help()
@@ -184,46 +197,190 @@ def parse_conf_file(filename, tests, params):
 
 
 def create_headers(username, password):
-    authorization = base64.encodestring('%s:%s' % (username, password))
+    authorization = base64.b64encode('%s:%s' % (username, password))
     return {'Content-Type': 'application/x-www-form-urlencoded',
             'Authorization': 'Basic %s' % authorization,
             'Accept': '*/*'}
 
 
-def get_server_logs(input, path):
-    for server in input.servers:
-        print "grabbing diags from ".format(server.ip)
-        diag_url = "http://{0}:{1}/diag".format(server.ip, server.port)
-        print diag_url
+class ArtifactCollector(object):
+    """Collects post-failure artifacts from all servers at once.
+
+    Jobs are (kind, server) pairs run on a bounded pool of threads, a job
+    succeeds when its func returns True. Jobs that have not started when
+    time_budget runs out are reported as timed out, the ones still running
+    are abandoned and their files are only listed as partial. What was
+    collected from where is added to <path>/collect_manifest.json."""
+
+    # artifact kind -> file name patterns the job leaves in the logs folder
+    ARTIFACTS = {'diag': ('{ip}-{port}-diag.txt.gz',),
+                 'cbcollect': ('{ip}-*-diag.zip',),
+                 'couch_dbinfo': ('{ip}-*-couch-dbinfo.txt',),
+                 'core_dumps': ('erlang-{ip}-*', 'breakpad-{ip}-*', 'core-{ip}-*')}
+
+    # status of the jobs of a kind whose func returned False
+    NOT_COLLECTED = {'core_dumps': 'none_found'}
+
+    def __init__(self, input, path, max_workers=None, time_budget=None):
+        self.input = input
+        self.path = path or "."
+        self.max_workers = max_workers or input.param("collect_workers", COLLECT_MAX_WORKERS)
+        self.time_budget = time_budget or input.param("collect_time_budget", COLLECT_TIME_BUDGET)
+        self.jobs = []
+        self.lock = threading.Lock()
 
+    def add(self, kind, func, servers=None):
+        for server in servers or self.input.servers:
+            self.jobs.append({'kind': kind, 'server': server.ip, 'port': server.port,
+                              'status': 'pending', 'func': func, 'args': (server,)})
+
+    def run(self):
+        """Runs all jobs, returns the list of jobs whose func returned True"""
+        if not self.jobs:
+            return []
+        deadline = time.time() + self.time_budget
+        pending = list(reversed(self.jobs))
+        workers = []
+        for i in range(min(self.max_workers, len(pending))):
+            worker = Thread(target=self._worker, args=(pending, deadline),
+                            name="collector_{0}".format(i))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join(max(0, deadline - time.time()))
+        with self.lock:
+            for job in self.jobs:
+                if job['status'] == 'pending':
+                    job['status'] = 'timeout'
+                elif job['status'] == 'running':
+                    # its thread keeps writing to the logs folder
+                    job['status'] = 'still_running'
+                else:
+                    continue
+                print "gave up collecting {0} from {1} after {2} sec".\
+                    format(job['kind'], job['server'], self.time_budget)
+        self.write_manifest()
+        return [job for job in self.jobs if job.get('result') is True]
+
+    def _worker(self, pending, deadline):
+        while time.time() < deadline:
+            with self.lock:
+                if not pending:
+                    return
+                job = pending.pop()
+                job['status'] = 'running'
+            start = time.time()
+            try:
+                result = job['func'](self.input, job['args'][0], self.path)
+                status = 'ok' if result else self.NOT_COLLECTED.get(job['kind'], 'failed')
+                error = None
+            except Exception as e:
+                result = None
+                status = 'error'
+                error = str(e)
+                print "NOT POSSIBLE TO GRAB {0} FROM {1}: {2}".format(job['kind'], job['server'], e)
+            with self.lock:
+                if job['status'] == 'running':
+                    job.update(status=status, result=result, error=error,
+                               time=round(time.time() - start, 2))
+
+    def collected_files(self, job):
+        ip = job['server'].replace('[', '').replace(']', '')
+        files = []
+        for name in set([ip, ip.replace(':', '.')]):
+            for pattern in self.ARTIFACTS.get(job['kind'], ()):
+                pattern = pattern.format(ip=name, port=job['port'])
+                files.extend(glob.glob(os.path.join(self.path, pattern)))
+        return sorted(set(os.path.basename(f) for f in files))
+
+    def write_manifest(self):
+        """Adds the jobs of this run to the manifest of the logs folder,
+        e.g. after the ones of the core dump collections of the same test"""
+        manifest_file = os.path.join(self.path, "collect_manifest.json")
+        manifest = []
+        if os.path.exists(manifest_file):
+            try:
+                with open(manifest_file) as f:
+                    manifest = json.load(f)
+            except (IOError, ValueError) as e:
+                print "unable to read collection manifest: {0}".format(e)
+        with self.lock:
+            for job in self.jobs:
+                entry = dict((k, v) for k, v in job.iteritems() if k not in ('func', 'args'))
+                if job['status'] == 'still_running':
+                    entry['partial_files'] = self.collected_files(job)
+                elif job['status'] == 'timeout':
+                    # never started, files of the same ip are another job's
+                    entry['files'] = []
+                else:
+                    entry['files'] = self.collected_files(job)
+                manifest.append(entry)
         try:
-            req = urllib2.Request(diag_url)
-            req.headers = create_headers(input.membase_settings.rest_username,
-                                         input.membase_settings.rest_password)
-            filename = "{0}/{1}-diag.txt".format(path, server.ip)
-            page = urllib2.urlopen(req)
-            with open(filename, 'wb') as output:
-                os.write(1, "downloading {0} ...".format(server.ip))
-                while True:
-                    buffer = page.read(65536)
-                    if not buffer:
-                        break
-                    output.write(buffer)
-                    os.write(1, ".")
-            file_input = open('{0}'.format(filename), 'rb')
-            zipped = gzip.open("{0}.gz".format(filename), 'wb')
-            zipped.writelines(file_input)
-            file_input.close()
-            zipped.close()
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f, indent=2, default=str)
+        except IOError as e:
+            print "unable to write collection manifest: {0}".format(e)
+        return manifest
+
 
+def _get_server_diag(input, server, path):
+    diag_url = "http://{0}:{1}/diag".format(server.ip, server.port)
+    print "grabbing diags from {0}".format(diag_url)
+    try:
+        req = urllib2.Request(diag_url)
+        req.headers = create_headers(input.membase_settings.rest_username,
+                                     input.membase_settings.rest_password)
+        # cluster_run servers share one ip
+        filename = "{0}/{1}-{2}-diag.txt.gz".format(path, server.ip, server.port)
+        page = urllib2.urlopen(req)
+        # compress while streaming instead of re-reading the whole file
+        zipped = gzip.open(filename, 'wb')
+        try:
+            while True:
+                buffer = page.read(65536)
+                if not buffer:
+                    break
+                zipped.write(buffer)
+        except Exception:
+            zipped.close()
             os.remove(filename)
-            print "downloaded and zipped diags @ : {0}".format("{0}.gz".format(filename))
-        except urllib2.URLError:
-            print "unable to obtain diags from %s" % diag_url
-        except BadStatusLine:
-            print "unable to obtain diags from %s" % diag_url
-        except Exception as e:
-            print "unable to obtain diags from %s %s" % (diag_url, e)
+            raise
+        zipped.close()
+        print "downloaded and zipped diags @ : {0}".format(filename)
+        return True
+    except urllib2.URLError:
+        print "unable to obtain diags from %s" % diag_url
+    except BadStatusLine:
+        print "unable to obtain diags from %s" % diag_url
+    except Exception as e:
+        print "unable to obtain diags from %s %s" % (diag_url, e)
+    return False
+
+
+def _get_cbcollect_info(input, server, path):
+    print "grabbing cbcollect from {0}".format(server.ip)
+    # raises when the logs could not be downloaded
+    cbcollectRunner(server, path).run()
+    return True
+
+
+def _get_couch_dbinfo(input, server, path):
+    print "grabbing dbinfo from {0}".format(server.ip)
+    # raises when the dbinfo could not be downloaded
+    couch_dbinfo_Runner(server, path).run()
+    return True
+
+
+def _get_core_dumps(input, server, path):
+    print "grabbing core dumps files from {0}".format(server.ip)
+    return Getcoredumps(server, path).run()
+
+
+def get_server_logs(input, path):
+    collector = ArtifactCollector(input, path)
+    collector.add('diag', _get_server_diag)
+    collector.run()
 
 def get_logs_cluster_run(input, path, ns_server_path):
     print "grabbing logs (cluster-run)"
@@ -235,22 +392,14 @@ def get_logs_cluster_run(input, path, ns_server_path):
         print "NOT POSSIBLE TO GRAB LOGS (CLUSTER_RUN)"
 
 def get_cbcollect_info(input, path):
-    for server in input.servers:
-        print "grabbing cbcollect from {0}".format(server.ip)
-        path = path or "."
-        try:
-            cbcollectRunner(server, path).run()
-        except Exception as e:
-            print "NOT POSSIBLE TO GRAB CBCOLLECT FROM {0}: {1}".format(server.ip, e)
+    collector = ArtifactCollector(input, path)
+    collector.add('cbcollect', _get_cbcollect_info)
+    collector.run()
 
 def get_couch_dbinfo(input, path):
-    for server in input.servers:
-        print "grabbing dbinfo from {0}".format(server.ip)
-        path = path or "."
-        try:
-            couch_dbinfo_Runner(server, path).run()
-        except Exception as e:
-            print "NOT POSSIBLE TO GRAB dbinfo FROM {0}: {1}".format(server.ip, e)
+    collector = ArtifactCollector(input, path)
+    collector.add('couch_dbinfo', _get_couch_dbinfo)
+    collector.run()
 
 def clear_old_core_dumps(_input, path):
     for server in _input.servers:
@@ -261,17 +410,98 @@ def clear_old_core_dumps(_input, path):
             print "Unable to clear core dumps on {0} : {1}".format(server.ip, e)
 
 def get_core_dumps(_input, path):
-    ret = False
-    for server in _input.servers:
-        print "grabbing core dumps files from {0}".format(server.ip)
-        path = path or "."
-        try:
-            if Getcoredumps(server, path).run():
-                ret = True
-        except Exception as e:
-            print "NOT POSSIBLE TO GRAB CORE DUMPS FROM {0} : {1}".\
-                format(server.ip, e)
-    return ret
+    collector = ArtifactCollector(_input, path)
+    collector.add('core_dumps', _get_core_dumps)
+    return len(collector.run()) > 0
+
+
+def split_ini_file(ini, num_slices, path):
+    """Writes num_slices copies of the ini file under path, each listing a
+    disjoint, contiguous slice of its [servers], the first slices getting one
+    more server when they do not divide evenly. Returns the new file names"""
+    config = ConfigParser.ConfigParser()
+    config.optionxform = str
+    config.read(ini)
+    servers = [config.get('servers', option) for option in config.options('servers')]
+    if len(servers) < num_slices:
+        sys.exit("-j {0} needs at least {0} servers in {1}, found {2}".
+                 format(num_slices, ini, len(servers)))
+    size, remainder = divmod(len(servers), num_slices)
+    ini_files = []
+    end = 0
+    for i in range(num_slices):
+        start, end = end, end + size + (1 if i < remainder else 0)
+        for option in config.options('servers'):
+            config.remove_option('servers', option)
+        for j, server in enumerate(servers[start:end]):
+            config.set('servers', str(j + 1), server)
+        worker_path = os.path.join(path, "worker_{0}".format(i + 1))
+        if not os.path.exists(worker_path):
+            os.makedirs(worker_path)
+        ini_file = os.path.join(worker_path, os.path.basename(ini))
+        with open(ini_file, 'w') as f:
+            config.write(f)
+        ini_files.append(ini_file)
+    return ini_files
+
+
+def write_conf_file(conf_file, tests, params):
+    with open(conf_file, 'w') as f:
+        for test in tests:
+            f.write("{0}\n".format(test))
+        if params:
+            f.write("params:\n")
+            for key, value in params.iteritems():
+                f.write("    {0}={1}\n".format(key, value))
+
+
+def run_parallel(names, conf_params, arg_i, arg_p, options, root_log_dir, str_time):
+    """Runs the tests in options.jobs child testrunners, each with its own
+    slice of the cluster, logs folder and xunit report, and merges the reports"""
+    num_workers = min(options.jobs, len(names))
+    ini_files = split_ini_file(arg_i, num_workers, root_log_dir)
+    params = dict((key, value) for key, value in conf_params.iteritems()
+                  if key not in ('ini', 'cluster_name', 'conf_file'))
+    workers = []
+    for i in range(num_workers):
+        worker_path = os.path.dirname(ini_files[i])
+        conf_file = os.path.join(worker_path, "tests.conf")
+        write_conf_file(conf_file, names[i::num_workers], params)
+        command = [sys.executable, sys.argv[0], "-i", ini_files[i], "-c", conf_file,
+                   "-l", options.loglevel, "--log-dir", worker_path]
+        if arg_p:
+            command.extend(["-p", arg_p])
+        output = open(os.path.join(worker_path, "testrunner.out"), 'w')
+        print "worker {0}: {1} tests on {2}, output in {3}".format(i + 1, len(names[i::num_workers]),
+                                                                 ini_files[i], output.name)
+        workers.append((worker_path, output, subprocess.Popen(command, stdout=output,
+                                                              stderr=subprocess.STDOUT)))
+    xunit = XUnitTestResult()
+    results = []
+    for worker_path, output, process in workers:
+        rc = process.wait()
+        output.close()
+        print "worker {0} finished with exit code {1}".format(worker_path, rc)
+        for report_file in sorted(glob.glob(os.path.join(worker_path, "report-*.xml"))):
+            for name, status, time_taken in xunit.merge(report_file):
+                results.append({"result": status, "name": name, "time": time_taken})
+    xunit.write("{0}{2}report-{1}".format(root_log_dir, str_time, os.sep))
+    xunit.print_summary()
+    print "testrunner logs, diags and results are available under {0}".format(root_log_dir)
+    return results
+
+
+def exit_on_failures(results):
+    # print out fail for those tests which failed and do sys.exit() error code
+    fail_count = 0
+    for result in results:
+        if result["result"] == "fail":
+            print result["name"], " fail "
+            fail_count += 1
+        else:
+            print result["name"], " pass"
+    if fail_count > 0:
+        sys.exit(1)
 
 
 class StoppableThreadWithResult(Thread):
@@ -305,6 +535,7 @@ def main():
     BEFORE_SUITE = "suite_setUp"
     AFTER_SUITE = "suite_tearDown"
     names, runtime_test_params, arg_i, arg_p, options = parse_args(sys.argv)
+    conf_params = dict(runtime_test_params)
     # get params from command line
     TestInputSingleton.input = TestInputParser.get_test_input(sys.argv)
     # ensure command line params get higher priority
@@ -318,10 +549,18 @@ def main():
     abs_path = os.path.dirname(os.path.abspath(sys.argv[0]))
     # Create testrunner logs subdirectory
     str_time = time.strftime("%y-%b-%d_%H-%M-%S", time.localtime())
-    root_log_dir = os.path.join(abs_path, "logs{0}testrunner-{1}".format(os.sep, str_time))
+    root_log_dir = options.log_dir or \
+                   os.path.join(abs_path, "logs{0}testrunner-{1}".format(os.sep, str_time))
     if not os.path.exists(root_log_dir):
         os.makedirs(root_log_dir)
 
+    if options.jobs > 1:
+        results = run_parallel(names, conf_params, arg_i, arg_p, options,
+                               root_log_dir, str_time)
+        if "makefile" in TestInputSingleton.input.test_params:
+            exit_on_failures(results)
+        return
+
     results = []
     case_number = 1
     if "GROUP" in runtime_test_params:
@@ -449,8 +688,10 @@ def main():
         if result.failures or result.errors:
             # Immediately get the server logs, if
             # the test has failed or has errors
+            # collect everything from all servers in one go
+            collector = ArtifactCollector(TestInputSingleton.input, logs_folder)
             if "get-logs" in TestInputSingleton.input.test_params:
-                get_server_logs(TestInputSingleton.input, logs_folder)
+                collector.add('diag', _get_server_diag)
 
             if "get-logs-cluster-run" in TestInputSingleton.input.test_params:
                 if TestInputSingleton.input.param("get-logs-cluster-run", True):
@@ -460,11 +701,12 @@ def main():
 
             if "get-cbcollect-info" in TestInputSingleton.input.test_params:
                 if TestInputSingleton.input.param("get-cbcollect-info", True):
-                    get_cbcollect_info(TestInputSingleton.input, logs_folder)
+                    collector.add('cbcollect', _get_cbcollect_info)
 
             if "get-couch-dbinfo" in TestInputSingleton.input.test_params and \
                 TestInputSingleton.input.param("get-couch-dbinfo", True):
-                    get_couch_dbinfo(TestInputSingleton.input, logs_folder)
+                    collector.add('couch_dbinfo', _get_couch_dbinfo)
+            collector.run()
 
             errors = []
             for failure in result.failures:
@@ -499,16 +741,7 @@ def main():
     except AttributeError as ex:
         pass
     if "makefile" in TestInputSingleton.input.test_params:
-        # print out fail for those tests which failed and do sys.exit() error code
-        fail_count = 0
-        for result in results:
-            if result["result"] == "fail":
-                print result["name"], " fail "
-                fail_count += 1
-            else:
-                print result["name"], " pass"
-        if fail_count > 0:
-            sys.exit(1)
+        exit_on_failures(results)
 
     if TestInputSingleton.input.param("get-delays", False):
         sd.stop_measure_sched_delay()
@@ -0,0 +1,68 @@
+import sys
+import threading
+from multiprocessing import Process, Queue
+
+sys.path.append(".")
+sys.path.append("lib")
+
+import crc32
+from membase.api.rest_client import RestConnection
+from memcached.helper.data_helper import VBucketAwareMemcached
+from memcached.helper.kvstore import KVStore
+from mock_cluster import MockCluster
+from tasks.task import ShardedValidateDataTask
+
+# forks REST clients and validation shards from a process whose pool holds
+# keep-alive connections and that keeps making REST calls, every child must
+# use connections of its own instead of reading the parent's replies
+
+NUM_ITEMS = 5000
+NUM_PROCESSES = 4
+
+
+def get_nodes(server, results):
+    try:
+        for i in xrange(20):
+            RestConnection(server).get_nodes()
+        results.put(None)
+    except Exception as e:
+        results.put(repr(e))
+
+
+cluster = MockCluster(num_nodes=3, num_vbuckets=64)
+cluster.start()
+stop = threading.Event()
+try:
+    server = cluster.servers()[0]
+    rest = RestConnection(server)
+    client = VBucketAwareMemcached(rest, "default")
+    kv_store = KVStore()
+    for i in xrange(NUM_ITEMS):
+        key, value = "key-{0}".format(i), "value-{0}".format(i)
+        client.set(key, 0, 0, value)
+        kv_store.partition(key)["partition"].set(key, str(crc32.crc32_hash(value)), 0, 0)
+    client.done()
+
+    def poll():
+        while not stop.is_set():
+            rest.get_nodes()
+    poller = threading.Thread(target=poll)
+    poller.daemon = True
+    poller.start()
+
+    results = Queue()
+    processes = [Process(target=get_nodes, args=(server, results)) for i in xrange(NUM_PROCESSES)]
+    for process in processes:
+        process.start()
+    errors = [error for error in [results.get(timeout=60) for process in processes] if error]
+    for process in processes:
+        process.join()
+    assert not errors, "forked REST clients failed: {0}".format(errors)
+
+    task = ShardedValidateDataTask(server, "default", kv_store, num_shards=NUM_PROCESSES)
+    task.run()
+    assert task.result(60), "sharded validation failed"
+finally:
+    stop.set()
+    cluster.stop()
+print "{0} forked REST clients and {0} validation shards ok".format(NUM_PROCESSES)
@@ -0,0 +1,74 @@
+import BaseHTTPServer
+import json
+import SocketServer
+import sys
+import threading
+import urlparse
+
+sys.path.append(".")
+sys.path.append("lib")
+
+from membase.api.rest_client import RestConnection
+from TestInput import TestInputServer
+
+# streams view and N1QL rows from a local HTTP/1.1 server keeping its
+# connections alive, the way the view engine and the query service do
+
+ROWS = [{"id": str(i), "key": i, "value": None} for i in xrange(1000)]
+
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, body, keep_alive=True):
+        body = json.dumps(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if not keep_alive:
+            self.send_header("Connection", "close")
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path
+        if path == "/nodes/self":
+            self._reply({"version": "5.5.0-0000-enterprise",
+                         "couchApiBase": "http://127.0.0.1:{0}/".format(self.server.server_port)},
+                        keep_alive=False)
+        else:
+            self._reply({"total_rows": len(ROWS), "rows": ROWS})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader("Content-Length") or 0))
+        self._reply({"requestID": "1", "results": ROWS, "status": "success"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+httpd = KeepAliveServer(("127.0.0.1", 0), KeepAliveHandler)
+thread = threading.Thread(target=httpd.serve_forever)
+thread.daemon = True
+thread.start()
+
+server = TestInputServer()
+server.ip = "127.0.0.1"
+server.rest_username = 'Administrator'
+server.rest_password = 'password'
+server.port = httpd.server_port
+rest = RestConnection(server)
+
+rows = list(rest.query_view_rows("ddoc", "view", "default", {"stale": "false"}))
+assert rows == ROWS, "got {0} view rows out of {1}".format(len(rows), len(ROWS))
+
+rows = list(rest.query_tool_rows("select * from default", port=httpd.server_port))
+assert rows == ROWS, "got {0} query rows out of {1}".format(len(rows), len(ROWS))
+
+httpd.shutdown()
+print "streamed {0} view and query rows".format(len(ROWS))